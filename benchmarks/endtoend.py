@@ -0,0 +1,379 @@
+"""
+Measures pulsus end to end: runs the server against local stand-ins for
+the APNS gateway and feedback service (TLS, binary protocol) and for
+FCM (HTTP, with configurable latency and errors), and pushes
+notifications to `/api/push/` with `Client` at a controlled rate.
+
+Reports the notifications delivered per second, the p50/p99 latency
+from enqueueing a notification in the client to it arriving at the
+stand-in (per priority, when a share is sent with high priority), and
+the memory growth and CPU time per notification of the server process.
+
+    python -m benchmarks.endtoend [--count N] [--rate N] ...
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+from gevent import pywsgi, ssl
+from gevent.server import StreamServer
+
+from pulsus.client import Client
+from pulsus.services.apns import APNSNotification
+from pulsus.services.apns.notification import FRAME_HEADER
+from pulsus.services.apns.service import FEEDBACK_RECORD
+from pulsus.services.base import PRIORITIES
+from pulsus.services.gcm import GCMJSONMessage
+
+
+# APNS error response: command, status, identifier
+ERROR_RESPONSE = struct.Struct("!BBI")
+STATUS_INVALID_TOKEN = 8
+
+LOGGING_CONF = """\
+[loggers]
+keys = root
+
+[handlers]
+keys = stderr
+
+[formatters]
+keys = plain
+
+[logger_root]
+level = %s
+handlers = stderr
+
+[handler_stderr]
+class = StreamHandler
+args = (sys.stderr,)
+formatter = plain
+
+[formatter_plain]
+format = %%(asctime)s %%(name)s %%(levelname)s %%(message)s
+"""
+
+
+class Stats(object):
+    """
+    Latencies of the notifications received by the stand-ins.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        # priority -> latencies
+        self.by_priority = {}
+        self.last_received = None
+
+    def received(self, sent_at, priority=None):
+        now = time.time()
+        self.latencies.append(now - sent_at)
+        self.by_priority.setdefault(priority or 'normal', []).append(
+            now - sent_at)
+        self.last_received = now
+
+    def percentile(self, p, priority=None):
+        latencies = self.latencies
+        if priority is not None:
+            latencies = self.by_priority.get(priority, [])
+        if not latencies:
+            return float('nan')
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+class APNSGateway(object):
+    """
+    Binary protocol gateway, replying to a share of the notifications
+    with an error response and closing the connection, like APNS.
+    """
+
+    def __init__(self, context, stats, error_rate=0.0):
+        self.stats = stats
+        self.error_rate = error_rate
+        self.server = StreamServer(('127.0.0.1', 0), self.handle,
+                                   ssl_context=context)
+
+    def handle(self, sock, address):
+        buf = bytearray()
+        while True:
+            data = sock.recv(64 * 1024)
+            if not data:
+                return
+            buf += data
+            offset = 0
+            while len(buf) - offset >= FRAME_HEADER.size:
+                (_, identifier, _, _, _,
+                 length) = FRAME_HEADER.unpack_from(buf, offset)
+                start = offset + FRAME_HEADER.size
+                if start + length > len(buf):
+                    break
+                payload = json.loads(bytes(buf[start:start + length]))
+                offset = start + length
+                if random.random() < self.error_rate:
+                    sock.sendall(ERROR_RESPONSE.pack(
+                        8, STATUS_INVALID_TOKEN, identifier))
+                    sock.close()
+                    return
+                self.stats.received(payload['t'], payload.get('p'))
+            del buf[:offset]
+
+
+class APNSFeedback(object):
+    """
+    Feedback service, reporting ``count`` invalid tokens per connection.
+    """
+
+    def __init__(self, context, count=0):
+        self.count = count
+        self.server = StreamServer(('127.0.0.1', 0), self.handle,
+                                   ssl_context=context)
+
+    def handle(self, sock, address):
+        now = int(time.time())
+        sock.sendall(b''.join(FEEDBACK_RECORD.pack(now, 32, os.urandom(32))
+                              for _ in range(self.count)))
+        sock.close()
+
+
+class FCM(object):
+    """
+    FCM legacy HTTP endpoint, answering after ``latency`` seconds. A
+    share of the requests fails with a 503, and of the registration IDs
+    with ``NotRegistered``.
+    """
+
+    def __init__(self, stats, latency=0.0, error_rate=0.0,
+                 result_error_rate=0.0):
+        self.stats = stats
+        self.latency = latency
+        self.error_rate = error_rate
+        self.result_error_rate = result_error_rate
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), self.application,
+                                        log=None)
+
+    def application(self, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = json.loads(environ['wsgi.input'].read(length))
+        if self.latency:
+            gevent.sleep(self.latency)
+        if random.random() < self.error_rate:
+            start_response('503 Service Unavailable', [])
+            return [b'']
+        results = []
+        for i, _ in enumerate(body['registration_ids']):
+            if random.random() < self.result_error_rate:
+                results.append({'error': 'NotRegistered'})
+            else:
+                results.append({'message_id': '0:%d' % i})
+                self.stats.received(body['data']['t'],
+                                    body['data'].get('p'))
+        data = json.dumps({
+            'success': sum(1 for r in results if 'message_id' in r),
+            'failure': sum(1 for r in results if 'error' in r),
+            'canonical_ids': 0, 'results': results}).encode('utf8')
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [data]
+
+
+def generate_cert(directory):
+    """
+    Returns the path of a self-signed certificate and key, in one file.
+    """
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', key, '-out', cert, '-days', '1',
+         '-subj', '/CN=localhost'], stderr=subprocess.DEVNULL)
+    path = os.path.join(directory, 'apns.pem')
+    with open(path, 'w') as f:
+        for name in (cert, key):
+            with open(name) as part:
+                f.write(part.read())
+    return path
+
+
+def write_config(directory, args, certfile, gateway, feedback, fcm):
+    with open(os.path.join(directory, 'pulsus.conf'), 'w') as f:
+        f.write('[server]\naddress = 127.0.0.1\nport = %d\n' % args.port)
+        f.write('\n[apns]\ncert_file_pem = %s\n' % certfile)
+        f.write('gateway = 127.0.0.1:%d\n' % gateway.server.server_port)
+        f.write('feedback = 127.0.0.1:%d\n' % feedback.server.server_port)
+        f.write('feedback_interval = %s\n' % args.feedback_interval)
+        f.write('\n[gcm]\napi_key = benchmark\n')
+        f.write('url = http://127.0.0.1:%d/fcm/send\n' %
+                fcm.server.server_port)
+    with open(os.path.join(directory, 'logging.conf'), 'w') as f:
+        f.write(LOGGING_CONF % args.log_level)
+
+
+def process_usage(pid):
+    """
+    Returns the resident memory (bytes) and CPU time (seconds) of a
+    process.
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024, cpu
+    return 0, cpu
+
+
+def make_notification(i, kind, priority=None):
+    extra = {'t': time.time()}
+    if priority is not None:
+        extra['p'] = priority
+    if kind == 'apns':
+        notification = APNSNotification(
+            token=os.urandom(32), alert='Hello World!', identifier=i,
+            extra=extra, sandbox=False)
+    else:
+        extra['message'] = 'Hello World!'
+        notification = GCMJSONMessage(
+            registration_ids=['APA91bF%030d' % i], data=extra)
+    notification.priority = priority
+    return notification
+
+
+def wait_for_server(client, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client.content_types()
+            return
+        except Exception:
+            if time.time() > deadline:
+                raise
+            gevent.sleep(0.1)
+
+
+def push(client, args):
+    """
+    Enqueues the notifications at ``args.rate`` per second (as fast as
+    possible if 0), alternating between APNS and GCM as configured. A
+    share of ``args.high_share`` is sent with high priority, the others
+    with ``args.priority``.
+    """
+    kinds = {'apns': ['apns'], 'gcm': ['gcm'],
+             'both': ['apns', 'gcm']}[args.services]
+    start = time.time()
+    for i in range(args.count):
+        if args.rate:
+            delay = start + i / float(args.rate) - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+        priority = args.priority
+        if random.random() < args.high_share:
+            priority = 'high'
+        client.enqueue(make_notification(i, kinds[i % len(kinds)],
+                                         priority))
+    client.flush()
+
+
+def run(args, directory):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    certfile = args.cert or generate_cert(directory)
+    context.load_cert_chain(certfile)
+    stats = Stats()
+    gateway = APNSGateway(context, stats, args.apns_error_rate)
+    feedback = APNSFeedback(context, args.feedback_count)
+    fcm = FCM(stats, args.fcm_latency, args.fcm_error_rate,
+              args.fcm_result_error_rate)
+    for stand_in in (gateway, feedback, fcm):
+        stand_in.server.start()
+    write_config(directory, args, certfile, gateway, feedback, fcm)
+    log = open(args.server_log or os.devnull, 'w')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'pulsus.server.serve', directory],
+        stdout=log, stderr=log)
+    client = Client('127.0.0.1', args.port, content_type=args.content_type,
+                    batch_size=args.batch_size)
+    try:
+        wait_for_server(client)
+        rss_before, cpu_before = process_usage(server.pid)
+        start = time.time()
+        push(client, args)
+        # Wait until nothing arrived for a second
+        while True:
+            received = len(stats.latencies)
+            gevent.sleep(1)
+            if len(stats.latencies) == received:
+                break
+        rss_after, cpu_after = process_usage(server.pid)
+    finally:
+        client.close()
+        server.terminate()
+        server.wait()
+        log.close()
+        for stand_in in (gateway, feedback, fcm):
+            stand_in.server.stop()
+    delivered = len(stats.latencies)
+    elapsed = (stats.last_received or time.time()) - start
+    print('delivered      %d/%d' % (delivered, args.count))
+    print('throughput     %.0f notifications/s' % (delivered / elapsed))
+    print('latency p50    %.1f ms' % (stats.percentile(0.5) * 1000))
+    print('latency p99    %.1f ms' % (stats.percentile(0.99) * 1000))
+    if len(stats.by_priority) > 1:
+        for priority in PRIORITIES:
+            if priority in stats.by_priority:
+                print('  %-6s p50  %.1f ms, p99 %.1f ms' % (
+                    priority, stats.percentile(0.5, priority) * 1000,
+                    stats.percentile(0.99, priority) * 1000))
+    print('memory growth  %.1f MB' % ((rss_after - rss_before) / 1e6))
+    print('cpu/push       %.1f us' % (
+        (cpu_after - cpu_before) / max(delivered, 1) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='notifications per second, 0 for no limit')
+    parser.add_argument('--services', choices=['apns', 'gcm', 'both'],
+                        default='both')
+    parser.add_argument('--priority', choices=PRIORITIES, default=None,
+                        help='priority of the bulk of the notifications')
+    parser.add_argument('--high-share', type=float, default=0.0,
+                        help='share of notifications sent with high '
+                        'priority')
+    parser.add_argument('--content-type', default=None)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--port', type=int, default=18321)
+    parser.add_argument('--cert', help='certificate and key, generated '
+                        'with openssl if not given')
+    parser.add_argument('--apns-error-rate', type=float, default=0.0)
+    parser.add_argument('--feedback-count', type=int, default=0)
+    parser.add_argument('--feedback-interval', type=float, default=60)
+    parser.add_argument('--fcm-latency', type=float, default=0.0,
+                        help='seconds')
+    parser.add_argument('--fcm-error-rate', type=float, default=0.0)
+    parser.add_argument('--fcm-result-error-rate', type=float, default=0.0)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--server-log', help='file to write the output of '
+                        'the server to')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='pulsus-benchmark-')
+    try:
+        run(args, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures the memory footprint of queued notifications, and the rate at
+which serialized notifications are deserialized and packed.
+
+    python -m benchmarks.notifications [count]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from pulsus.services.apns import APNSNotification
+from pulsus.services.base import BaseNotification
+from pulsus.services.gcm import GCMJSONMessage
+
+
+def apns_data(i):
+    return APNSNotification(
+        token=os.urandom(32), alert='Hello World!', badge=1,
+        identifier=i).serialize()
+
+
+def gcm_data(i):
+    return GCMJSONMessage(
+        registration_ids=['APA91bF%030d' % i],
+        data={'message': 'Hello World!'}).serialize()
+
+
+def measure_memory(serialized):
+    # Parse from JSON, like the server does, so that nothing is shared
+    # with the serialized data.
+    lines = [json.dumps(data) for data in serialized]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    notifications = [BaseNotification.deserialize(json.loads(line))
+                     for line in lines]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(
+        before, 'filename'))
+    # Keep the notifications alive up to here
+    return size / float(len(notifications))
+
+
+def measure_throughput(serialized):
+    t = time.time()
+    for data in serialized:
+        BaseNotification.deserialize(data).pack()
+    return len(serialized) / (time.time() - t)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, factory in [('apns', apns_data), ('gcm', gcm_data)]:
+        serialized = [factory(i) for i in range(count)]
+        per_item = measure_memory(serialized)
+        rate = measure_throughput(serialized)
+        print('%-5s %8.1f bytes/notification %10.0f deserialize+pack/s' % (
+            name, per_item, rate))
+
+
+if __name__ == '__main__':
+    main()
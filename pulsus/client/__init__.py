@@ -1 +1,2 @@
 from .client import Client  # noqa
+from .aio import AsyncClient  # noqa
@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import logging
+
+from .client import Client
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClient(object):
+    """
+    asyncio variant of ``Client``, taking the same arguments. Requests
+    are made by a ``Client`` in the default executor, sharing its pool of
+    keep-alive connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.client = Client(*args, **kwargs)
+        self._buffer = []
+        self._flush_handle = None
+        self._pushing = set()
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    async def push(self, notifications):
+        return await self._call(self.client.push, notifications)
+
+    async def push_stream(self, notifications):
+        return await self._call(self.client.push_stream, notifications)
+
+    async def feedback(self):
+        return await self._call(self.client.feedback)
+
+    async def export_feedback(self, cursor=None, limit=None, **filters):
+        return await self._call(self.client.export_feedback, cursor, limit,
+                                **filters)
+
+    async def ack_feedback(self, cursor):
+        return await self._call(self.client.ack_feedback, cursor)
+
+    async def rate_limits(self):
+        return await self._call(self.client.rate_limits)
+
+    async def set_rate_limit(self, kind, app=None, max_request_rate=None,
+                             max_recipient_rate=None):
+        return await self._call(self.client.set_rate_limit, kind, app,
+                                max_request_rate, max_recipient_rate)
+
+    def enqueue(self, notification):
+        """
+        Buffers the notification, to be pushed by a background task
+        together with others, see ``Client.enqueue()``.
+        """
+        self.push_async([notification])
+
+    def push_async(self, notifications):
+        self._buffer.extend(notifications)
+        if len(self._buffer) >= self.client.batch_size:
+            self._flush_buffer()
+        elif self._flush_handle is None and self._buffer:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.client.linger, self._flush_buffer)
+
+    def _flush_buffer(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch_size = self.client.batch_size
+        while self._buffer:
+            batch = self._buffer[:batch_size]
+            del self._buffer[:batch_size]
+            task = asyncio.ensure_future(self._push_batch(batch))
+            self._pushing.add(task)
+            task.add_done_callback(self._pushing.discard)
+
+    async def _push_batch(self, batch):
+        try:
+            resp = await self.push(batch)
+            resp.raise_for_status()
+        except Exception:
+            logger.exception("Error pushing %d notifications" % len(batch))
+
+    async def flush(self):
+        """
+        Pushes the buffered notifications, and waits until all pushes in
+        progress completed.
+        """
+        self._flush_buffer()
+        if self._pushing:
+            await asyncio.gather(*self._pushing)
+
+    async def close(self):
+        await self.flush()
+        self.client.session.close()
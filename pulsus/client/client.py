@@ -1,20 +1,265 @@
 import json
+import logging
+import random
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .. import serialization
+from ..serialization import CODECS, JSON_CONTENT_TYPE, get_codec
+
+
+MAX_RETRIES = 5
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 60
+# Connections kept alive to the server.
+POOL_SIZE = 10
+# Seconds to wait for connecting to, and for a response from, the server.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Notifications are pushed once this many are enqueued, or the first of
+# them was enqueued LINGER seconds ago.
+BATCH_SIZE = 500
+LINGER = 0.05
+
+logger = logging.getLogger(__name__)
 
 
 class Client(object):
-    def __init__(self, address, port):
+    """
+    Client of the push API. Notifications are sent in the fastest format
+    both the client and the server support, unless a ``content_type`` is
+    given. Requests share a pool of ``pool_size`` keep-alive connections;
+    failing to connect is retried up to ``max_retries`` times. The client
+    can be shared by threads.
+    """
+
+    def __init__(self, address, port, max_retries=MAX_RETRIES,
+                 content_type=None, pool_size=POOL_SIZE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 batch_size=BATCH_SIZE, linger=LINGER):
         self.address = address
         self.port = port
         self.api_url = 'http://{0}:{1}/api'.format(address, port)
+        self.max_retries = max_retries
+        self.content_type = content_type
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.linger = linger
+        self._codec = None
+        self.session = requests.Session()
+        retry = Retry(total=max_retries, connect=max_retries, read=0,
+                      status=0, redirect=0, backoff_factor=0.1)
+        self.session.mount('http://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        self._buffer = []
+        self._buffer_started = None
+        self._buffer_cond = threading.Condition()
+        self._flush_thread = None
+        self._closed = False
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, self.api_url + path, **kwargs)
+
+    def content_types(self):
+        """
+        Returns the content types the server accepts for pushes.
+        """
+        resp = self.request('OPTIONS', '/push/')
+        if resp.status_code != 204:
+            # Servers predating content negotiation only take JSON
+            return [JSON_CONTENT_TYPE]
+        return [t.strip() for t in resp.headers['Accept-Post'].split(',')]
+
+    def get_codec(self):
+        if self._codec is None:
+            content_type = self.content_type
+            if content_type is None:
+                accepted = self.content_types()
+                content_type = next(t for t in serialization.content_types()
+                                    if t in accepted)
+            self._codec = CODECS[content_type]
+        return self._codec
 
     def push(self, notifications):
-        data = json.dumps([n.serialize() for n in notifications])
-        resp = requests.post(self.api_url + '/push/',
-                             data=data)
+        """
+        Pushes the notifications. When the server is overloaded (429), the
+        request is retried after the delay the server asks for, or with
+        exponential backoff if it does not, up to `max_retries` times.
+        """
+        codec = self.get_codec()
+        data = codec.dumps([n.serialize() for n in notifications])
+        headers = {'Content-Type': codec.content_type}
+        backoff = INITIAL_BACKOFF
+        for attempt in range(self.max_retries + 1):
+            resp = self.request('POST', '/push/', data=data,
+                                headers=headers)
+            if resp.status_code != 429 or attempt == self.max_retries:
+                break
+            try:
+                delay = float(resp.headers['Retry-After'])
+            except (KeyError, ValueError):
+                delay = backoff
+            # Jitter, so that clients do not come back in lockstep
+            time.sleep(delay * random.uniform(1, 1.25))
+            backoff = min(backoff * 2, MAX_BACKOFF)
         return resp
 
+    def push_stream(self, notifications):
+        """
+        Uploads the notifications as newline delimited JSON, using a
+        chunked request, so that the server starts queueing them before
+        the upload completes. `notifications` can be any iterable,
+        including a generator. Returns the server's accept/reject
+        summary.
+        """
+        def lines():
+            for n in notifications:
+                yield (json.dumps(n.serialize()) + '\n').encode('utf8')
+        resp = self.request('POST', '/push/', data=lines(),
+                            headers={'Content-Type': 'application/x-ndjson'})
+        resp.raise_for_status()
+        return resp.json()
+
     def feedback(self):
-        resp = requests.post(self.api_url + '/feedback/')
+        accept = ', '.join(serialization.content_types())
+        resp = self.request('POST', '/feedback/',
+                            headers={'Accept': accept})
+        resp.raise_for_status()
+        return get_codec(resp.headers.get('Content-Type')).loads(
+            resp.content)
+
+    def export_feedback(self, cursor=None, limit=None, **filters):
+        """
+        Returns a page of the feedback retained by the server, starting
+        at `cursor` (by default, the first unacknowledged entry), as a
+        list of entries, the cursor of the next page, and whether there
+        are more entries. `filters` can be `type`, `sandbox`, `since`
+        and `until`. Acknowledge entries once processed, using
+        `ack_feedback()`.
+        """
+        params = dict(filters)
+        if cursor is not None:
+            params['cursor'] = cursor
+        if limit is not None:
+            params['limit'] = limit
+        resp = self.request('GET', '/feedback/export/', params=params,
+                            stream=True)
+        resp.raise_for_status()
+        entries = [json.loads(line) for line in resp.iter_lines() if line]
+        last = entries.pop()
+        return entries, last['next_cursor'], last['more']
+
+    def ack_feedback(self, cursor):
+        resp = self.request('POST', '/feedback/ack/',
+                            data=json.dumps(dict(cursor=cursor)))
+        resp.raise_for_status()
+        return resp.json()['cursor']
+
+    def rate_limits(self):
+        """
+        Returns the rate limits, the rates currently allowed and measured,
+        and the number of times it was throttled, of each push service.
+        """
+        resp = self.request('GET', '/rate-limits/')
+        resp.raise_for_status()
+        return resp.json()
+
+    def set_rate_limit(self, kind, app=None, max_request_rate=None,
+                       max_recipient_rate=None):
+        """
+        Limits the requests, and recipients, per second of the push
+        service of `kind` (`apns`, `apns_sandbox` or `gcm`) for `app`,
+        None meaning unlimited. Returns the state of the service.
+        """
+        resp = self.request('POST', '/rate-limits/', data=json.dumps(dict(
+            kind=kind, app=app, max_request_rate=max_request_rate,
+            max_recipient_rate=max_recipient_rate)))
         resp.raise_for_status()
         return resp.json()
+
+    def enqueue(self, notification):
+        """
+        Buffers the notification, to be pushed in the background together
+        with others, once ``batch_size`` notifications are buffered or
+        ``linger`` seconds passed. Errors are logged.
+        """
+        self.push_async([notification])
+
+    def push_async(self, notifications):
+        """
+        Buffers the notifications, see ``enqueue()``.
+        """
+        with self._buffer_cond:
+            if self._closed:
+                raise RuntimeError('Client is closed')
+            if self._flush_thread is None:
+                self._flush_thread = threading.Thread(
+                    target=self._flush_loop, name='pulsus-client-flush')
+                self._flush_thread.daemon = True
+                self._flush_thread.start()
+            was_empty = not self._buffer
+            if was_empty:
+                self._buffer_started = time.time()
+            self._buffer.extend(notifications)
+            # Start the linger timer, or flush a full batch
+            if was_empty or len(self._buffer) >= self.batch_size:
+                self._buffer_cond.notify()
+
+    def _take_batch(self, wait=True):
+        with self._buffer_cond:
+            while wait and not self._closed:
+                if len(self._buffer) >= self.batch_size:
+                    break
+                if self._buffer:
+                    remaining = (self._buffer_started + self.linger -
+                                 time.time())
+                    if remaining <= 0:
+                        break
+                    self._buffer_cond.wait(remaining)
+                else:
+                    self._buffer_cond.wait()
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+            if self._buffer:
+                self._buffer_started = time.time()
+            return batch
+
+    def _flush_loop(self):
+        while not self._closed:
+            batch = self._take_batch()
+            if batch:
+                self._push_batch(batch)
+
+    def _push_batch(self, batch):
+        try:
+            self.push(batch).raise_for_status()
+        except Exception:
+            logger.exception("Error pushing %d notifications" % len(batch))
+
+    def flush(self):
+        """
+        Pushes the notifications buffered by ``enqueue()`` right away.
+        """
+        while True:
+            batch = self._take_batch(wait=False)
+            if not batch:
+                break
+            self._push_batch(batch)
+
+    def close(self):
+        """
+        Pushes the buffered notifications and closes the connections.
+        """
+        with self._buffer_cond:
+            self._closed = True
+            self._buffer_cond.notify()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
+        self.session.close()
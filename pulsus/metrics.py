@@ -0,0 +1,203 @@
+"""
+Minimal, dependency free metrics, exposed in the Prometheus text format.
+
+Recording a value is a dictionary update (plus a bisect for histograms),
+so that it can be done for every single notification. Gauges are
+usually backed by a function that is only evaluated when the metrics
+are collected.
+"""
+from bisect import bisect_left
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+# Notifications can wait for minutes behind a broadcast.
+WAIT_BUCKETS = LATENCY_BUCKETS + (30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace(
+            '"', r'\"')) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def samples(self):
+        """
+        Yields (name, labels, value) tuples.
+        """
+        for labelvalues, value in sorted(self._values.items()):
+            yield self.name, _format_labels(
+                self.labelnames, labelvalues), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labelvalues, **kwargs):
+        amount = kwargs.get('amount', 1)
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def set(self, value, *labelvalues):
+        self._values[labelvalues] = value
+
+    def set_function(self, func, *labelvalues):
+        """
+        Have the gauge report the return value of ``func`` when collected.
+        """
+        self._values[labelvalues] = func
+
+    def remove(self, *labelvalues):
+        self._values.pop(labelvalues, None)
+
+    def samples(self):
+        for name, labels, value in super(Gauge, self).samples():
+            if callable(value):
+                value = value()
+            yield name, labels, value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            # Bucket counts (the last one being +Inf), and the sum
+            entry = self._values[labelvalues] = [
+                [0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labelvalues, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', _format_labels(
+                    self.labelnames, labelvalues,
+                    ('le', _format_value(bound))), cumulative
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield self.name + '_count', labels, cumulative
+            yield self.name + '_sum', labels, total
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        return '\n'.join(m.render() for m in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+NOTIFICATIONS_QUEUED = REGISTRY.counter(
+    'pulsus_notifications_queued_total',
+    'Notifications queued for sending.',
+    ('service',))
+NOTIFICATIONS_SENT = REGISTRY.counter(
+    'pulsus_notifications_sent_total',
+    'Notifications handed to the push service, by outcome.',
+    ('service', 'worker', 'outcome'))
+SEND_DURATION = REGISTRY.histogram(
+    'pulsus_send_duration_seconds',
+    'Time taken to write a request (or batch) to the push service.',
+    ('service', 'worker'))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'pulsus_queue_depth',
+    'Notifications currently queued.',
+    ('service',))
+QUEUE_BYTES = REGISTRY.gauge(
+    'pulsus_queue_bytes',
+    'Bytes currently queued.',
+    ('service',))
+NOTIFICATIONS_DEAD_LETTERED = REGISTRY.counter(
+    'pulsus_notifications_dead_lettered_total',
+    'Notifications given up on, by reason.',
+    ('service', 'reason'))
+TOKENS_SUPPRESSED = REGISTRY.counter(
+    'pulsus_tokens_suppressed_total',
+    'Device tokens not sent to, because they are known to be invalid.',
+    ('service',))
+LANE_DEPTH = REGISTRY.gauge(
+    'pulsus_lane_depth',
+    'Notifications waiting in the send queue, by priority.',
+    ('service', 'priority'))
+QUEUE_WAIT = REGISTRY.histogram(
+    'pulsus_queue_wait_seconds',
+    'Time notifications waited in the send queue, by priority.',
+    ('service', 'priority'),
+    buckets=WAIT_BUCKETS)
+NOTIFICATIONS_COLLAPSED = REGISTRY.counter(
+    'pulsus_notifications_collapsed_total',
+    'Queued notifications superseded by a newer one to the same device:'
+    ' replaced, or the device dropped from a multicast (merged).',
+    ('service', 'outcome'))
+RATE_LIMIT = REGISTRY.gauge(
+    'pulsus_rate_limit',
+    'Requests, or recipients, per second currently allowed.',
+    ('service', 'unit'))
+THROTTLED = REGISTRY.counter(
+    'pulsus_throttled_total',
+    'Responses of the push service telling it is sent too much.',
+    ('service',))
+RETRIES_PENDING = REGISTRY.gauge(
+    'pulsus_retries_pending',
+    'Notifications waiting to be retried after an error.',
+    ('service',))
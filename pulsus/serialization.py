@@ -0,0 +1,215 @@
+"""
+Wire formats of the push API. Notifications, and feedback, are sent as
+a list of objects, encoded as JSON (by default), msgpack, or in a
+compact binary format. JSON is encoded with orjson, and msgpack with
+the msgpack package, when installed.
+
+The binary format is a sequence of records, each preceded by its length
+(unsigned 32 bit, big endian). A record starts with its kind: either an
+APNS notification, with its token as 32 raw bytes, or any other object,
+as JSON.
+"""
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+BINARY_CONTENT_TYPE = 'application/x-pulsus-binary'
+
+RECORD_LENGTH = struct.Struct('!I')
+RECORD_JSON = 0
+RECORD_APNS = 1
+# Kind, token, identifier, expiry, flags
+APNS_HEADER = struct.Struct('!B32sIIB')
+APNS_SANDBOX = 0x01
+# The header is followed by the app id, preceded by its length.
+APNS_APP = 0x02
+APNS_FIELDS = frozenset(['token', 'identifier', 'expiry', 'sandbox'])
+# Keys of the serialized notifications an APNS record holds.
+APNS_KEYS = frozenset(['type', 'data', 'app'])
+
+
+def json_dumps(obj):
+    """
+    Returns ``obj`` encoded as compact JSON, as bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+
+def json_loads(data):
+    """
+    Decodes JSON given as bytes or str.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf8')
+    return json.loads(data)
+
+
+class JSONCodec(object):
+
+    content_type = JSON_CONTENT_TYPE
+
+    def dumps(self, objs):
+        return json_dumps(objs)
+
+    def loads(self, data):
+        return json_loads(data)
+
+
+class MsgpackCodec(object):
+
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def dumps(self, objs):
+        return msgpack.packb(objs, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class BinaryCodec(object):
+
+    content_type = BINARY_CONTENT_TYPE
+
+    def dumps(self, objs):
+        records = []
+        for obj in objs:
+            record = self._pack_apns(obj)
+            if record is None:
+                record = bytes((RECORD_JSON,)) + json_dumps(obj)
+            records.append(RECORD_LENGTH.pack(len(record)))
+            records.append(record)
+        return b''.join(records)
+
+    def _pack_apns(self, obj):
+        """
+        Returns the record of a serialized APNS notification, or None if
+        it does not fit an APNS record.
+        """
+        if obj.get('type') != 'apns' or not APNS_KEYS.issuperset(obj):
+            return None
+        data = obj['data']
+        token = data['token']
+        identifier = data.get('identifier', 0)
+        expiry = data.get('expiry')
+        if (len(token) != 64 or expiry is None or
+                not 0 <= identifier <= 0xffffffff or
+                not 0 <= expiry <= 0xffffffff):
+            return None
+        flags = 0
+        if data.get('sandbox', True):
+            flags |= APNS_SANDBOX
+        app = b''
+        if obj.get('app') is not None:
+            flags |= APNS_APP
+            app = obj['app'].encode('utf8')
+            if len(app) > 0xff:
+                return None
+            app = bytes((len(app),)) + app
+        rest = dict((k, v) for k, v in data.items() if k not in APNS_FIELDS)
+        return b''.join([
+            APNS_HEADER.pack(RECORD_APNS, bytes.fromhex(token), identifier,
+                             expiry, flags),
+            app,
+            json_dumps(rest) if rest else b''])
+
+    def loads(self, data):
+        objs = []
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            if offset + RECORD_LENGTH.size > len(view):
+                raise ValueError('Truncated record')
+            length, = RECORD_LENGTH.unpack_from(view, offset)
+            offset += RECORD_LENGTH.size
+            record = view[offset:offset + length]
+            if len(record) != length or not length:
+                raise ValueError('Truncated record')
+            offset += length
+            if record[0] == RECORD_APNS:
+                objs.append(self._unpack_apns(record))
+            elif record[0] == RECORD_JSON:
+                objs.append(json_loads(bytes(record[1:])))
+            else:
+                raise ValueError('Unknown record kind: %d' % record[0])
+        return objs
+
+    def _unpack_apns(self, record):
+        if len(record) < APNS_HEADER.size:
+            raise ValueError('Truncated record')
+        _, token, identifier, expiry, flags = APNS_HEADER.unpack_from(record)
+        offset = APNS_HEADER.size
+        obj = dict(type='apns')
+        if flags & APNS_APP:
+            length = record[offset]
+            obj['app'] = bytes(
+                record[offset + 1:offset + 1 + length]).decode('utf8')
+            offset += 1 + length
+        data = {}
+        if offset < len(record):
+            data = json_loads(bytes(record[offset:]))
+        data.update(token=token.hex(), identifier=identifier, expiry=expiry,
+                    sandbox=bool(flags & APNS_SANDBOX))
+        obj['data'] = data
+        return obj
+
+
+CODECS = dict((codec.content_type, codec) for codec in [
+    BinaryCodec(), JSONCodec()])
+if msgpack is not None:
+    CODECS[MSGPACK_CONTENT_TYPE] = MsgpackCodec()
+# Content types, fastest first.
+PREFERENCE = (BINARY_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, JSON_CONTENT_TYPE)
+
+
+def content_types():
+    """
+    Returns the supported content types, fastest first.
+    """
+    return [t for t in PREFERENCE if t in CODECS]
+
+
+def get_codec(content_type):
+    """
+    Returns the codec for a request body of the given content type, or
+    None if the type is not supported. Bodies without a content type are
+    taken to be JSON.
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return CODECS.get(content_type or JSON_CONTENT_TYPE)
+
+
+def negotiate(accept):
+    """
+    Returns the codec best matching an Accept header, JSON by default.
+    """
+    best, best_q = None, 0
+    for item in (accept or '').split(','):
+        params = item.split(';')
+        content_type = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if content_type in CODECS and q > best_q:
+            best, best_q = content_type, q
+    return CODECS[best or JSON_CONTENT_TYPE]
@@ -0,0 +1,429 @@
+import asyncio
+import functools
+import json
+import logging
+import signal
+from urllib.parse import parse_qsl
+
+from .. import metrics
+from ..serialization import get_codec, negotiate
+from ..services.apns.aio import AsyncAPNSService
+from ..services.apns.service import BATCH_SIZE, FEEDBACK_INTERVAL
+from ..services.gcm.aio import AsyncGCMService
+from ..services.gcm.service import (
+    COALESCE_LINGER, GCM_URL, MAX_WORKERS, MIN_WORKERS, SHARED_POOL_SIZE,
+    shared_session)
+from .api import (
+    ACCEPT_POST, BaseAPIServer, INVALID_NOTIFICATION_ERRORS, MAX_LINE_LENGTH,
+    NDJSON_CONTENT_TYPE, ServiceOverloaded,
+    FEEDBACK_COLLECT_INTERVAL, apns_addresses, lane_options,
+    queue_limits, rate_limits, retry_limits,
+    setup_suppression, stream_summary)
+from .deadletter import DeadLetterLog
+from .feedback import FeedbackLog
+from .journal import NotificationJournal, SYNC_INTERVAL
+from .registry import ServiceRegistry
+from .suppression import SuppressionIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncNotificationJournal(NotificationJournal):
+    """
+    ``NotificationJournal`` that syncs from an asyncio task, running the
+    fsync() in the default executor.
+    """
+
+    _sync_task = None
+
+    def start(self):
+        if self._sync_task is None:
+            self._sync_task = asyncio.ensure_future(self._sync_loop())
+
+    def stop(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        self.sync()
+
+    async def _sync_loop(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                await asyncio.sleep(self.sync_interval)
+                if self._dirty:
+                    self._dirty = False
+                    segment = self._current
+                    segment.flush()
+                    await loop.run_in_executor(None, segment.sync)
+        except asyncio.CancelledError:
+            pass
+
+    def _sync_segment(self, segment):
+        segment.sync()
+
+
+class AsyncSuppressionIndex(SuppressionIndex):
+    """
+    ``SuppressionIndex`` reading and writing its file in the default
+    executor, whose ``sync()`` and ``save()`` are coroutines.
+    """
+
+    async def sync(self, write=False):
+        if self.path is None:
+            return
+        write = write or self.dirty
+        snapshot = self._snapshot(write)
+        loop = asyncio.get_event_loop()
+        try:
+            records, version = await loop.run_in_executor(
+                None, self._exchange, snapshot)
+        except Exception:
+            self.dirty = self.dirty or write
+            raise
+        self._merge(records, version)
+
+    async def save(self):
+        await self.sync(write=True)
+
+
+class AsyncAPIServer(BaseAPIServer):
+    """
+    ASGI application serving the push API on an asyncio event loop. The
+    services are started and stopped through the ASGI lifespan protocol.
+    If ``reload_config`` is given, the services are updated to match the
+    config it returns on SIGHUP.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_content_length = kwargs.pop('max_content_length', None)
+        self.stop_timeout = kwargs.pop('stop_timeout', 10.0)
+        self.reload_config = kwargs.pop('reload_config', None)
+        super(AsyncAPIServer, self).__init__(*args, **kwargs)
+        self._feedback_task = None
+
+    def start(self):
+        for service in self.registry.services():
+            service.start()
+        if self.reload_config is not None:
+            try:
+                asyncio.get_event_loop().add_signal_handler(
+                    signal.SIGHUP,
+                    lambda: self.reload(self.reload_config()))
+            except (NotImplementedError, RuntimeError, ValueError):
+                logger.warning("Cannot update the services on SIGHUP")
+        if self.journal is not None:
+            self.journal.start()
+            self.replay_journal()
+        self._feedback_task = asyncio.ensure_future(
+            self._collect_feedback_loop())
+
+    async def stop(self, timeout=10.0):
+        """
+        Stops the services, giving them ``timeout`` seconds to send the
+        notifications still queued. Returns True if nothing was left
+        unsent.
+        """
+        results = await asyncio.gather(
+            *[s.stop(timeout) for s in self.registry.services()])
+        if self._feedback_task is not None:
+            self._feedback_task.cancel()
+            self._feedback_task = None
+        if self.journal is not None:
+            self.journal.close()
+        if self.suppression is not None:
+            await self.suppression.save()
+        return all(results)
+
+    def reload(self, config):
+        """
+        Updates the services to match the config. New services are
+        started, removed ones stopped in the background.
+        """
+        try:
+            added, removed = self.update_services(config)
+        except Exception:
+            logger.exception("Error updating services, keeping them as is")
+            return
+        for service in added:
+            service.start()
+        for service in removed:
+            asyncio.ensure_future(service.stop())
+
+    async def _collect_feedback_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(FEEDBACK_COLLECT_INTERVAL)
+                try:
+                    self.buffer_feedback()
+                    if self.suppression is not None:
+                        await self.suppression.sync()
+                except Exception:
+                    logger.exception("Error collecting feedback")
+        except asyncio.CancelledError:
+            pass
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.dispatch_request(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if not await self.stop(self.stop_timeout):
+                    logger.warning("Notifications left unsent on shutdown")
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch_request(self, scope, receive, send):
+        path, method = scope['path'], scope['method']
+        headers = dict(scope['headers'])
+        if path == '/api/push/' and method == 'POST':
+            content_type = headers.get(b'content-type', b'').decode('latin1')
+            if content_type.split(';')[0].strip() == NDJSON_CONTENT_TYPE:
+                summary = await self.push_notifications_stream(receive)
+                await self.respond(send, 201, json.dumps(summary),
+                                   content_type='application/json')
+                return
+            codec = get_codec(content_type)
+            if codec is None:
+                await self.respond(send, 415, headers=[
+                    (b'accept-post', ACCEPT_POST.encode('latin1'))])
+                return
+            body = await self.read_body(receive)
+            if body is None:
+                await self.respond(send, 413)
+                return
+            try:
+                notifications = codec.loads(body)
+            except ValueError as e:
+                await self.respond(send, 400, str(e))
+                return
+            try:
+                suppression = self.push_notifications(notifications)
+            except ServiceOverloaded as e:
+                await self.respond(send, 429, headers=[
+                    (b'retry-after', str(e.retry_after).encode('ascii'))])
+            except INVALID_NOTIFICATION_ERRORS as e:
+                await self.respond(send, 400, str(e))
+            else:
+                await self.respond(send, 201,
+                                   json.dumps(dict(suppression=suppression)),
+                                   content_type='application/json')
+        elif path == '/api/push/' and method == 'OPTIONS':
+            await self.respond(send, 204, headers=[
+                (b'accept-post', ACCEPT_POST.encode('latin1'))])
+        elif (path == '/api/feedback/' and method == 'POST' and
+                self.feedback_log is not None):
+            # Draining would acknowledge the feedback being exported
+            await self.respond(send, 409, 'Feedback is retained, use '
+                               '/api/feedback/export/')
+        elif path == '/api/feedback/' and method == 'POST':
+            codec = negotiate(headers.get(b'accept', b'').decode('latin1'))
+            await self.respond(send, 200, codec.dumps(self.drain_feedback()),
+                               content_type=codec.content_type)
+        elif (path == '/api/feedback/export/' and method == 'GET' and
+                self.feedback_log is not None):
+            args = dict(parse_qsl(scope['query_string'].decode('latin1')))
+            loop = asyncio.get_event_loop()
+            try:
+                lines = await loop.run_in_executor(
+                    None, self.export_feedback, args)
+            except ValueError as e:
+                await self.respond(send, 400, str(e))
+            else:
+                await self.respond(send, 200, ''.join(lines),
+                                   content_type=NDJSON_CONTENT_TYPE)
+        elif (path == '/api/feedback/ack/' and method == 'POST' and
+                self.feedback_log is not None):
+            body = await self.read_body(receive)
+            try:
+                cursor = self.ack_feedback(json.loads(body.decode('utf8')))
+            except (ValueError, KeyError, TypeError) as e:
+                await self.respond(send, 400, str(e))
+            else:
+                await self.respond(send, 200,
+                                   json.dumps(dict(cursor=cursor)),
+                                   content_type='application/json')
+        elif path == '/api/rate-limits/' and method == 'GET':
+            await self.respond(send, 200, json.dumps(self.get_rate_limits()),
+                               content_type='application/json')
+        elif path == '/api/rate-limits/' and method == 'POST':
+            body = await self.read_body(receive)
+            try:
+                state = self.set_rate_limit(json.loads(body.decode('utf8')))
+            except ValueError as e:
+                await self.respond(send, 400, str(e))
+            else:
+                await self.respond(send, 200, json.dumps(state),
+                                   content_type='application/json')
+        elif path == '/metrics' and method == 'GET':
+            await self.respond(send, 200, metrics.REGISTRY.render(),
+                               content_type=metrics.CONTENT_TYPE)
+        else:
+            await self.respond(send, 400)
+
+    async def respond(self, send, status, body='',
+                      content_type='text/plain; charset=utf-8', headers=()):
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [
+                        (b'content-type', content_type.encode('latin1')),
+                        (b'content-length', str(len(body)).encode('ascii')),
+                    ] + list(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def read_body(self, receive):
+        """
+        Returns the request body, or None if it exceeds the maximum
+        content length.
+        """
+        chunks = []
+        size = 0
+        for chunk in self._iter_body(receive):
+            chunk = await chunk
+            size += len(chunk)
+            if (self.max_content_length is not None and
+                    size > self.max_content_length):
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def _iter_body(self, receive):
+        more_body = True
+
+        async def next_chunk():
+            nonlocal more_body
+            message = await receive()
+            more_body = message.get('more_body', False)
+            return message.get('body', b'')
+
+        while more_body:
+            yield next_chunk()
+
+    async def push_notifications_stream(self, receive):
+        """
+        Queues notifications from a stream of newline delimited JSON as
+        the request body comes in. See ``APIServer`` for the summary
+        returned.
+        """
+        summary = stream_summary()
+        lineno = 0
+        buf = b''
+        skipping = False
+        for chunk in self._iter_body(receive):
+            buf += await chunk
+            while True:
+                end = buf.find(b'\n')
+                if end < 0:
+                    if len(buf) >= MAX_LINE_LENGTH:
+                        if not skipping:
+                            lineno += 1
+                            self.push_line(summary, lineno, None)
+                            skipping = True
+                        buf = b''
+                    break
+                line, buf = buf[:end + 1], buf[end + 1:]
+                if skipping:
+                    # Remainder of a line that was too long
+                    skipping = False
+                    continue
+                lineno += 1
+                self.push_line(summary, lineno, line)
+        if buf and not skipping:
+            lineno += 1
+            self.push_line(summary, lineno, buf)
+        return summary
+
+
+def setup_apns(config, section, sandbox, app=None):
+    if config.get(section, 'protocol', fallback='binary') != 'binary':
+        raise ValueError('Only the binary APNS protocol is supported by the'
+                         ' asyncio engine')
+    return AsyncAPNSService(
+        sandbox=sandbox,
+        app=app,
+        certfile=config.get(section, 'cert_file_pem'),
+        batch_size=config.getint(section, 'batch_size', fallback=BATCH_SIZE),
+        feedback_interval=config.getfloat(section, 'feedback_interval',
+                                          fallback=FEEDBACK_INTERVAL),
+        **apns_addresses(config, section),
+        **queue_limits(config, section),
+        **retry_limits(config, section),
+        **lane_options(config, section),
+        **rate_limits(config, section))
+
+
+def setup_gcm(config, section, app=None, session=None):
+    return AsyncGCMService(
+        config.get(section, 'api_key'),
+        app=app,
+        session=session,
+        url=config.get(section, 'url', fallback=GCM_URL),
+        coalesce_linger=config.getfloat(section, 'coalesce_linger',
+                                        fallback=COALESCE_LINGER),
+        min_workers=config.getint(section, 'min_workers',
+                                  fallback=MIN_WORKERS),
+        max_workers=config.getint(section, 'max_workers',
+                                  fallback=MAX_WORKERS),
+        canonical_id_map_size=config.getint(section, 'canonical_id_map_size',
+                                            fallback=0),
+        **queue_limits(config, section),
+        **retry_limits(config, section),
+        **lane_options(config, section),
+        **rate_limits(config, section))
+
+
+def setup_service(config, section, app, kind, gcm_session=None):
+    if kind == 'gcm':
+        return setup_gcm(config, section, app, gcm_session)
+    return setup_apns(config, section, kind == 'apns_sandbox', app)
+
+
+def setup(config, reload_config=None):
+    """
+    Sets up the asyncio push services and returns the ASGI application.
+    The services are started once the ASGI server runs the lifespan
+    startup. ``reload_config`` returns the config to update the services
+    to on SIGHUP.
+    """
+    gcm_session = shared_session(config.getint(
+        'server', 'gcm_pool_size', fallback=SHARED_POOL_SIZE))
+    registry = ServiceRegistry(
+        functools.partial(setup_service, gcm_session=gcm_session))
+    registry.update(config)
+    journal = None
+    journal_dir = config.get('server', 'journal_dir', fallback=None)
+    if journal_dir:
+        journal = AsyncNotificationJournal(
+            journal_dir,
+            sync_interval=config.getfloat('server', 'journal_sync_interval',
+                                          fallback=SYNC_INTERVAL))
+    dead_letter = None
+    dead_letter_file = config.get('server', 'dead_letter_file', fallback=None)
+    if dead_letter_file:
+        dead_letter = DeadLetterLog(dead_letter_file)
+    feedback_log = None
+    feedback_log_dir = config.get('server', 'feedback_log_dir', fallback=None)
+    if feedback_log_dir:
+        feedback_log = FeedbackLog(feedback_log_dir)
+    return AsyncAPIServer(
+        max_content_length=config.getint('server', 'max_request_size',
+                                         fallback=None),
+        stop_timeout=config.getfloat('server', 'drain_timeout',
+                                     fallback=10.0),
+        registry=registry,
+        reload_config=reload_config,
+        journal=journal,
+        dead_letter=dead_letter,
+        suppression=setup_suppression(config, AsyncSuppressionIndex),
+        feedback_log=feedback_log)
@@ -0,0 +1,527 @@
+import configparser
+import json
+import logging
+import os
+from datetime import datetime
+from queue import Empty
+
+from .. import metrics
+from ..serialization import content_types, json_loads
+from ..services.base import PRIORITIES, BaseNotification
+from ..services.base.service import service_name
+from ..services.base.feedback import CANONICAL_ID, INVALID_TOKEN
+from ..services.base.retry import MAX_ATTEMPTS
+from .registry import SERVICE_KINDS, ServiceRegistry, service_kind
+from .suppression import SUPPRESSION_TTL, SuppressionIndex
+
+
+logger = logging.getLogger(__name__)
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+# Maximum size of a single line in a streamed (NDJSON) push request.
+MAX_LINE_LENGTH = 64 * 1024
+# Maximum number of rejected lines of a streamed push request reported
+# individually; all of them are counted.
+MAX_REJECTED = 100
+# Seconds between collecting feedback from the services.
+FEEDBACK_COLLECT_INTERVAL = 5
+# Default, and maximum, number of entries per page of exported feedback.
+EXPORT_LIMIT = 1000
+MAX_EXPORT_LIMIT = 10000
+# Content types accepted by /api/push/, fastest first.
+ACCEPT_POST = ', '.join(content_types() + [NDJSON_CONTENT_TYPE])
+# Errors raised for notifications that are invalid, or for an unknown
+# app or service.
+INVALID_NOTIFICATION_ERRORS = (ValueError, KeyError, TypeError,
+                               AssertionError)
+# Units the rates of the services are limited in.
+RATE_UNITS = ('request', 'recipient')
+
+
+class ServiceOverloaded(Exception):
+
+    def __init__(self, retry_after):
+        super(ServiceOverloaded, self).__init__('Service overloaded')
+        self.retry_after = retry_after
+
+
+class BaseAPIServer(object):
+    """
+    Routing of notifications to services, independent of the web
+    framework and concurrency model (gevent or asyncio) used. The
+    services are either given as a ``registry``, or as the ``apns``,
+    ``apns_sandbox`` and ``gcm`` services of the default app.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.registry = kwargs.pop('registry', None)
+        if self.registry is None:
+            self.registry = ServiceRegistry()
+            for kind in SERVICE_KINDS:
+                self.registry.add(None, kind, kwargs.pop(kind))
+        self.journal = kwargs.pop('journal', None)
+        self.dead_letter = kwargs.pop('dead_letter', None)
+        self.suppression = kwargs.pop('suppression', None)
+        self.feedback_log = kwargs.pop('feedback_log', None)
+        self._feedback = []
+        for service in self.registry.services():
+            self._register_service(service)
+
+    def _register_service(self, service):
+        if self.journal is not None:
+            service.on_sent = self.acknowledge
+        service.on_failed = self.notification_failed
+        backlog = service.backlog
+        metrics.QUEUE_DEPTH.set_function(
+            lambda b=backlog: b.count, service.name)
+        metrics.QUEUE_BYTES.set_function(
+            lambda b=backlog: b.bytes, service.name)
+        metrics.RETRIES_PENDING.set_function(
+            lambda s=service: len(s.retry), service.name)
+        for priority in PRIORITIES:
+            metrics.LANE_DEPTH.set_function(
+                lambda l=service.lanes, p=priority: l.depth(p),
+                service.name, priority)
+        for unit in RATE_UNITS:
+            metrics.RATE_LIMIT.set_function(
+                lambda r=service.rate_limiter, u=unit: r.allowed_rate(u),
+                service.name, unit)
+
+    def _unregister_service(self, service):
+        for metric in (metrics.QUEUE_DEPTH, metrics.QUEUE_BYTES,
+                       metrics.RETRIES_PENDING):
+            metric.remove(service.name)
+        for priority in PRIORITIES:
+            metrics.LANE_DEPTH.remove(service.name, priority)
+        for unit in RATE_UNITS:
+            metrics.RATE_LIMIT.remove(service.name, unit)
+
+    def update_services(self, config):
+        """
+        Adds, replaces and removes services to match the [apns*] and
+        [gcm*] sections of the config. Returns the services added, which
+        the caller starts, and removed, which the caller stops once the
+        notifications they still have queued are sent.
+        """
+        added, removed = self.registry.update(config)
+        for service in removed:
+            # Its feedback would otherwise be lost
+            self._feedback.extend(self._handle_feedback(service))
+            self._unregister_service(service)
+        for service in added:
+            self._register_service(service)
+        return added, removed
+
+    def acknowledge(self, notification):
+        for offset in notification.journal_offsets:
+            self.journal.ack(offset)
+
+    def notification_failed(self, notification, reason):
+        logger.warning("Dropping %s notification: %s" % (
+            notification.service_type, reason))
+        if self.dead_letter is not None:
+            self.dead_letter.put(notification, reason)
+        # Do not replay it on the next start either
+        if self.journal is not None:
+            self.acknowledge(notification)
+
+    def replay_journal(self):
+        """
+        Queues all journalled notifications that were not handed over to
+        the push services before the previous shutdown.
+        """
+        count = 0
+        for offset, data in self.journal.replay():
+            try:
+                notification = BaseNotification.deserialize(data)
+            except INVALID_NOTIFICATION_ERRORS as e:
+                logger.error("Skipping journalled notification: %s" % e)
+                self.journal.ack(offset)
+                continue
+            notification.journal_offsets = (offset,)
+            self.queue_notification(notification)
+            count += 1
+        logger.info("Replayed %d journalled notifications" % count)
+
+    def collect_feedback(self):
+        feedback = []
+        for service in self.registry.services():
+            feedback.extend(self._handle_feedback(service))
+        return feedback
+
+    def buffer_feedback(self):
+        """
+        Moves the feedback of the services to a buffer, until it is
+        drained. Called periodically, along with syncing the suppression
+        index, so that invalid tokens are suppressed without waiting for
+        the feedback to be fetched.
+        """
+        if self.feedback_log is not None:
+            self.feedback_log.append(self.collect_feedback())
+        else:
+            self._feedback.extend(self.collect_feedback())
+
+    def drain_feedback(self):
+        """
+        Returns, and forgets, the buffered feedback. Not used when the
+        feedback is retained in a log, which is only read through
+        ``export_feedback`` and ``ack_feedback``.
+        """
+        feedback = self._feedback + self.collect_feedback()
+        self._feedback = []
+        return feedback
+
+    def export_feedback(self, args):
+        """
+        Returns a page of the retained feedback as lines of JSON, for the
+        query arguments ``cursor``, ``limit``, ``type``, ``app``,
+        ``sandbox``, ``since`` and ``until`` (ISO 8601). Each entry
+        includes its ``cursor``; the last line holds the ``next_cursor``
+        to continue from and whether there is ``more``. Raises ValueError
+        for invalid arguments.
+        """
+        cursor = args.get('cursor')
+        if cursor is not None:
+            cursor = int(cursor)
+        limit = min(int(args.get('limit', EXPORT_LIMIT)), MAX_EXPORT_LIMIT)
+        if limit < 1:
+            raise ValueError('Invalid limit')
+        entries, cursor, more = self.feedback_log.read(
+            cursor, limit, feedback_filter(args))
+        lines = [json.dumps(entry) + '\n' for entry in entries]
+        lines.append(json.dumps(dict(next_cursor=cursor, more=more)) + '\n')
+        return lines
+
+    def ack_feedback(self, data):
+        """
+        Acknowledges the exported feedback up to ``data['cursor']``, and
+        returns the cursor up to which feedback is acknowledged. Raises
+        ValueError, KeyError or TypeError for an invalid ``data``.
+        """
+        return self.feedback_log.ack(int(data['cursor']))
+
+    def _handle_feedback(self, service):
+        type = service.service_type
+        sandbox = service.sandbox
+        feedback = []
+        try:
+            while True:
+                entry = service.get_feedback(block=False)
+                if (entry.event == INVALID_TOKEN and
+                        self.suppression is not None):
+                    self.suppression.add(service.name, entry.token,
+                                         entry.timestamp)
+                dt = datetime.utcfromtimestamp(entry.timestamp)
+                if entry.event == CANONICAL_ID:
+                    feedback.append(dict(type=type,
+                                         sandbox=sandbox,
+                                         app=service.app,
+                                         event=entry.event,
+                                         replaced_at=dt.isoformat(),
+                                         token=entry.token,
+                                         canonical_token=(
+                                             entry.canonical_token)))
+                else:
+                    feedback.append(dict(type=type,
+                                         sandbox=sandbox,
+                                         app=service.app,
+                                         event=entry.event,
+                                         marked_inactive_at=dt.isoformat(),
+                                         token=entry.token))
+        except Empty:
+            pass
+        return feedback
+
+    def get_rate_limits(self):
+        """
+        Returns the rate limits, the rates currently allowed and measured,
+        and the number of times it was throttled, of each service.
+        """
+        return [dict(app=app, kind=kind, **service.rate_limiter.state())
+                for app, kind, service in sorted(
+                    self.registry.items(),
+                    key=lambda item: (item[0] or '', item[1]))]
+
+    def set_rate_limit(self, data):
+        """
+        Sets the ``max_request_rate`` and ``max_recipient_rate`` (missing
+        or None for unlimited) of the service of ``data['kind']`` for
+        ``data['app']``, and returns its state. Raises ValueError for an
+        unknown service or invalid limits.
+        """
+        app, kind = data.get('app'), data.get('kind')
+        service = self.registry.get(app, kind)
+        if service is None:
+            raise ValueError('Unknown service: %s' % service_name(kind, app))
+        limits = []
+        for option in ('max_request_rate', 'max_recipient_rate'):
+            limit = data.get(option)
+            if limit is not None and (
+                    isinstance(limit, bool) or
+                    not isinstance(limit, (int, float)) or limit <= 0):
+                raise ValueError('Invalid %s: %r' % (option, limit))
+            limits.append(limit)
+        service.rate_limiter.configure(*limits)
+        logger.info("Rate limits of %s set to %s requests/s, %s"
+                    " recipients/s" % (service.name, limits[0], limits[1]))
+        return dict(app=app, kind=kind, **service.rate_limiter.state())
+
+    def push_notifications(self, notifications):
+        """
+        Queues the notifications. Raises ServiceOverloaded, without
+        queueing any of them, if they would take one of the services
+        involved over its capacity, and one of the
+        INVALID_NOTIFICATION_ERRORS for an invalid notification. Returns
+        the number of device tokens that were dropped because they are
+        known to be invalid (hits), and not (misses).
+        """
+        suppression = dict(hits=0, misses=0)
+        pending = [self._prepare_notification(data, suppression)
+                   for data in notifications]
+        pending = [p for p in pending if p is not None]
+        totals = {}
+        for service, notification, data in pending:
+            count, size = totals.get(service, (0, 0))
+            totals[service] = (count + notification.queued_count,
+                               size + queued_size(notification))
+        for service, (count, size) in totals.items():
+            if not service.backlog.fits(count, size):
+                raise ServiceOverloaded(
+                    service.backlog.retry_after(count, size))
+        for service, notification, data in pending:
+            self._queue_notification(service, notification, data)
+        return suppression
+
+    def push_line(self, summary, lineno, line):
+        """
+        Queues the notification on a single line of a streamed push
+        request, and records the outcome in the summary (see
+        ``stream_summary()``). A line of None indicates the line was too
+        long.
+        """
+        if line is None:
+            reject_line(summary, lineno, 'Line too long')
+            return
+        if not line.strip():
+            return
+        try:
+            self.push_notification(json_loads(line),
+                                   summary['suppression'])
+        except ServiceOverloaded as e:
+            reject_line(summary, lineno, str(e))
+            summary['retry_after'] = max(summary.get('retry_after', 0),
+                                         e.retry_after)
+        except INVALID_NOTIFICATION_ERRORS as e:
+            reject_line(summary, lineno, str(e))
+        else:
+            summary['accepted'] += 1
+
+    def push_notification(self, data, suppression=None):
+        prepared = self._prepare_notification(data, suppression)
+        if prepared is None:
+            return
+        service, notification, data = prepared
+        count, size = notification.queued_count, queued_size(notification)
+        if not service.backlog.fits(count, size):
+            raise ServiceOverloaded(service.backlog.retry_after(count, size))
+        self._queue_notification(service, notification, data)
+
+    def _prepare_notification(self, data, suppression=None):
+        """
+        Returns the service, notification and data to journal, or None if
+        all of the notification's tokens are suppressed. The number of
+        suppressed (hits) and other (misses) tokens is added to the
+        ``suppression`` counts.
+        """
+        notification = BaseNotification.deserialize(data)
+        service = self.get_service(notification)
+        if service is None:
+            raise ValueError('Unknown app: %s' % notification.app)
+        if self.suppression is not None:
+            hits, misses = self.suppression.filter(notification,
+                                                   service.name)
+            if suppression is not None:
+                suppression['hits'] += hits
+                suppression['misses'] += misses
+            metrics.TOKENS_SUPPRESSED.inc(service.name, amount=hits)
+            if not misses:
+                return None
+            if hits:
+                data = notification.serialize()
+        return service, notification, data
+
+    def _queue_notification(self, service, notification, data):
+        if self.journal is not None:
+            notification.journal_offsets = (self.journal.append(data),)
+        logger.debug("Sending %s notification" % notification.service_type)
+        metrics.NOTIFICATIONS_QUEUED.inc(service.name)
+        service.queue_notification(notification)
+
+    def get_service(self, notification):
+        return self.registry.get(notification.app,
+                                 service_kind(notification))
+
+    def queue_notification(self, notification):
+        service = self.get_service(notification)
+        if service is None:
+            logger.error("No %s service for app %s" % (
+                service_kind(notification), notification.app))
+            return
+        logger.debug("Sending %s notification" % notification.service_type)
+        metrics.NOTIFICATIONS_QUEUED.inc(service.name)
+        service.queue_notification(notification)
+
+
+def stream_summary():
+    """
+    Returns the summary of a streamed push request: the number of
+    accepted notifications, the line numbers and reasons of the first
+    MAX_REJECTED rejected ones, and the number of rejected ones.
+    """
+    return dict(accepted=0, rejected=[], rejected_count=0,
+                suppression=dict(hits=0, misses=0))
+
+
+def reject_line(summary, lineno, error):
+    summary['rejected_count'] += 1
+    if len(summary['rejected']) < MAX_REJECTED:
+        summary['rejected'].append(dict(line=lineno, error=error))
+
+
+def queued_size(notification):
+    """
+    Returns the size the notification is accounted for in the backlog,
+    computing it once.
+    """
+    if not notification.queued_size:
+        notification.queued_size = notification.size()
+    return notification.queued_size
+
+
+def feedback_filter(args):
+    """
+    Returns a function matching the feedback entries selected by the
+    query arguments, or None if all are.
+    """
+    type = args.get('type')
+    app = args.get('app')
+    sandbox = args.get('sandbox')
+    if sandbox is not None:
+        sandbox = sandbox.lower() in ('1', 'true', 'yes')
+    since = args.get('since')
+    until = args.get('until')
+    if (type is None and app is None and sandbox is None and
+            since is None and until is None):
+        return None
+
+    def match(entry):
+        if type is not None and entry['type'] != type:
+            return False
+        if app is not None and entry.get('app') != app:
+            return False
+        if sandbox is not None and entry['sandbox'] != sandbox:
+            return False
+        # ISO 8601 timestamps sort chronologically
+        at = (entry.get('marked_inactive_at') or
+              entry.get('replaced_at') or '')
+        if since is not None and at < since:
+            return False
+        if until is not None and at >= until:
+            return False
+        return True
+    return match
+
+
+def read_config(config_dir):
+    config = configparser.ConfigParser()
+    config.read([os.path.join(config_dir, 'pulsus.conf')])
+    return config
+
+
+def queue_limits(config, section):
+    return dict(
+        max_queue_count=config.getint(section, 'max_queue_count',
+                                      fallback=None),
+        max_queue_bytes=config.getint(section, 'max_queue_bytes',
+                                      fallback=None))
+
+
+def parse_address(address):
+    """
+    Returns the (host, port) of a ``host:port`` string.
+    """
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('Invalid address: %s' % address)
+    return host, int(port)
+
+
+def apns_addresses(config, section):
+    """
+    Returns the gateway and feedback addresses an APNS section overrides,
+    for instance to send to a stand-in server. With the HTTP/2 protocol,
+    the gateway is the host of the provider API, and the certificates
+    trusted to verify it can be given as ``ca_file``.
+    """
+    addresses = {}
+    options = ('gateway', 'feedback')
+    if config.get(section, 'protocol', fallback='binary') == 'http2':
+        # Invalid tokens are reported in the responses instead
+        options = ('gateway',)
+        cafile = config.get(section, 'ca_file', fallback=None)
+        if cafile:
+            addresses['cafile'] = cafile
+    for option in options:
+        address = config.get(section, option, fallback=None)
+        if address:
+            addresses[option] = parse_address(address)
+    return addresses
+
+
+def setup_suppression(config, index_class=SuppressionIndex):
+    """
+    Returns the suppression index of invalid tokens, if enabled. Its file
+    is shared by the worker processes.
+    """
+    if not config.getboolean('server', 'suppress_invalid_tokens',
+                             fallback=False):
+        return None
+    ttl = config.getint('server', 'suppression_ttl', fallback=SUPPRESSION_TTL)
+    path = config.get('server', 'suppression_file', fallback=None)
+    return index_class(ttl=ttl or None, path=path)
+
+
+def retry_limits(config, section):
+    return dict(
+        max_attempts=config.getint(section, 'max_attempts',
+                                   fallback=MAX_ATTEMPTS))
+
+
+def rate_limits(config, section):
+    return dict(
+        max_request_rate=config.getfloat(section, 'max_request_rate',
+                                         fallback=None),
+        max_recipient_rate=config.getfloat(section, 'max_recipient_rate',
+                                           fallback=None))
+
+
+def lane_options(config, section):
+    """
+    Returns the options of the send queue of a service: whether to
+    collapse notifications, and the weights of the priority lanes, given
+    as ``high:16, normal:4, low:1`` (any of them, the others keeping
+    their default).
+    """
+    weights = {}
+    for item in config.get(section, 'priority_weights',
+                           fallback='').split(','):
+        if not item.strip():
+            continue
+        priority, _, weight = item.partition(':')
+        priority = priority.strip()
+        if priority not in PRIORITIES or not weight.strip().isdigit():
+            raise ValueError('Invalid priority weight: %s' % item.strip())
+        weights[priority] = max(1, int(weight))
+    return dict(
+        priority_weights=weights or None,
+        collapse=config.getboolean(section, 'collapse', fallback=False))
@@ -0,0 +1,5 @@
+from . import aio
+from .api import read_config
+
+config = read_config('.')
+application = aio.setup(config, lambda: read_config('.'))
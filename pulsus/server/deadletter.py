@@ -0,0 +1,28 @@
+import fcntl
+import json
+from datetime import datetime
+
+
+class DeadLetterLog(object):
+    """
+    File collecting the notifications the services gave up on, as
+    newline delimited JSON, for inspection or manual resending. The file
+    is locked while being appended to, so it can be shared by the worker
+    processes of a multi-process server.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, notification, reason):
+        entry = dict(notification=notification.serialize(),
+                     reason=reason,
+                     attempts=notification.attempts,
+                     failed_at=datetime.utcnow().isoformat())
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
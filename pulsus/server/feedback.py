@@ -0,0 +1,184 @@
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+
+# Size at which the feedback log starts a new segment file.
+LOG_SEGMENT_SIZE = 16 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class FeedbackSpool(object):
+    """
+    Directory of feedback files shared by the worker processes of a
+    multi-process server. Each worker appends the feedback collected by
+    its own services to a file of its own, while any worker can drain
+    the feedback of all of them. Files are locked while being appended
+    to or drained, so no entry is lost or handed out twice.
+    """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, '%s.ndjson' % name)
+
+    def put(self, entries):
+        if not entries:
+            return
+        data = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(data)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def drain(self):
+        entries = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.ndjson'):
+                continue
+            with open(os.path.join(self.directory, name), 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    for line in f:
+                        if line.strip():
+                            entries.append(json.loads(line))
+                    f.truncate(0)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return entries
+
+
+class FeedbackLog(object):
+    """
+    Retained log of feedback, exported in pages and only removed once
+    acknowledged, so that no entry is lost if a client fails half way.
+    Entries are addressed by a cursor: the position, in bytes across
+    all segment files, of the entry following it. Acknowledging a
+    cursor acknowledges every entry before it. Like ``FeedbackSpool``,
+    the log can be shared by the worker processes of a multi-process
+    server.
+    """
+
+    def __init__(self, directory, segment_size=LOG_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock_path = os.path.join(directory, 'lock')
+        self._ack_path = os.path.join(directory, 'acked')
+
+    @contextmanager
+    def _locked(self, operation=fcntl.LOCK_EX):
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _path(self, base):
+        return os.path.join(self.directory, '%020d.ndjson' % base)
+
+    def _segments(self):
+        """
+        Returns (base, size) of each segment file, in order.
+        """
+        segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.ndjson'):
+                base = int(name[:-len('.ndjson')])
+                segments.append((base, os.path.getsize(self._path(base))))
+        return segments
+
+    def _acked(self):
+        try:
+            with open(self._ack_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def append(self, entries):
+        if not entries:
+            return
+        data = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        with self._locked():
+            segments = self._segments()
+            if not segments:
+                base = self._acked()
+            else:
+                base, size = segments[-1]
+                if size >= self.segment_size:
+                    base += size
+            with open(self._path(base), 'ab') as f:
+                f.write(data.encode('utf8'))
+
+    def read(self, cursor=None, limit=None, match=None):
+        """
+        Reads up to ``limit`` entries, for which ``match(entry)`` is true,
+        starting at ``cursor`` (or the first unacknowledged entry). Each
+        entry is returned with its ``cursor``. Returns the entries, the
+        cursor to continue from, and whether there are more entries.
+        Raises ValueError if the cursor is not at the start of an entry.
+        """
+        entries = []
+        with self._locked(fcntl.LOCK_SH):
+            acked = self._acked()
+            if cursor is None or cursor < acked:
+                cursor = acked
+            segments = self._segments()
+            end = segments[-1][0] + segments[-1][1] if segments else acked
+            if cursor > end:
+                raise ValueError('Invalid cursor')
+            for base, size in segments:
+                if base + size <= cursor:
+                    continue
+                with open(self._path(base), 'rb') as f:
+                    if cursor > base:
+                        f.seek(cursor - base - 1)
+                        if f.read(1) != b'\n':
+                            raise ValueError('Invalid cursor')
+                    cursor = max(cursor, base)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        cursor += len(line)
+                        try:
+                            entry = json.loads(line.decode('utf8'))
+                        except ValueError:
+                            # Left behind by a crash while appending
+                            logger.warning('Skipping corrupt feedback entry')
+                            continue
+                        if match is not None and not match(entry):
+                            continue
+                        entry['cursor'] = cursor
+                        entries.append(entry)
+                        if limit is not None and len(entries) >= limit:
+                            return entries, cursor, cursor < end
+        return entries, cursor, False
+
+    def ack(self, cursor):
+        """
+        Acknowledges all entries before ``cursor``, removing segment files
+        that only hold acknowledged entries. Returns the cursor up to
+        which entries are acknowledged.
+        """
+        with self._locked():
+            segments = self._segments()
+            end = segments[-1][0] + segments[-1][1] if segments else 0
+            cursor = max(self._acked(), min(cursor, end))
+            tmp_path = self._ack_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(str(cursor))
+            os.replace(tmp_path, self._ack_path)
+            # Keep the last segment, it is still being appended to
+            for (base, size), (next_base, _) in zip(segments, segments[1:]):
+                if next_base <= cursor:
+                    os.remove(self._path(base))
+        return cursor
@@ -0,0 +1,208 @@
+import logging
+import mmap
+import os
+
+import gevent
+
+from ..serialization import json_dumps, json_loads
+
+
+# Number of records per segment file.
+SEGMENT_ENTRIES = 65536
+# Seconds between group commits (flush + fsync).
+SYNC_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class Segment(object):
+    """
+    A segment consists of an append-only log file holding one JSON record
+    per line, and a memory-mapped bitmap of acknowledged records.
+    """
+
+    def __init__(self, directory, base, entries):
+        self.base = base
+        self.entries = entries
+        path = os.path.join(directory, '%020d' % base)
+        self.log_path = path + '.log'
+        self.ack_path = path + '.ack'
+        self.count = self._recover()
+        self._log = open(self.log_path, 'ab')
+        ack_size = (entries + 7) // 8
+        with open(self.ack_path, 'ab') as f:
+            if f.tell() < ack_size:
+                f.truncate(ack_size)
+        self._ack_file = open(self.ack_path, 'r+b')
+        self._acks = mmap.mmap(self._ack_file.fileno(), ack_size)
+        self.acked = sum(bin(b).count('1') for b in self._acks[:])
+
+    def _recover(self):
+        """
+        Counts the complete records in the log, discarding a trailing
+        partial record left behind by a crash.
+        """
+        if not os.path.exists(self.log_path):
+            return 0
+        with open(self.log_path, 'r+b') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                logger.warning('Truncating partial record in %s' % (
+                    self.log_path))
+                f.truncate(end)
+        return data.count(b'\n', 0, end)
+
+    @property
+    def full(self):
+        return self.count >= self.entries
+
+    @property
+    def done(self):
+        return self.full and self.acked >= self.count
+
+    def append(self, line):
+        self._log.write(line)
+        self.count += 1
+        return self.base + self.count - 1
+
+    def ack(self, offset):
+        i = offset - self.base
+        mask = 1 << (i & 7)
+        if not self._acks[i >> 3] & mask:
+            self._acks[i >> 3] |= mask
+            self.acked += 1
+
+    def is_acked(self, offset):
+        i = offset - self.base
+        return bool(self._acks[i >> 3] & (1 << (i & 7)))
+
+    def records(self):
+        with open(self.log_path, 'rb') as f:
+            for i, line in enumerate(f):
+                if i >= self.count:
+                    break
+                yield self.base + i, line
+
+    def flush(self):
+        self._log.flush()
+        self._acks.flush()
+
+    def sync(self):
+        os.fsync(self._log.fileno())
+
+    def close(self):
+        self.flush()
+        self._log.close()
+        self._acks.close()
+        self._ack_file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.ack_path)
+
+
+class NotificationJournal(object):
+    """
+    Durable, append-only log of serialized notifications. Records are
+    appended to a page cache backed file, and flushed and fsynced in
+    groups every ``sync_interval`` seconds, so that appending does not
+    block on the disk. Records that have not been acknowledged are
+    replayed on startup.
+    """
+
+    def __init__(self, directory, segment_entries=SEGMENT_ENTRIES,
+                 sync_interval=SYNC_INTERVAL):
+        self.directory = directory
+        self.segment_entries = segment_entries
+        self.sync_interval = sync_interval
+        self._segments = {}
+        self._dirty = False
+        self._sync_greenlet = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                base = int(name[:-4])
+                self._segments[base] = Segment(
+                    directory, base, segment_entries)
+        if self._segments:
+            self._current = self._segments[max(self._segments)]
+        else:
+            self._current = self._new_segment(0)
+        for base, segment in list(self._segments.items()):
+            if segment.done and segment is not self._current:
+                del self._segments[base]
+                segment.remove()
+
+    def _new_segment(self, base):
+        segment = Segment(self.directory, base, self.segment_entries)
+        self._segments[base] = segment
+        return segment
+
+    def start(self):
+        if self._sync_greenlet is None:
+            self._sync_greenlet = gevent.spawn(self._sync_loop)
+
+    def stop(self):
+        if self._sync_greenlet is not None:
+            gevent.kill(self._sync_greenlet)
+            self._sync_greenlet = None
+        self.sync()
+
+    def _sync_loop(self):
+        try:
+            while True:
+                gevent.sleep(self.sync_interval)
+                if self._dirty:
+                    self.sync()
+        except gevent.GreenletExit:
+            pass
+
+    def sync(self):
+        self._dirty = False
+        segment = self._current
+        segment.flush()
+        self._sync_segment(segment)
+
+    def _sync_segment(self, segment):
+        # fsync() blocks, keep the hub running meanwhile
+        gevent.get_hub().threadpool.apply(segment.sync)
+
+    def append(self, record):
+        """
+        Appends the record and returns its offset.
+        """
+        if self._current.full:
+            self.sync()
+            self._current = self._new_segment(
+                self._current.base + self.segment_entries)
+        line = json_dumps(record)
+        self._dirty = True
+        return self._current.append(line + b'\n')
+
+    def ack(self, offset):
+        base = offset - offset % self.segment_entries
+        segment = self._segments.get(base)
+        if segment is None:
+            return
+        segment.ack(offset)
+        if segment.done and segment is not self._current:
+            del self._segments[base]
+            segment.remove()
+
+    def replay(self):
+        """
+        Yields (offset, record) for all records not acknowledged yet.
+        """
+        for base in sorted(self._segments):
+            segment = self._segments[base]
+            for offset, line in segment.records():
+                if not segment.is_acked(offset):
+                    yield offset, json_loads(line)
+
+    def close(self):
+        self.stop()
+        for segment in self._segments.values():
+            segment.close()
@@ -0,0 +1,137 @@
+import logging
+import os
+import signal
+import time
+
+from .wsgiserver import BACKLOG, DRAIN_TIMEOUT, listen, serve
+
+
+# Worker exits tolerated within ``CRASH_WINDOW`` seconds, after which the
+# master gives up.
+MAX_CRASHES = 10
+CRASH_WINDOW = 60
+# Seconds to wait before restarting a worker, doubled for every other
+# exit within the window.
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+
+class PreforkServer(object):
+    """
+    Pre-forking master process. The master binds the listen socket and
+    forks ``worker_count`` workers, which all accept connections on that
+    socket. Each worker creates its own application (and with it, its
+    own push services) by calling ``make_app(worker_id)``. Workers that
+    exit are replaced by a new worker with the same id, after a delay
+    growing with the number of recent exits; once more than
+    ``max_crashes`` exit within ``crash_window`` seconds, the master
+    stops all workers instead. SIGHUP is passed on to the workers, which
+    reload their app with the config returned by ``reload_config``.
+    """
+
+    def __init__(self, address, port, worker_count, make_app,
+                 backlog=BACKLOG, drain_timeout=DRAIN_TIMEOUT,
+                 max_connections=None, reload_config=None,
+                 max_crashes=MAX_CRASHES, crash_window=CRASH_WINDOW):
+        self.address = address
+        self.port = port
+        self.worker_count = worker_count
+        self.make_app = make_app
+        self.backlog = backlog
+        self.drain_timeout = drain_timeout
+        self.max_connections = max_connections
+        self.reload_config = reload_config
+        self.max_crashes = max_crashes
+        self.crash_window = crash_window
+        self.workers = {}
+        self.crashes = []
+        self.stopping = False
+        self.failed = False
+        self.listener = None
+
+    def serve_forever(self):
+        """
+        Runs the workers until stopped. Returns False if the master gave
+        up restarting crashing workers.
+        """
+        self.listener = listen(self.address, self.port, self.backlog)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        for worker_id in range(self.worker_count):
+            self.spawn_worker(worker_id)
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None:
+                continue
+            if not self.stopping:
+                self.handle_crash(worker_id, pid,
+                                  os.waitstatus_to_exitcode(status))
+        logger.info("All workers stopped")
+        return not self.failed
+
+    def handle_crash(self, worker_id, pid, code):
+        now = time.monotonic()
+        self.crashes = [t for t in self.crashes
+                        if t > now - self.crash_window]
+        self.crashes.append(now)
+        if len(self.crashes) > self.max_crashes:
+            logger.error("Worker %d (pid %d) exited with code %d, %d exits"
+                         " within %ds, stopping" % (
+                             worker_id, pid, code, len(self.crashes),
+                             self.crash_window))
+            self.failed = True
+            self.handle_stop(None, None)
+            return
+        delay = min(RESTART_DELAY * 2 ** (len(self.crashes) - 1),
+                    MAX_RESTART_DELAY)
+        logger.error("Worker %d (pid %d) exited with code %d, restarting"
+                     " in %.1fs" % (worker_id, pid, code, delay))
+        time.sleep(delay)
+        if not self.stopping:
+            self.spawn_worker(worker_id)
+
+    def spawn_worker(self, worker_id):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = worker_id
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        status = 1
+        try:
+            self.run_worker(worker_id)
+            status = 0
+        except Exception:
+            logger.exception("Worker %d crashed" % worker_id)
+        finally:
+            os._exit(status)
+
+    def run_worker(self, worker_id):
+        logger.info("Worker %d started (pid %d)" % (worker_id, os.getpid()))
+        app = self.make_app(worker_id)
+        serve(self.listener, app, drain_timeout=self.drain_timeout,
+              max_connections=self.max_connections,
+              reload_config=self.reload_config)
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def handle_reload(self, signum, frame):
+        logger.info("Reloading workers")
+        self.signal_workers(signal.SIGHUP)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
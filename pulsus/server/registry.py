@@ -0,0 +1,105 @@
+import logging
+
+
+# Kinds of service each app can have.
+SERVICE_KINDS = ('apns', 'apns_sandbox', 'gcm')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_section(section):
+    """
+    Returns the app (None for the default app) and kind of service a
+    config section configures, or None if it configures no service.
+    """
+    service_type, _, app = section.partition(':')
+    if service_type not in ('apns', 'gcm'):
+        return None
+    kind = service_type
+    if service_type == 'apns':
+        if app == 'sandbox':
+            app, kind = '', 'apns_sandbox'
+        elif app.endswith(':sandbox'):
+            app, kind = app[:-len(':sandbox')], 'apns_sandbox'
+    if ':' in app:
+        return None
+    return app or None, kind
+
+
+def service_kind(notification):
+    if notification.service_type == 'apns' and notification.sandbox:
+        return 'apns_sandbox'
+    return notification.service_type
+
+
+class ServiceRegistry(object):
+    """
+    The push services of each app, keyed by app id and kind of service
+    (apns, apns_sandbox or gcm). The services of the default app, which
+    sends the notifications without an app id, are configured by the
+    [apns], [apns:sandbox] and [gcm] sections, those of other apps by
+    [apns:<app>], [apns:<app>:sandbox] and [gcm:<app>] sections.
+    ``factory(config, section, app, kind)`` creates the service for a
+    section.
+    """
+
+    def __init__(self, factory=None):
+        self.factory = factory
+        # (app, kind) -> service
+        self._services = {}
+        # (app, kind) -> options of the section a service was created from
+        self._options = {}
+
+    def __len__(self):
+        return len(self._services)
+
+    def get(self, app, kind):
+        return self._services.get((app, kind))
+
+    def items(self):
+        """
+        Returns (app, kind, service) for each service.
+        """
+        return [(app, kind, service)
+                for (app, kind), service in self._services.items()]
+
+    def services(self):
+        return list(self._services.values())
+
+    def add(self, app, kind, service):
+        self._services[(app, kind)] = service
+
+    def remove(self, app, kind):
+        self._options.pop((app, kind), None)
+        return self._services.pop((app, kind))
+
+    def update(self, config):
+        """
+        Creates the services of sections that were added or changed, and
+        removes those of sections that were changed or removed. Returns
+        the services added and removed; starting and stopping them is up
+        to the caller. Nothing is changed if a service cannot be created.
+        """
+        sections = {}
+        for section in config.sections():
+            key = parse_section(section)
+            if key is not None:
+                sections[key] = (section, dict(config.items(section)))
+        created = {}
+        for key, (section, options) in sections.items():
+            if (key not in self._services or
+                    (key in self._options and
+                     self._options[key] != options)):
+                created[key] = self.factory(config, section, *key)
+        removed = []
+        for key in list(self._options):
+            if key not in sections or key in created:
+                del self._options[key]
+                removed.append(self._services.pop(key))
+        for key, service in created.items():
+            self._services[key] = service
+            self._options[key] = sections[key][1]
+        if created or removed:
+            logger.info("Services updated: %d added, %d removed" % (
+                len(created), len(removed)))
+        return list(created.values()), removed
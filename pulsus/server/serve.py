@@ -4,8 +4,7 @@ monkey.patch_all()
 import os
 import logging.config
 import sys
-
-from werkzeug.serving import run_simple
+import tempfile
 
 
 if __name__ == "__main__":
@@ -17,10 +16,38 @@ if __name__ == "__main__":
     logger = logging.getLogger(__name__)
 
     from . import server
+    from .wsgiserver import BACKLOG, DRAIN_TIMEOUT, listen, serve
     config = server.read_config(config_dir)
 
-    server = server.setup(config)
     server_address = config.get('server', 'address')
     server_port = config.getint('server', 'port')
-    logger.info("Pulsus started")
-    run_simple(server_address, server_port, server)
+    workers = config.getint('server', 'workers', fallback=1)
+    options = dict(
+        backlog=config.getint('server', 'backlog', fallback=BACKLOG),
+        drain_timeout=config.getfloat('server', 'drain_timeout',
+                                      fallback=DRAIN_TIMEOUT),
+        max_connections=config.getint('server', 'max_connections',
+                                      fallback=None),
+        reload_config=lambda: server.read_config(config_dir))
+    if workers > 1:
+        from .prefork import CRASH_WINDOW, MAX_CRASHES, PreforkServer
+        if not config.has_option('server', 'feedback_dir'):
+            config.set('server', 'feedback_dir',
+                       tempfile.mkdtemp(prefix='pulsus-feedback-'))
+        logger.info("Pulsus started (%d workers)" % workers)
+        prefork = PreforkServer(
+            server_address, server_port, workers,
+            lambda worker_id: server.setup(config, worker_id),
+            max_crashes=config.getint('server', 'max_worker_crashes',
+                                      fallback=MAX_CRASHES),
+            crash_window=config.getfloat('server', 'worker_crash_window',
+                                         fallback=CRASH_WINDOW),
+            **options)
+        if not prefork.serve_forever():
+            sys.exit(1)
+    else:
+        app = server.setup(config)
+        listener = listen(server_address, server_port,
+                          backlog=options.pop('backlog'))
+        logger.info("Pulsus started")
+        serve(listener, app, **options)
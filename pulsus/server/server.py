@@ -1,16 +1,32 @@
-import configparser
+import functools
 import json
 import logging
 import os
-from datetime import datetime
 
+import gevent
 from gevent import monkey
-from gevent.queue import Empty
+from werkzeug.exceptions import HTTPException
 from werkzeug.wrappers import Request, Response
 
-from ..services.apns import APNSService
-from ..services.base import BaseNotification
+from .. import metrics
+from ..serialization import get_codec, negotiate
+from ..services.apns import APNSHTTP2Service, APNSService
+from ..services.apns.http2 import CONNECTION_COUNT
+from ..services.apns.service import BATCH_SIZE, FEEDBACK_INTERVAL
 from ..services.gcm import GCMService
+from ..services.gcm.service import (
+    COALESCE_LINGER, GCM_URL, MAX_WORKERS, MIN_WORKERS, SHARED_POOL_SIZE,
+    shared_session)
+from .api import (  # noqa
+    ACCEPT_POST, BaseAPIServer, INVALID_NOTIFICATION_ERRORS, MAX_LINE_LENGTH,
+    NDJSON_CONTENT_TYPE, ServiceOverloaded,
+    FEEDBACK_COLLECT_INTERVAL, apns_addresses, lane_options,
+    queue_limits, rate_limits, read_config, retry_limits,
+    setup_suppression, stream_summary)
+from .deadletter import DeadLetterLog
+from .feedback import FeedbackLog, FeedbackSpool
+from .journal import NotificationJournal, SYNC_INTERVAL
+from .registry import ServiceRegistry
 
 
 monkey.patch_all()
@@ -18,97 +34,300 @@ monkey.patch_all()
 logger = logging.getLogger(__name__)
 
 
-class APIServer(object):
+class APIServer(BaseAPIServer):
 
     def __init__(self, *args, **kwargs):
-        self.apns = kwargs.pop('apns')
-        self.apns_sandbox = kwargs.pop('apns_sandbox')
-        self.gcm = kwargs.pop('gcm')
+        self.feedback_spool = kwargs.pop('feedback_spool', None)
+        self.max_content_length = kwargs.pop('max_content_length', None)
+        super(APIServer, self).__init__(*args, **kwargs)
+        gevent.spawn(self._collect_feedback_loop)
 
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
-        response = self.dispatch_request(request)
+        request.max_content_length = self.max_content_length
+        try:
+            response = self.dispatch_request(request)
+        except HTTPException as e:
+            response = e
         return response(environ, start_response)
 
+    def stop(self, timeout=10.0):
+        """
+        Stops the services, giving them ``timeout`` seconds to send the
+        notifications still queued. Returns True if nothing was left
+        unsent.
+        """
+        greenlets = [gevent.spawn(s.stop, timeout)
+                     for s in self.registry.services()]
+        gevent.joinall(greenlets)
+        if self.journal is not None:
+            self.journal.close()
+        if self.suppression is not None:
+            self.suppression.save()
+        return all(g.value for g in greenlets)
+
+    def reload(self, config):
+        """
+        Updates the services to match the config. New services are
+        started, removed ones stopped in the background.
+        """
+        try:
+            added, removed = self.update_services(config)
+        except Exception:
+            logger.exception("Error updating services, keeping them as is")
+            return
+        for service in added:
+            service.start()
+        for service in removed:
+            gevent.spawn(service.stop)
+
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
     def dispatch_request(self, request):
         if request.path == '/api/push/' and request.method == 'POST':
-            notifications = json.loads(request.data)
-            self.push_notifications(notifications)
+            if request.mimetype == NDJSON_CONTENT_TYPE:
+                summary = self.push_notifications_stream(request.stream)
+                resp = Response(json.dumps(summary),
+                                mimetype='application/json')
+                resp.status_code = 201
+            else:
+                resp = self.handle_push(request)
+        elif request.path == '/api/push/' and request.method == 'OPTIONS':
             resp = Response('')
-            resp.status_code = 201
+            resp.status_code = 204
+            resp.headers['Accept-Post'] = ACCEPT_POST
         elif request.path == '/api/feedback/' and request.method == 'POST':
-            resp = self.handle_feedback(request)
+            if self.feedback_log is not None:
+                # Draining would acknowledge the feedback being exported
+                resp = Response('Feedback is retained, use '
+                                '/api/feedback/export/')
+                resp.status_code = 409
+            else:
+                resp = self.handle_feedback(request)
+        elif (request.path == '/api/feedback/export/' and
+                request.method == 'GET' and self.feedback_log is not None):
+            try:
+                lines = self.export_feedback(request.args)
+            except ValueError as e:
+                resp = Response(str(e))
+                resp.status_code = 400
+            else:
+                resp = Response((line.encode('utf8') for line in lines),
+                                mimetype=NDJSON_CONTENT_TYPE)
+        elif (request.path == '/api/feedback/ack/' and
+                request.method == 'POST' and self.feedback_log is not None):
+            try:
+                cursor = self.ack_feedback(json.loads(request.data))
+            except (ValueError, KeyError, TypeError) as e:
+                resp = Response(str(e))
+                resp.status_code = 400
+            else:
+                resp = Response(json.dumps(dict(cursor=cursor)),
+                                mimetype='application/json')
+        elif request.path == '/api/rate-limits/' and request.method == 'GET':
+            resp = Response(json.dumps(self.get_rate_limits()),
+                            mimetype='application/json')
+        elif (request.path == '/api/rate-limits/' and
+                request.method == 'POST'):
+            try:
+                state = self.set_rate_limit(json.loads(request.data))
+            except ValueError as e:
+                resp = Response(str(e))
+                resp.status_code = 400
+            else:
+                resp = Response(json.dumps(state),
+                                mimetype='application/json')
+        elif request.path == '/metrics' and request.method == 'GET':
+            resp = Response(metrics.REGISTRY.render(),
+                            content_type=metrics.CONTENT_TYPE)
         else:
             resp = Response('')
             resp.status_code = 400
         return resp
 
-    def handle_feedback(self, request):
-        feedback = self._handle_feedback('apns', self.apns, False)
-        feedback.extend(self._handle_feedback('apns', self.apns_sandbox, True))
-        feedback.extend(self._handle_feedback('gcm', self.gcm, False))
-        resp = Response(json.dumps(feedback))
+    def handle_push(self, request):
+        codec = get_codec(request.mimetype)
+        if codec is None:
+            resp = Response('')
+            resp.status_code = 415
+            resp.headers['Accept-Post'] = ACCEPT_POST
+            return resp
+        try:
+            notifications = codec.loads(request.get_data())
+        except ValueError as e:
+            resp = Response(str(e))
+            resp.status_code = 400
+            return resp
+        try:
+            suppression = self.push_notifications(notifications)
+        except ServiceOverloaded as e:
+            resp = Response('')
+            resp.status_code = 429
+            resp.headers['Retry-After'] = str(e.retry_after)
+        except INVALID_NOTIFICATION_ERRORS as e:
+            resp = Response(str(e))
+            resp.status_code = 400
+        else:
+            resp = Response(json.dumps(dict(suppression=suppression)),
+                            mimetype='application/json')
+            resp.status_code = 201
         return resp
 
-    def _handle_feedback(self, type, service, sandbox):
-        feedback = []
-        try:
-            while True:
-                epoch, token = service.get_feedback(block=False)
-                dt = datetime.utcfromtimestamp(epoch)
-                feedback.append(dict(type=type,
-                                     sandbox=sandbox,
-                                     marked_inactive_at=dt.isoformat(),
-                                     token=token))
-        except Empty:
-            pass
-        return feedback
-
-    def push_notifications(self, notifications):
-        for data in notifications:
-            notification = BaseNotification.deserialize(data)
-            if notification.service_type == 'apns':
-                if notification.sandbox:
-                    logger.debug("Sending APNS notification (to sandbox)")
-                    self.apns_sandbox.queue_notification(notification)
-                else:
-                    logger.debug("Sending APNS notification")
-                    self.apns.queue_notification(notification)
-            elif notification.service_type == 'gcm':
-                logger.debug("Sending GCM notification")
-                self.gcm.queue_notification(notification)
-            else:
-                logger.error("Unknown push type")
+    def handle_feedback(self, request):
+        feedback = self.drain_feedback()
+        if self.feedback_spool is not None:
+            # Include the feedback collected by the other workers
+            self.feedback_spool.put(feedback)
+            feedback = self.feedback_spool.drain()
+        codec = negotiate(request.headers.get('Accept'))
+        return Response(codec.dumps(feedback), mimetype=codec.content_type)
+
+    def _collect_feedback_loop(self):
+        while True:
+            gevent.sleep(FEEDBACK_COLLECT_INTERVAL)
+            try:
+                self.buffer_feedback()
+                if self.suppression is not None:
+                    self.suppression.sync()
+                if (self.feedback_spool is not None and
+                        self.feedback_log is None):
+                    # Make it available to the other workers
+                    self.feedback_spool.put(self.drain_feedback())
+            except Exception:
+                logger.exception("Error collecting feedback")
+
+    def push_notifications_stream(self, stream):
+        """
+        Queues notifications from a stream of newline delimited JSON,
+        one notification per line, as they come in. Returns a summary of
+        the number of accepted notifications, and the line numbers and
+        reasons of the rejected ones.
+        """
+        summary = stream_summary()
+        lineno = 0
+        while True:
+            line = stream.readline(MAX_LINE_LENGTH)
+            if not line:
+                break
+            lineno += 1
+            if not line.endswith(b'\n') and len(line) >= MAX_LINE_LENGTH:
+                # Skip the remainder of the line
+                while line and not line.endswith(b'\n'):
+                    line = stream.readline(MAX_LINE_LENGTH)
+                line = None
+            self.push_line(summary, lineno, line)
+        return summary
+
+
+def setup_apns(config, section, sandbox, app=None):
+    certfile = config.get(section, 'cert_file_pem')
+    if config.get(section, 'protocol', fallback='binary') == 'http2':
+        return APNSHTTP2Service(
+            sandbox=sandbox,
+            app=app,
+            certfile=certfile,
+            topic=config.get(section, 'topic', fallback=None),
+            connection_count=config.getint(
+                section, 'connections', fallback=CONNECTION_COUNT),
+            **apns_addresses(config, section),
+            **queue_limits(config, section),
+            **retry_limits(config, section),
+            **lane_options(config, section),
+            **rate_limits(config, section))
+    return APNSService(
+        sandbox=sandbox,
+        app=app,
+        certfile=certfile,
+        batch_size=config.getint(section, 'batch_size', fallback=BATCH_SIZE),
+        feedback_interval=config.getfloat(section, 'feedback_interval',
+                                          fallback=FEEDBACK_INTERVAL),
+        **apns_addresses(config, section),
+        **queue_limits(config, section),
+        **retry_limits(config, section),
+        **lane_options(config, section),
+        **rate_limits(config, section))
+
+
+def setup_gcm(config, section, app=None, session=None):
+    return GCMService(
+        config.get(section, 'api_key'),
+        app=app,
+        session=session,
+        url=config.get(section, 'url', fallback=GCM_URL),
+        coalesce_linger=config.getfloat(section, 'coalesce_linger',
+                                        fallback=COALESCE_LINGER),
+        min_workers=config.getint(section, 'min_workers',
+                                  fallback=MIN_WORKERS),
+        max_workers=config.getint(section, 'max_workers',
+                                  fallback=MAX_WORKERS),
+        canonical_id_map_size=config.getint(section, 'canonical_id_map_size',
+                                            fallback=0),
+        **queue_limits(config, section),
+        **retry_limits(config, section),
+        **lane_options(config, section),
+        **rate_limits(config, section))
+
 
+def setup_service(config, section, app, kind, gcm_session=None):
+    if kind == 'gcm':
+        return setup_gcm(config, section, app, gcm_session)
+    return setup_apns(config, section, kind == 'apns_sandbox', app)
 
-def read_config(config_dir):
-    config = configparser.ConfigParser()
-    config.read([os.path.join(config_dir, 'pulsus.conf')])
-    return config
 
+def setup(config, worker_id=None):
+    """
+    Sets up the push services and returns the API server. When running
+    multiple worker processes, each worker calls this with its own
+    ``worker_id``.
+    """
+    # Push services of all apps, sharing the connections to GCM
+    gcm_session = shared_session(config.getint(
+        'server', 'gcm_pool_size', fallback=SHARED_POOL_SIZE))
+    registry = ServiceRegistry(
+        functools.partial(setup_service, gcm_session=gcm_session))
+    registry.update(config)
+    for service in registry.services():
+        service.start()
 
-def setup(config):
-    # Apple (Production)
-    apns_server = APNSService(
-        sandbox=False,
-        certfile=config.get('apns', 'cert_file_pem'))
-    apns_server.start()
+    # Journal
+    journal = None
+    journal_dir = config.get('server', 'journal_dir', fallback=None)
+    if journal_dir and worker_id is not None:
+        journal_dir = os.path.join(journal_dir, 'worker-%d' % worker_id)
+    if journal_dir:
+        journal = NotificationJournal(
+            journal_dir,
+            sync_interval=config.getfloat('server', 'journal_sync_interval',
+                                          fallback=SYNC_INTERVAL))
+        journal.start()
 
-    # Apple (Sandbox)
-    apns_sandbox_server = APNSService(
-        sandbox=True,
-        certfile=config.get('apns:sandbox', 'cert_file_pem'))
-    apns_sandbox_server.start()
+    # Notifications given up on
+    dead_letter = None
+    dead_letter_file = config.get('server', 'dead_letter_file', fallback=None)
+    if dead_letter_file:
+        dead_letter = DeadLetterLog(dead_letter_file)
 
-    # GCM
-    gcm_server = GCMService(config.get('gcm', 'api_key'))
-    gcm_server.start()
+    # Feedback, shared by all workers
+    feedback_log = None
+    feedback_spool = None
+    feedback_log_dir = config.get('server', 'feedback_log_dir', fallback=None)
+    if feedback_log_dir:
+        feedback_log = FeedbackLog(feedback_log_dir)
+    elif worker_id is not None:
+        feedback_spool = FeedbackSpool(
+            config.get('server', 'feedback_dir'), 'worker-%d' % worker_id)
 
     # API
-    api_server = APIServer(apns=apns_server,
-                           apns_sandbox=apns_sandbox_server,
-                           gcm=gcm_server)
+    max_content_length = config.getint('server', 'max_request_size',
+                                       fallback=None)
+    api_server = APIServer(max_content_length=max_content_length,
+                           registry=registry,
+                           journal=journal,
+                           dead_letter=dead_letter,
+                           suppression=setup_suppression(config),
+                           feedback_log=feedback_log,
+                           feedback_spool=feedback_spool)
+    if journal is not None:
+        api_server.replay_journal()
     return api_server
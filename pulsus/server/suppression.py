@@ -0,0 +1,195 @@
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+import time
+
+import gevent
+
+
+# Seconds a token stays suppressed, unless reported invalid again.
+SUPPRESSION_TTL = 30 * 86400
+
+# Key hash, expiry time
+RECORD = struct.Struct('!Qd')
+
+logger = logging.getLogger(__name__)
+
+
+class SuppressionIndex(object):
+    """
+    Set of device tokens known to be invalid, consulted before queueing
+    notifications so that nothing is sent to them. Tokens are scoped by
+    the service (kind and app) that reported them, as a token rejected by
+    the sandbox, or for one app, may well be valid for another. Only a 64
+    bit hash of each scoped token is kept, along with the time it expires
+    from the index after ``ttl`` seconds (or never, if None), in case the
+    token gets registered again. A false positive, dropping a
+    notification for a valid token, requires a hash collision and is
+    therefore negligible.
+
+    If ``path`` is given, the index is loaded from it, and ``save()``
+    writes it back. The file can be shared by several processes, each
+    calling ``sync()`` periodically to pick up the tokens the others
+    added.
+    """
+
+    def __init__(self, ttl=SUPPRESSION_TTL, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.dirty = False
+        self._expiry = {}
+        # Identity of the version of the file last loaded, or written
+        self._version = None
+        if path is not None:
+            self._merge(*self._exchange())
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def _key(self, scope, token):
+        digest = hashlib.blake2b(
+            ('%s/%s' % (scope, token)).encode('utf8'),
+            digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, scope, token, timestamp=None):
+        """
+        Adds a token the service named ``scope`` reported invalid.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        expiry = float('inf')
+        if self.ttl is not None:
+            expiry = timestamp + self.ttl
+        self._expiry[self._key(scope, token)] = expiry
+        self.dirty = True
+
+    def contains(self, scope, token, now=None):
+        key = self._key(scope, token)
+        expiry = self._expiry.get(key)
+        if expiry is None:
+            return False
+        if expiry <= (now or time.time()):
+            del self._expiry[key]
+            self.dirty = True
+            return False
+        return True
+
+    def filter(self, notification, scope):
+        """
+        Removes the tokens known to be invalid for the service named
+        ``scope`` from the notification. Returns the number of tokens
+        removed (hits) and left (misses). If none is left, the
+        notification should not be sent at all.
+        """
+        now = time.time()
+        tokens = notification.tokens()
+        valid = [token for token in tokens
+                 if not self.contains(scope, token, now)]
+        hits = len(tokens) - len(valid)
+        if hits and valid:
+            notification.drop_tokens(set(tokens) - set(valid))
+        return hits, len(valid)
+
+    def purge(self, now=None):
+        now = now or time.time()
+        expired = [k for k, expiry in self._expiry.items() if expiry <= now]
+        for key in expired:
+            del self._expiry[key]
+        if expired:
+            self.dirty = True
+
+    def _locked(self):
+        """
+        Returns the lock file, held exclusively while open, serializing
+        the processes sharing the index.
+        """
+        f = open(self.path + '.lock', 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _file_version(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _exchange(self, snapshot=None):
+        """
+        Reads the records of the file, if changed since it was last
+        loaded or written, and writes ``snapshot``, a copy of the index,
+        merged with them. Returns the records read and the version of
+        the file. Leaves the index alone, so that it can run in a thread.
+        """
+        with self._locked():
+            version = self._file_version()
+            records = []
+            if version is not None and version != self._version:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                records = list(RECORD.iter_unpack(
+                    data[:len(data) - len(data) % RECORD.size]))
+            if snapshot is None:
+                return records, version
+            now = time.time()
+            for key, expiry in records:
+                if expiry > max(now, snapshot.get(key, 0)):
+                    snapshot[key] = expiry
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(RECORD.pack(key, expiry)
+                                 for key, expiry in snapshot.items()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            return records, self._file_version()
+
+    def _snapshot(self, write):
+        """
+        Returns a copy of the index to write to the file, if ``write``.
+        """
+        if not write:
+            return None
+        self.purge()
+        self.dirty = False
+        return dict(self._expiry)
+
+    def _merge(self, records, version):
+        now = time.time()
+        count = len(self._expiry)
+        for key, expiry in records:
+            if expiry > max(now, self._expiry.get(key, 0)):
+                self._expiry[key] = expiry
+        self._version = version
+        if records:
+            logger.debug("Loaded %d suppressed tokens" % (
+                len(self._expiry) - count))
+
+    def sync(self, write=False):
+        """
+        Picks up the tokens other processes added to the file, and adds
+        the ones added here since the last time (or all of them, if
+        ``write``).
+        """
+        if self.path is None:
+            return
+        write = write or self.dirty
+        snapshot = self._snapshot(write)
+        try:
+            # flock() and the file I/O block, keep the hub running
+            records, version = gevent.get_hub().threadpool.apply(
+                self._exchange, (snapshot,))
+        except Exception:
+            self.dirty = self.dirty or write
+            raise
+        self._merge(records, version)
+
+    def save(self):
+        """
+        Writes the index, merged with the file, to its file, replacing
+        the previous version atomically.
+        """
+        self.sync(write=True)
@@ -0,0 +1,57 @@
+import logging
+import signal
+import socket
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+
+BACKLOG = 1024
+# Seconds to wait for in-flight requests, and for queued notifications to
+# be sent, when shutting down.
+DRAIN_TIMEOUT = 10.0
+
+logger = logging.getLogger(__name__)
+
+# gevent < 1.5 names this gevent.signal
+signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+
+
+def listen(address, port, backlog=BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    return sock
+
+
+def serve(listener, app, drain_timeout=DRAIN_TIMEOUT, max_connections=None,
+          reload_config=None):
+    """
+    Serves ``app`` on ``listener``, using HTTP/1.1 keep-alive, until
+    SIGTERM or SIGINT is received. On shutdown, new connections are no
+    longer accepted, in-flight requests are given ``drain_timeout``
+    seconds to complete, after which the app is stopped, so that queued
+    notifications are sent before exiting. On SIGHUP, the app is
+    reloaded with the config returned by ``reload_config``.
+    """
+    spawn = 'default'
+    if max_connections:
+        spawn = Pool(max_connections)
+    server = WSGIServer(listener, app, spawn=spawn)
+
+    def shutdown():
+        logger.info("Shutting down, draining requests")
+        server.stop(timeout=drain_timeout)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal_handler(signum, shutdown)
+    if reload_config is not None and hasattr(app, 'reload'):
+        signal_handler(signal.SIGHUP,
+                       lambda: gevent.spawn(app.reload, reload_config()))
+    server.serve_forever()
+    if hasattr(app, 'stop'):
+        if not app.stop(drain_timeout):
+            logger.warning("Stopped with notifications left unsent")
+    logger.info("Stopped")
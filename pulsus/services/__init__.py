@@ -0,0 +1,3 @@
+# The notification classes register themselves for deserialization when
+# imported.
+from . import apns, gcm  # noqa
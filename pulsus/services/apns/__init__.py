@@ -1,2 +1,3 @@
 from .notification import APNSNotification  # noqa
 from .service import APNSService  # noqa
+from .http2 import APNSHTTP2Service  # noqa
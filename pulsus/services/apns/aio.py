@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import queue
+import ssl
+import time
+
+from ..base.aio import AsyncRetryScheduler, SendQueue
+from .service import APNSService, FEEDBACK_BUFFER_SIZE, parse_feedback
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAPNSService(APNSService):
+    """
+    asyncio implementation of the APNS (binary protocol) service. Apart
+    from ``stop()`` being a coroutine, and ``get_feedback()`` and
+    ``get_error()`` being non-blocking, it behaves like ``APNSService``.
+    It must be started from within a running event loop.
+    """
+
+    retry_scheduler_class = AsyncRetryScheduler
+
+    def __init__(self, sandbox=True, **kwargs):
+        super(AsyncAPNSService, self).__init__(sandbox=sandbox, **kwargs)
+        self._send_queue = SendQueue(self.lanes)
+        self._feedback_queue = queue.Queue()
+        self._error_queue = queue.Queue()
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.load_cert_chain(self._sslargs['certfile'],
+                                          self._sslargs.get('keyfile'))
+        self._writer = None
+        self._send_task = None
+        self._error_task = None
+        self._feedback_task = None
+
+    def start(self):
+        """Start the message sending and feedback loops."""
+        if self._send_task is None:
+            self._send_task = asyncio.ensure_future(self._send_loop())
+            self._feedback_task = asyncio.ensure_future(
+                self._feedback_loop())
+            self.retry.start()
+
+    async def stop(self, timeout=10.0):
+        """
+        Send all pending messages, close connection.
+        Returns True if no message left to sent. False if dirty, which
+        includes notifications still waiting to be retried.
+        """
+        if self._send_task is not None and not self._send_queue.empty():
+            try:
+                await asyncio.wait_for(self._send_queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in (self._send_task, self._error_task, self._feedback_task):
+            if task is not None:
+                task.cancel()
+        self._send_task = self._error_task = self._feedback_task = None
+        self.retry.stop()
+        self._close_send_connection()
+        return self._send_queue.empty() and not len(self.retry)
+
+    async def _send_loop(self):
+        logger.info("%s service started (asyncio)" % self.service_type)
+        try:
+            while True:
+                batch = await self._get_batch()
+                delay = self.rate_limiter.reserve(len(batch), len(batch))
+                if delay:
+                    await asyncio.sleep(delay)
+                try:
+                    await self.send_notifications(batch)
+                except Exception:
+                    self.error_sending_notifications(batch)
+                finally:
+                    for i in range(len(batch)):
+                        self._send_queue.task_done()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.last_err = e
+            raise
+        logger.info("%s service stopped (asyncio)" % self.service_type)
+
+    async def _get_batch(self):
+        batch = [await self._send_queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._send_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _check_send_connection(self):
+        if self._writer is None:
+            host, port = self.gateway
+            logger.debug('Connecting to %s' % host)
+            reader, self._writer = await asyncio.open_connection(
+                host, port, ssl=self._ssl_context)
+            self._sent.clear()
+            self._failed_identifier = None
+            self._error_task = asyncio.ensure_future(
+                self._error_loop(reader, self._writer))
+
+    def _close_send_connection(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _error_loop(self, reader, writer):
+        try:
+            msg = await reader.readexactly(1 + 1 + 4)
+            self._handle_error_response(msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            return
+        if self._writer is writer:
+            self._close_send_connection()
+            if self._failed_identifier is not None:
+                self._requeue_after(self._failed_identifier)
+            self._sent.clear()
+
+    async def send_notifications(self, notifications):
+        await self._check_send_connection()
+        logger.debug('Sending %d APNS notifications' % len(notifications))
+        t = time.time()
+        for buf in self._pack_batch(notifications):
+            self._writer.write(buf)
+        await self._writer.drain()
+        self._batch_sent(notifications, time.time() - t)
+
+    async def send_notification(self, notification):
+        await self.send_notifications([notification])
+
+    def error_sending_notifications(self, notifications):
+        self._close_send_connection()
+        self._retry_failed(notifications)
+
+    async def _feedback_loop(self):
+        try:
+            while True:
+                try:
+                    await self._read_feedback()
+                except (OSError, asyncio.IncompleteReadError):
+                    logger.exception('Error reading APNS feedback')
+                await asyncio.sleep(self.feedback_interval)
+        except asyncio.CancelledError:
+            pass
+
+    async def _read_feedback(self):
+        host, port = self.feedback
+        logger.debug('Connecting to %s' % host)
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self._ssl_context)
+        buf = bytearray()
+        try:
+            while True:
+                data = await reader.read(FEEDBACK_BUFFER_SIZE)
+                if not data:
+                    break
+                buf += data
+                for feedback in parse_feedback(buf):
+                    self._feedback_queue.put(feedback)
+        finally:
+            writer.close()
+        if buf:
+            logger.warning('Discarding incomplete APNS feedback tuple')
+
+    def get_error(self, block=False, timeout=None):
+        """
+        Get the next error message, raising queue.Empty if there is none.
+
+        Each error message is a 2-tuple of (status, identifier)."""
+        return self._error_queue.get_nowait()
+
+    def get_feedback(self, block=False, timeout=None):
+        """
+        Get the next feedback message, raising queue.Empty if there is
+        none.
+
+        Each feedback message is a ``Feedback`` tuple of (timestamp,
+        device_token, event, canonical_token)."""
+        return self._feedback_queue.get_nowait()
@@ -0,0 +1,406 @@
+import json
+import logging
+import os
+import time
+
+import gevent
+from gevent import socket, ssl
+from gevent.event import AsyncResult, Event
+from gevent.lock import BoundedSemaphore, RLock
+from gevent.queue import Queue
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2 import events as h2_events
+except ImportError:  # pragma: no cover
+    H2Connection = None
+
+from ... import metrics
+from ..base.backlog import Backlog
+from ..base.feedback import Feedback
+from ..base.lanes import JoinableLaneQueue, Lanes
+from ..base.ratelimit import RateLimiter
+from ..base.retry import MAX_ATTEMPTS, RetryScheduler
+from ..base.service import BaseService, service_name
+from .notification import APNSNotification
+
+
+HOST = ("api.push.apple.com", 443)
+HOST_SANDBOX = ("api.sandbox.push.apple.com", 443)
+CONNECTION_COUNT = 2
+# Number of concurrent streams used per connection. APNS itself
+# advertises a (much) higher limit.
+MAX_CONCURRENT_STREAMS = 100
+READ_SIZE = 65536
+
+# Responses indicating that the device token is no longer valid.
+INVALID_TOKEN_REASONS = ('BadDeviceToken', 'Unregistered',
+                         'DeviceTokenNotForTopic')
+
+
+logger = logging.getLogger(__name__)
+
+
+class APNSHTTP2Error(Exception):
+    pass
+
+
+class APNSHTTP2Connection(object):
+    """
+    A single HTTP/2 connection to APNS, multiplexing concurrent requests
+    over separate streams.
+    """
+
+    def __init__(self, host, port, ssl_context,
+                 max_concurrent_streams=MAX_CONCURRENT_STREAMS):
+        self.host = host
+        self.port = port
+        self._ssl_context = ssl_context
+        self._max_concurrent_streams = max_concurrent_streams
+        self._socket = None
+        self._conn = None
+        self._lock = RLock()
+        self._streams = None
+        self._responses = {}
+        self._window_updated = Event()
+        self._read_greenlet = None
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    @property
+    def active_streams(self):
+        return len(self._responses)
+
+    def connect(self):
+        logger.debug('Connecting to %s' % self.host)
+        tcp_socket = socket.create_connection((self.host, self.port))
+        s = self._ssl_context.wrap_socket(tcp_socket,
+                                          server_hostname=self.host)
+        if s.selected_alpn_protocol() != 'h2':
+            s.close()
+            raise APNSHTTP2Error('Server did not negotiate HTTP/2')
+        self._conn = H2Connection(config=H2Configuration(
+            client_side=True, header_encoding='utf-8'))
+        self._conn.initiate_connection()
+        self._socket = s
+        self._socket.sendall(self._conn.data_to_send())
+        self._streams = BoundedSemaphore(self._max_concurrent_streams)
+        self._read_greenlet = gevent.spawn(self._read_loop)
+
+    def close(self):
+        if self._read_greenlet is not None:
+            gevent.kill(self._read_greenlet)
+            self._read_greenlet = None
+        self._disconnect(APNSHTTP2Error('Connection closed'))
+
+    def _disconnect(self, exc):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        responses, self._responses = self._responses, {}
+        for response in responses.values():
+            response['result'].set_exception(exc)
+        self._window_updated.set()
+
+    def request(self, path, headers, body):
+        """
+        Sends a POST request on a new stream and blocks until the response
+        has been received. Returns a (status, headers, body) tuple.
+        """
+        with self._lock:
+            if not self.connected:
+                self.connect()
+        streams = self._streams
+        with streams:
+            result = AsyncResult()
+            with self._lock:
+                if not self.connected:
+                    raise APNSHTTP2Error('Connection closed')
+                stream_id = self._conn.get_next_available_stream_id()
+                self._responses[stream_id] = dict(
+                    result=result, status=None, headers={}, body=[])
+                request_headers = [
+                    (':method', 'POST'),
+                    (':scheme', 'https'),
+                    (':authority', self.host),
+                    (':path', path)]
+                request_headers.extend(headers)
+                self._conn.send_headers(stream_id, request_headers)
+                self._flush()
+            self._send_body(stream_id, body)
+            return result.get()
+
+    def _send_body(self, stream_id, body):
+        while body:
+            with self._lock:
+                if not self.connected:
+                    raise APNSHTTP2Error('Connection closed')
+                window = min(self._conn.local_flow_control_window(stream_id),
+                             self._conn.max_outbound_frame_size)
+                if window > 0:
+                    chunk, body = body[:window], body[window:]
+                    self._conn.send_data(stream_id, chunk,
+                                         end_stream=not body)
+                    self._flush()
+                    continue
+                self._window_updated.clear()
+            self._window_updated.wait()
+
+    def _flush(self):
+        data = self._conn.data_to_send()
+        if data:
+            self._socket.sendall(data)
+
+    def _read_loop(self):
+        exc = APNSHTTP2Error('Connection closed by APNS')
+        try:
+            while True:
+                data = self._socket.recv(READ_SIZE)
+                if not data:
+                    break
+                with self._lock:
+                    for event in self._conn.receive_data(data):
+                        self._handle_event(event)
+                    self._flush()
+        except gevent.GreenletExit:
+            pass
+        except Exception as e:
+            logger.exception('Error reading from %s' % self.host)
+            exc = e
+        finally:
+            self._read_greenlet = None
+            self._disconnect(exc)
+
+    def _handle_event(self, event):
+        if isinstance(event, h2_events.ResponseReceived):
+            response = self._responses.get(event.stream_id)
+            if response is not None:
+                headers = dict(event.headers)
+                response['status'] = int(headers.pop(':status'))
+                response['headers'] = headers
+        elif isinstance(event, h2_events.DataReceived):
+            self._conn.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
+            response = self._responses.get(event.stream_id)
+            if response is not None:
+                response['body'].append(event.data)
+        elif isinstance(event, h2_events.StreamEnded):
+            response = self._responses.pop(event.stream_id, None)
+            if response is not None:
+                response['result'].set((response['status'],
+                                        response['headers'],
+                                        b''.join(response['body'])))
+        elif isinstance(event, h2_events.StreamReset):
+            response = self._responses.pop(event.stream_id, None)
+            if response is not None:
+                response['result'].set_exception(APNSHTTP2Error(
+                    'Stream reset (error code %s)' % event.error_code))
+        elif isinstance(event, h2_events.WindowUpdated):
+            self._window_updated.set()
+        elif isinstance(event, h2_events.ConnectionTerminated):
+            raise APNSHTTP2Error(
+                'Connection terminated (error code %s)' % event.error_code)
+
+
+class APNSHTTP2Service(BaseService):
+    """
+    APNS service speaking the HTTP/2 provider API. Notifications are sent
+    over a pool of connections, each carrying many concurrent streams,
+    and every notification gets an individual response.
+
+    ``gateway`` overrides the (host, port) of APNS, and ``cafile`` the
+    certificates trusted to verify it, for instance to send to a stand-in
+    server.
+    """
+
+    service_type = 'apns'
+
+    def __init__(self, sandbox=True, topic=None,
+                 connection_count=CONNECTION_COUNT,
+                 max_concurrent_streams=MAX_CONCURRENT_STREAMS,
+                 max_queue_count=None, max_queue_bytes=None,
+                 max_attempts=MAX_ATTEMPTS, app=None, priority_weights=None,
+                 collapse=False, max_request_rate=None,
+                 max_recipient_rate=None, gateway=None, cafile=None,
+                 **kwargs):
+        if H2Connection is None:
+            raise ImportError(u"The h2 package is required for HTTP/2.")
+        if "certfile" not in kwargs:
+            raise ValueError(u"Must specify a PEM bundle.")
+        if not os.path.exists(kwargs['certfile']):
+            raise ValueError('PEM bundle file not found')
+        self.name = service_name('apns_sandbox' if sandbox else 'apns', app)
+        self.lanes = Lanes(self.name, priority_weights, collapse)
+        # Joinable, to wait for the notifications being sent as well
+        self._send_queue = JoinableLaneQueue(self.lanes)
+        self._send_greenlets = []
+        self.backlog = Backlog(max_queue_count, max_queue_bytes)
+        self.rate_limiter = RateLimiter(max_request_rate, max_recipient_rate,
+                                        self.name)
+        self.retry = RetryScheduler(self._send_queue.put,
+                                    self.notification_failed,
+                                    max_attempts=max_attempts)
+        self._feedback_queue = Queue()
+        self._error_queue = Queue()
+        self._sandbox = self.sandbox = sandbox
+        self.app = app
+        self.topic = topic
+        self.last_err = None
+
+        # gevent's context, as create_default_context() returns one
+        # blocking the hub unless the ssl module is monkey patched.
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if cafile:
+            ssl_context.load_verify_locations(cafile)
+        else:
+            ssl_context.load_default_certs()
+        ssl_context.load_cert_chain(**kwargs)
+        ssl_context.set_alpn_protocols(['h2'])
+        if gateway is None:
+            gateway = HOST_SANDBOX if sandbox else HOST
+        self.gateway = gateway
+        host, port = gateway
+        self.connections = [
+            APNSHTTP2Connection(host, port, ssl_context,
+                                max_concurrent_streams)
+            for i in range(connection_count)]
+        self.concurrency = connection_count * max_concurrent_streams
+
+    def start(self):
+        """Start the message sending loops."""
+        if not self._send_greenlets:
+            logger.info("%s (HTTP/2) service started" % self.service_type)
+            self._send_greenlets = [
+                gevent.spawn(self.save_err, self._send_loop)
+                for i in range(self.concurrency)]
+            self.retry.start()
+
+    def stop(self, timeout=10.0):
+        """
+        Send all pending messages, close connections.
+        Returns True if no message left to sent. False if dirty, which
+        includes notifications still being sent when the timeout expired,
+        and notifications still waiting to be retried.
+        """
+        clean = True
+        if self._send_greenlets:
+            clean = self.wait_send(timeout=timeout)
+        gevent.killall(self._send_greenlets)
+        self._send_greenlets = []
+        self.retry.stop()
+        for connection in self.connections:
+            connection.close()
+        logger.info("%s (HTTP/2) service stopped" % self.service_type)
+        return (clean and self._send_queue.qsize() < 1 and
+                not len(self.retry))
+
+    def wait_send(self, timeout=None):
+        """
+        Waits until the queued notifications, and those being sent, are
+        done with. Returns False if the timeout expired before.
+        """
+        return self._send_queue.join(timeout=timeout)
+
+    def _send_loop(self):
+        try:
+            while True:
+                message = self._send_queue.get()
+                try:
+                    self.send_notification(message)
+                except Exception:
+                    self.error_sending_notification(message)
+                finally:
+                    self._send_queue.task_done()
+        except gevent.GreenletExit:
+            pass
+
+    def _get_connection(self):
+        return min(self.connections, key=lambda c: c.active_streams)
+
+    def queue_notification(self, obj):
+        """Send a push notification"""
+        if not isinstance(obj, APNSNotification):
+            raise ValueError(u"You can only send APNSNotification objects.")
+        self.backlog.add(obj)
+        if not self.collapse(obj):
+            self._send_queue.put(obj)
+
+    def send_notification(self, notification):
+        """
+        Sends the notification and returns the (status, reason) of the
+        response. Raises an exception on errors that warrant a retry.
+        """
+        headers = [('apns-expiration', str(notification.expiry))]
+        if self.topic:
+            headers.append(('apns-topic', self.topic))
+        if notification.collapse_id is not None:
+            headers.append(('apns-collapse-id', notification.collapse_id))
+        delay = self.rate_limiter.reserve()
+        if delay:
+            gevent.sleep(delay)
+        connection = self._get_connection()
+        t = time.time()
+        status, _, body = connection.request(
+            '/3/device/' + notification.token, headers,
+            notification.payload())
+        metrics.SEND_DURATION.observe(time.time() - t, self.name, '0')
+        if status == 429:
+            self.rate_limiter.throttled()
+        else:
+            self.rate_limiter.succeeded()
+        if status == 200:
+            metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'success')
+            self.notification_sent(notification)
+            return status, None
+        reason = None
+        timestamp = None
+        if body:
+            data = json.loads(body.decode('utf8'))
+            reason = data.get('reason')
+            timestamp = data.get('timestamp')
+        if status == 429 or status >= 500:
+            raise APNSHTTP2Error('APNS responded %d (%s)' % (status, reason))
+        self.notification_sent(notification)
+        logger.info('APNS rejected notification: %d (%s)' % (status, reason))
+        metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'rejected')
+        self._error_queue.put((reason, notification.identifier))
+        if reason in INVALID_TOKEN_REASONS:
+            if timestamp:
+                epoch = timestamp / 1000.0
+            else:
+                epoch = time.time()
+            self._feedback_queue.put(Feedback(epoch, notification.token))
+        return status, reason
+
+    def error_sending_notification(self, notification):
+        logger.exception("Error while pushing")
+        metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'retry')
+        self.retry.schedule(notification)
+
+    def get_error(self, block=True, timeout=None):
+        """
+        Get the next error message.
+
+        Each error message is a 2-tuple of (reason, identifier)."""
+        return self._error_queue.get(block=block, timeout=timeout)
+
+    def get_feedback(self, block=True, timeout=None):
+        """
+        Get the next feedback message.
+
+        Each feedback message is a ``Feedback`` tuple of (timestamp,
+        device_token, event, canonical_token)."""
+        return self._feedback_queue.get(block=block, timeout=timeout)
+
+    def save_err(self, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self.last_err = e
+            raise
+
+    def get_last_error(self):
+        return self.last_err
@@ -1,35 +1,84 @@
 import json
 import struct
 import time
+from functools import lru_cache
 
 import six
 
 from ..base.notification import BaseNotification
 
 
+# Command, identifier, expiry, token length, token, payload length
+FRAME_HEADER = struct.Struct("!bIIH32sH")
+# Number of distinct payloads kept serialized.
+PAYLOAD_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=PAYLOAD_CACHE_SIZE, typed=True)
+def frame_template(alert, badge, sound, extra):
+    """
+    Returns the encoded JSON payload, and a frame with that payload
+    already in place, leaving only the header to be filled in. During a
+    broadcast only the token differs per notification, so the payload
+    is serialized once. ``extra`` is passed as JSON to make it hashable.
+    """
+    aps = {}
+    if alert is not None:
+        aps["alert"] = alert
+    if badge is not None:
+        aps["badge"] = badge
+    if sound is not None:
+        aps["sound"] = sound
+
+    data = {"aps": aps}
+
+    if extra is not None:
+        data.update(json.loads(extra))
+
+    payload = json.dumps(data, separators=(',', ':')).encode('utf8')
+    frame = bytearray(FRAME_HEADER.size + len(payload))
+    frame[FRAME_HEADER.size:] = payload
+    return payload, bytes(frame)
+
+
+@BaseNotification.register
 class APNSNotification(BaseNotification):
     """
     Inititalizes a push notification message.
 
-    token - device token
+    token - device token, as 64-char hex string or 32 raw bytes
     alert - message string or message dictionary
     badge - badge number
     sound - name of sound to play
     identifier - message identifier
     expiry - expiry date of message
     extra - dictionary of extra parameters
+    collapse_id - id of the notifications superseding each other
+
+    The payload is encoded once, when first needed: alert, badge, sound
+    and extra are not to be changed after that.
     """
 
+    __slots__ = ('_token', 'alert', 'badge', 'sound', 'identifier',
+                 'expiry', 'extra', 'sandbox', 'collapse_id', '_template')
+
     service_type = 'apns'
 
     def __init__(self, token, alert=None, badge=None, sound=None,
-                 identifier=0, expiry=None, extra=None, sandbox=True):
-        if len(token) != 64:
-            raise ValueError(u"Token must be a 64-char hex string.")
+                 identifier=0, expiry=None, extra=None, sandbox=True,
+                 collapse_id=None):
+        super(APNSNotification, self).__init__()
+        if isinstance(token, bytes):
+            if len(token) != 32:
+                raise ValueError(u"Token must be 32 bytes.")
+            self._token = token
+        else:
+            if len(token) != 64:
+                raise ValueError(u"Token must be a 64-char hex string.")
+            self._token = bytes.fromhex(token)
         if ((alert is not None) and
                 (not isinstance(alert, six.string_types))):
             raise ValueError
-        self.token = token
         self.alert = alert
         self.badge = badge
         self.sound = sound
@@ -39,40 +88,76 @@ class APNSNotification(BaseNotification):
         self.expiry = expiry
         self.extra = extra
         self.sandbox = sandbox
+        self.collapse_id = collapse_id
+        # (payload, frame template), see frame_template()
+        self._template = None
+
+    @property
+    def token(self):
+        """
+        The device token, as hex string.
+        """
+        return self._token.hex()
+
+    @property
+    def token_bytes(self):
+        return self._token
 
     @classmethod
     def deserialize_data(cls, data):
-        return APNSNotification(**data)
+        return cls(**data)
 
     def serialize_data(self):
         ret = dict(token=self.token,
                    sandbox=self.sandbox)
         for attr in ['alert', 'badge', 'extra', 'sound',
-                     'identifier', 'expiry']:
+                     'identifier', 'expiry', 'collapse_id']:
             val = getattr(self, attr)
             if val is not None:
                 ret[attr] = val
         return ret
 
-    def pack(self):
-        aps = {}
-        token = bytes.fromhex(self.token)
-        if self.alert is not None:
-            aps["alert"] = self.alert
-        if self.badge is not None:
-            aps["badge"] = self.badge
-        if self.sound is not None:
-            aps["sound"] = self.sound
+    def _frame_template(self):
+        if self._template is None:
+            extra = None
+            if self.extra is not None:
+                extra = json.dumps(self.extra, sort_keys=True)
+            self._template = frame_template(self.alert, self.badge,
+                                            self.sound, extra)
+        return self._template
+
+    def payload(self):
+        """
+        Returns the UTF-8 encoded JSON payload, as sent to APNS.
+        """
+        return self._frame_template()[0]
+
+    def tokens(self):
+        return [self.token]
 
-        data = {"aps": aps}
+    def collapse_keys(self):
+        if self.collapse_id is None:
+            return ()
+        return [(self.token, self.collapse_id)]
 
-        if self.extra is not None:
-            data.update(self.extra)
+    def expired(self, now):
+        return 0 < self.expiry < now
 
-        encoded = json.dumps(data)
-        length = len(encoded)
+    def size(self):
+        return FRAME_HEADER.size + len(self.payload())
 
-        return struct.pack(
-            "!bIIH32sH%(length)ds" % {"length": length},
-            1, self.identifier, self.expiry,
-            32, token, length, encoded.encode('utf8'))
+    def pack(self, identifier=None):
+        """
+        Returns the binary frame (a bytearray) for this notification. The
+        identifier placed in the frame defaults to ``self.identifier``,
+        but can be overridden by the service to track in-flight
+        notifications.
+        """
+        if identifier is None:
+            identifier = self.identifier
+        payload, template = self._frame_template()
+        frame = bytearray(template)
+        FRAME_HEADER.pack_into(
+            frame, 0, 1, identifier, self.expiry,
+            32, self._token, len(payload))
+        return frame
@@ -1,33 +1,93 @@
 import logging
 import os
 import struct
-import binascii
+import time
+from collections import OrderedDict
 
 import gevent
 from gevent import socket, ssl
 from gevent.event import Event
-from gevent.queue import Queue
-
-from ..base.service import BaseService
+from gevent.queue import Empty, Queue
+
+from ... import metrics
+from ..base.backlog import Backlog
+from ..base.feedback import Feedback
+from ..base.lanes import LaneQueue, Lanes
+from ..base.ratelimit import RateLimiter
+from ..base.retry import MAX_ATTEMPTS, RetryScheduler
+from ..base.service import BaseService, service_name
 from .notification import APNSNotification
 
 
-INITIAL_TIMEOUT = 5
-MAX_TIMEOUT = 600
+# Maximum number of notifications, and bytes, written per send() call.
+BATCH_SIZE = 100
+BATCH_MAX_BYTES = 64 * 1024
+# Number of sent notifications remembered so that they can be resent
+# when APNS reports an error for an earlier notification.
+SENT_WINDOW_SIZE = 10000
+
+# Status code APNS uses to indicate that it is shutting down. The
+# identifier in that case refers to the last notification that was
+# successfully sent.
+STATUS_SHUTDOWN = 10
+
+# (host, port) of the gateway and feedback services.
+GATEWAY = ("gateway.push.apple.com", 2195)
+GATEWAY_SANDBOX = ("gateway.sandbox.push.apple.com", 2195)
+FEEDBACK = ("feedback.push.apple.com", 2196)
+FEEDBACK_SANDBOX = ("feedback.sandbox.push.apple.com", 2196)
+
+# Seconds between connecting to the feedback service.
+FEEDBACK_INTERVAL = 60
+# Feedback tuple: timestamp, token length, token.
+FEEDBACK_RECORD = struct.Struct("!IH32s")
+FEEDBACK_BUFFER_SIZE = 64 * 1024
 
 
 logger = logging.getLogger(__name__)
 
 
+def parse_feedback(buf):
+    """
+    Parses the complete feedback tuples at the start of ``buf`` (a
+    bytearray), removing them from it. An incomplete tuple at the end is
+    left in ``buf``, to be completed by the data read next.
+    """
+    end = len(buf) - len(buf) % FEEDBACK_RECORD.size
+    if not end:
+        return []
+    with memoryview(buf) as view:
+        feedback = [Feedback(timestamp, token.hex())
+                    for timestamp, _, token in
+                    FEEDBACK_RECORD.iter_unpack(view[:end])]
+    del buf[:end]
+    return feedback
+
+
 class APNSService(BaseService):
 
     service_type = 'apns'
-
-    def __init__(self, sandbox=True, **kwargs):
-        self._send_queue = Queue()
+    retry_scheduler_class = RetryScheduler
+
+    def __init__(self, sandbox=True, batch_size=BATCH_SIZE,
+                 batch_max_bytes=BATCH_MAX_BYTES,
+                 sent_window_size=SENT_WINDOW_SIZE, max_queue_count=None,
+                 max_queue_bytes=None, max_attempts=MAX_ATTEMPTS, app=None,
+                 feedback_interval=FEEDBACK_INTERVAL, gateway=None,
+                 feedback=None, priority_weights=None, collapse=False,
+                 max_request_rate=None, max_recipient_rate=None, **kwargs):
+        self.name = service_name('apns_sandbox' if sandbox else 'apns', app)
+        self.lanes = Lanes(self.name, priority_weights, collapse)
+        self._send_queue = LaneQueue(self.lanes)
+        self.backlog = Backlog(max_queue_count, max_queue_bytes)
+        # With the binary protocol, every notification is a request.
+        self.rate_limiter = RateLimiter(max_request_rate, max_recipient_rate,
+                                        self.name)
+        self.retry = self.retry_scheduler_class(
+            self._requeue, self.notification_failed,
+            max_attempts=max_attempts)
         self._send_queue_cleared = Event()
         self._send_greenlet = None
-        self.timeout = INITIAL_TIMEOUT
         self._feedback_queue = Queue()
         if "certfile" not in kwargs:
             raise ValueError(u"Must specify a PEM bundle.")
@@ -35,31 +95,51 @@ class APNSService(BaseService):
             raise ValueError('PEM bundle file not found')
         self._sslargs = kwargs
         self._push_connection = None
-        self._sandbox = sandbox
+        self._sandbox = self.sandbox = sandbox
+        self.app = app
         self._error_queue = Queue()
         self._send_greenlet = None
         self._error_greenlet = None
-        self._feedback_connection = None
         self._feedback_greenlet = None
+        self.feedback_interval = feedback_interval
+        if gateway is None:
+            gateway = GATEWAY_SANDBOX if sandbox else GATEWAY
+        if feedback is None:
+            feedback = FEEDBACK_SANDBOX if sandbox else FEEDBACK
+        self.gateway = gateway
+        self.feedback = feedback
+        self._ssl_context = None
+        # Resumed on the next connection, to save a full handshake.
+        self._feedback_session = None
         self.last_err = None
+        self.batch_size = max(1, batch_size)
+        self.batch_max_bytes = batch_max_bytes
+        self.sent_window_size = sent_window_size
+        # identifier -> notification, in order of sending
+        self._sent = OrderedDict()
+        self._next_identifier = 0
+        self._failed_identifier = None
 
     def start(self):
-        """Start the message sending loop."""
+        """Start the message sending and feedback loops."""
         if self._send_greenlet is None:
             self._send_greenlet = gevent.spawn(self.save_err, self._send_loop)
+            self._feedback_greenlet = gevent.spawn(self._feedback_loop)
+            self.retry.start()
 
     def _send_loop(self):
         self._send_greenlet = gevent.getcurrent()
         try:
             logger.info("%s service started" % self.service_type)
             while True:
-                message = self._send_queue.get()
+                batch = self._get_batch()
+                delay = self.rate_limiter.reserve(len(batch), len(batch))
+                if delay:
+                    gevent.sleep(delay)
                 try:
-                    self.send_notification(message)
+                    self.send_notifications(batch)
                 except Exception:
-                    self.error_sending_notification(message)
-                else:
-                    self.timeout = INITIAL_TIMEOUT
+                    self.error_sending_notifications(batch)
                 finally:
                     if self._send_queue.qsize() < 1 and \
                             not self._send_queue_cleared.is_set():
@@ -70,78 +150,147 @@ class APNSService(BaseService):
             self._send_greenlet = None
         logger.info("%s service stopped" % self.service_type)
 
+    def _get_batch(self):
+        """
+        Blocks until at least one notification is available, then drains
+        whatever else is queued, up to ``batch_size`` notifications.
+        """
+        batch = [self._send_queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._send_queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
     def _check_send_connection(self):
         if self._push_connection is None:
-            tcp_socket = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM, 0)
-            s = ssl.wrap_socket(tcp_socket, ssl_version=ssl.PROTOCOL_TLSv1,
-                                **self._sslargs)
-            addr = ["gateway.push.apple.com", 2195]
-            if self._sandbox:
-                addr[0] = "gateway.sandbox.push.apple.com"
-            logger.debug('Connecting to %s' % addr[0])
-            s.connect_ex(tuple(addr))
-            self._push_connection = s
+            connection = self._connect(self.gateway)
+            self._push_connection = connection
+            self._sent.clear()
+            self._failed_identifier = None
             self._error_greenlet = gevent.spawn(self.save_err,
-                                                self._error_loop)
-
-    def _check_feedback_connection(self):
-        if self._feedback_connection is None:
-            tcp_socket = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM, 0)
-            s = ssl.wrap_socket(tcp_socket, ssl_version=ssl.PROTOCOL_TLSv1,
-                                **self._sslargs)
-            addr = ["feedback.push.apple.com", 2196]
-            if self._sandbox:
-                addr[0] = "feedback.sandbox.push.apple.com"
-            logger.debug('Connecting to %s' % addr[0])
-            s.connect_ex(tuple(addr))
-
-            self._feedback_connection = s
-
-    def _error_loop(self):
-        self._error_greenlet = gevent.getcurrent()
+                                                self._error_loop, connection)
+
+    def _connect(self, address, session=None):
+        """
+        Returns a TLS connection to ``address``, authenticated by the
+        certificate, resuming the TLS ``session`` if given.
+        """
+        if self._ssl_context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.load_cert_chain(self._sslargs['certfile'],
+                                    self._sslargs.get('keyfile'))
+            self._ssl_context = context
+        logger.debug('Connecting to %s' % address[0])
+        s = socket.create_connection(address)
+        try:
+            return self._ssl_context.wrap_socket(
+                s, server_hostname=address[0], session=session)
+        except Exception:
+            s.close()
+            raise
+
+    def _error_loop(self, connection):
         try:
             while True:
-                if self._push_connection is None:
-                    break
-                msg = self._push_connection.recv(1 + 1 + 4)
+                msg = connection.recv(1 + 1 + 4)
                 if len(msg) < 6:
                     return
-                data = struct.unpack("!bbI", msg)
-                self._error_queue.put((data[1], data[2]))
+                self._handle_error_response(msg)
         except gevent.GreenletExit:
-            logger.exception('Error')
+            pass
+        except OSError:
+            # Closed by the send loop
+            pass
         finally:
-            if self._push_connection is not None:
-                self._push_connection.close()
+            connection.close()
+            # Unless the send loop already connected again, in which case
+            # the window is that of the new connection.
+            current = self._push_connection
+            if current is connection or current is None:
                 self._push_connection = None
-            self._error_greenlet = None
+                if self._failed_identifier is not None:
+                    self._requeue_after(self._failed_identifier)
+                self._sent.clear()
+            if self._error_greenlet is gevent.getcurrent():
+                self._error_greenlet = None
+
+    def _handle_error_response(self, msg):
+        _, status, identifier = struct.unpack("!bbI", msg)
+        self._failed_identifier = identifier
+        # Report the identifier the notification was queued with, not
+        # the one assigned by this service.
+        sent = self._sent.get(identifier)
+        if sent is not None:
+            identifier = sent.identifier
+        logger.error('APNS error response: status %d' % status)
+        if status != STATUS_SHUTDOWN:
+            metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'rejected')
+        self._error_queue.put((status, identifier))
+
+    def _requeue_after(self, identifier):
+        """
+        APNS drops everything that was sent after the notification that
+        caused an error response. Put those notifications back on the
+        send queue. If the identifier is no longer in the window, all
+        notifications still in the window were sent after it.
+        """
+        found = identifier not in self._sent
+        requeued = 0
+        for sent_identifier, notification in self._sent.items():
+            if found:
+                self.backlog.add(notification)
+                self._send_queue.put(notification)
+                requeued += 1
+            elif sent_identifier == identifier:
+                found = True
+        self._failed_identifier = None
+        if requeued:
+            metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'resent',
+                                           amount=requeued)
+            logger.info('Requeued %d notifications sent after %d' % (
+                requeued, identifier))
 
     def _feedback_loop(self):
-        self._feedback_greenlet = gevent.getcurrent()
+        while True:
+            try:
+                self._read_feedback()
+            except (OSError, ssl.SSLError):
+                logger.exception('Error reading APNS feedback')
+            gevent.sleep(self.feedback_interval)
+
+    def _read_feedback(self):
+        """
+        Reads all feedback tuples, until APNS closes the connection.
+        """
+        conn = self._connect(self.feedback, self._feedback_session)
+        buf = bytearray()
+        chunk = bytearray(FEEDBACK_BUFFER_SIZE)
+        view = memoryview(chunk)
         try:
-            self._check_feedback_connection()
             while True:
-                msg = self._feedback_connection.recv(4 + 2 + 32)
-                if len(msg) < 38:
-                    return
-                data = struct.unpack("!IH32s", msg)
-                token = binascii.b2a_hex(data[2]).decode('ascii')
-                self._feedback_queue.put((data[0], token))
-        except gevent.GreenletExit:
-            logger.exception('Error')
+                n = conn.recv_into(chunk)
+                if not n:
+                    break
+                buf += view[:n]
+                for feedback in parse_feedback(buf):
+                    self._feedback_queue.put(feedback)
+            self._feedback_session = conn.session
         finally:
-            if self._feedback_connection:
-                self._feedback_connection.close()
-                self._feedback_connection = None
-            self._feedback_greenlet = None
+            conn.close()
+        if buf:
+            logger.warning('Discarding incomplete APNS feedback tuple')
 
     def queue_notification(self, obj):
         """Send a push notification"""
         if not isinstance(obj, APNSNotification):
             raise ValueError(u"You can only send APNSNotification objects.")
-        self._send_queue.put(obj)
+        self.backlog.add(obj)
+        if not self.collapse(obj):
+            self._send_queue.put(obj)
 
     def get_error(self, block=True, timeout=None):
         """
@@ -154,10 +303,8 @@ class APNSService(BaseService):
         """
         Get the next feedback message.
 
-        Each feedback message is a 2-tuple of (timestamp, device_token)."""
-        if self._feedback_greenlet is None:
-            self._feedback_greenlet = gevent.spawn(self.save_err,
-                                                   self._feedback_loop)
+        Each feedback message is a ``Feedback`` tuple of (timestamp,
+        device_token, event, canonical_token)."""
         return self._feedback_queue.get(
             block=block,
             timeout=timeout)
@@ -165,7 +312,8 @@ class APNSService(BaseService):
     def stop(self, timeout=10.0):
         """
         Send all pending messages, close connection.
-        Returns True if no message left to sent. False if dirty.
+        Returns True if no message left to sent. False if dirty, which
+        includes notifications still waiting to be retried.
 
         - timeout: seconds to wait for sending remaining messages. disconnect
           immediately if None.
@@ -177,6 +325,7 @@ class APNSService(BaseService):
         if self._send_greenlet is not None:
             gevent.kill(self._send_greenlet)
             self._send_greenlet = None
+        self.retry.stop()
 
         if self._error_greenlet is not None:
             gevent.kill(self._error_greenlet)
@@ -185,27 +334,82 @@ class APNSService(BaseService):
             gevent.kill(self._feedback_greenlet)
             self._feedback_greenlet = None
 
-        return self._send_queue.qsize() < 1
+        return self._send_queue.qsize() < 1 and not len(self.retry)
 
     def wait_send(self, timeout=None):
         self._send_queue_cleared.clear()
         return self._send_queue_cleared.wait(timeout=timeout)
 
     def error_sending_notification(self, notification):
+        self.error_sending_notifications([notification])
+
+    def error_sending_notifications(self, notifications):
         if self._push_connection is not None:
             self._push_connection.close()
             self._push_connection = None
+        self._retry_failed(notifications)
+
+    def _retry_failed(self, notifications):
+        failed = set(id(n) for n in notifications)
+        for identifier in [
+                i for i, n in self._sent.items() if id(n) in failed]:
+            del self._sent[identifier]
         logger.exception("Error while pushing")
+        metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'retry',
+                                       amount=len(notifications))
+        for notification in notifications:
+            self.retry.schedule(notification)
+
+    def _requeue(self, notification):
         self._send_queue.put(notification)
-        gevent.sleep(self.timeout)
-        # approaching Fibonacci series
-        timeout = int(round(float(self.timeout) * 1.6))
-        self.timeout = min(timeout, MAX_TIMEOUT)
 
     def send_notification(self, notification):
+        self.send_notifications([notification])
+
+    def send_notifications(self, notifications):
+        """
+        Packs the notifications into a single buffer and writes it to the
+        gateway in one go. Frames that would exceed ``batch_max_bytes``
+        are written in a subsequent call.
+        """
         self._check_send_connection()
-        logger.debug('Sending APNS notification')
-        self._push_connection.send(notification.pack())
+        logger.debug('Sending %d APNS notifications' % len(notifications))
+        t = time.time()
+        for buf in self._pack_batch(notifications):
+            self._push_connection.sendall(buf)
+        self._batch_sent(notifications, time.time() - t)
+
+    def _pack_batch(self, notifications):
+        """
+        Assigns identifiers to the notifications, remembers them in the
+        in-flight window and returns their frames, joined into buffers of
+        at most ``batch_max_bytes`` (unless a single frame is larger).
+        """
+        buffers = []
+        frames = []
+        size = 0
+        for notification in notifications:
+            identifier = self._next_identifier
+            self._next_identifier = (identifier + 1) & 0xffffffff
+            frame = notification.pack(identifier=identifier)
+            if frames and size + len(frame) > self.batch_max_bytes:
+                buffers.append(b''.join(frames))
+                frames = []
+                size = 0
+            frames.append(frame)
+            size += len(frame)
+            self._sent[identifier] = notification
+            if len(self._sent) > self.sent_window_size:
+                self._sent.popitem(last=False)
+        buffers.append(b''.join(frames))
+        return buffers
+
+    def _batch_sent(self, notifications, duration):
+        metrics.SEND_DURATION.observe(duration, self.name, '0')
+        metrics.NOTIFICATIONS_SENT.inc(self.name, '0', 'success',
+                                       amount=len(notifications))
+        for notification in notifications:
+            self.notification_sent(notification)
 
     def save_err(self, func, *args, **kwargs):
         try:
@@ -1,2 +1,7 @@
+from .backlog import Backlog  # noqa
+from .feedback import Feedback  # noqa
+from .lanes import PRIORITIES, Lanes  # noqa
 from .notification import BaseNotification  # noqa
+from .ratelimit import RateLimiter  # noqa
+from .retry import RetryScheduler  # noqa
 from .service import BaseService  # noqa
@@ -0,0 +1,53 @@
+import asyncio
+
+from .lanes import Lanes
+from .retry import RetryScheduler
+
+
+class SendQueue(asyncio.Queue):
+    """
+    Unbounded asyncio queue whose ``put()`` does not need to be awaited,
+    like the gevent queues used by the gevent based services. This lets
+    the asyncio services share the queueing code of the gevent ones.
+    Notifications are taken from priority ``lanes``.
+    """
+
+    def __init__(self, lanes=None):
+        self.lanes = lanes if lanes is not None else Lanes()
+        super(SendQueue, self).__init__()
+
+    def _init(self, maxsize):
+        self._queue = self.lanes
+
+    def put(self, item):
+        self.put_nowait(item)
+
+
+class AsyncRetryScheduler(RetryScheduler):
+    """``RetryScheduler`` running its timer as an asyncio task."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncRetryScheduler, self).__init__(*args, **kwargs)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self):
+        try:
+            while True:
+                timeout = self.run_due()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
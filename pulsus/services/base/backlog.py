@@ -0,0 +1,91 @@
+import math
+import time
+
+
+# Smoothing factor of the drain rate moving average.
+RATE_ALPHA = 0.2
+DEFAULT_RETRY_AFTER = 5
+MAX_RETRY_AFTER = 60
+
+
+class Backlog(object):
+    """
+    Keeps track of the number and size of notifications queued by a
+    service, and of the rate at which the service manages to get rid of
+    them. Either limit may be None, meaning unbounded.
+    """
+
+    def __init__(self, max_count=None, max_bytes=None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.bytes = 0
+        self.rate = 0.0
+        self._rate_started = time.time()
+        self._rate_count = 0
+
+    @property
+    def full(self):
+        return ((self.max_count is not None and
+                 self.count >= self.max_count) or
+                (self.max_bytes is not None and
+                 self.bytes >= self.max_bytes))
+
+    def fits(self, count, size):
+        """
+        Returns whether ``count`` more notifications, of ``size`` bytes in
+        total, can be queued without going over the limits.
+        """
+        return ((self.max_count is None or
+                 self.count + count <= self.max_count) and
+                (self.max_bytes is None or
+                 self.bytes + size <= self.max_bytes))
+
+    def add(self, notification):
+        if not notification.queued_size:
+            notification.queued_size = notification.size()
+        self.count += notification.queued_count
+        self.bytes += notification.queued_size
+
+    def remove(self, notification):
+        self.count = max(0, self.count - notification.queued_count)
+        self.bytes = max(0, self.bytes - notification.queued_size)
+        self._rate_count += notification.queued_count
+        now = time.time()
+        if now - self._rate_started >= 1.0:
+            self.rate = self.current_rate(now)
+            self._rate_started = now
+            self._rate_count = 0
+
+    def current_rate(self, now=None):
+        """
+        Returns the drain rate, including the notifications removed since
+        it was last updated. The longer ago that was, the more weight
+        they get, as if it had been updated every second meanwhile, so
+        that the rate decays while the service stalls.
+        """
+        elapsed = (now or time.time()) - self._rate_started
+        if elapsed < 1.0:
+            return self.rate
+        decay = (1 - RATE_ALPHA) ** int(elapsed)
+        return (decay * self.rate +
+                (1 - decay) * self._rate_count / elapsed)
+
+    def retry_after(self, count=1, size=0):
+        """
+        Returns the number of seconds, based on the current drain rate,
+        until ``count`` more notifications, of ``size`` bytes, are
+        expected to fit.
+        """
+        rate = self.current_rate()
+        if rate <= 0:
+            return DEFAULT_RETRY_AFTER
+        excess = 1
+        if self.max_count is not None:
+            excess = max(excess, self.count + count - self.max_count)
+        if self.max_bytes is not None and self.bytes:
+            average = float(self.bytes) / max(self.count, 1)
+            excess = max(excess,
+                         (self.bytes + size - self.max_bytes) / average)
+        return int(min(MAX_RETRY_AFTER,
+                       max(1, math.ceil(excess / rate))))
@@ -0,0 +1,22 @@
+from collections import namedtuple
+
+
+# Feedback events
+INVALID_TOKEN = 'invalid_token'
+CANONICAL_ID = 'canonical_id'
+
+
+class Feedback(namedtuple('Feedback',
+                          'timestamp token event canonical_token')):
+    """
+    Feedback reported by a push service about a device token. For
+    ``CANONICAL_ID`` events, ``canonical_token`` is the token that
+    replaces ``token``.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, timestamp, token, event=INVALID_TOKEN,
+                canonical_token=None):
+        return super(Feedback, cls).__new__(
+            cls, timestamp, token, event, canonical_token)
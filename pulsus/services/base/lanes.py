@@ -0,0 +1,160 @@
+import time
+from collections import deque
+
+from gevent.queue import JoinableQueue, Queue
+
+from ... import metrics
+
+
+# Priorities a notification can be sent with, highest first. The
+# notifications of each priority are queued in a lane of their own.
+PRIORITIES = ('high', 'normal', 'low')
+DEFAULT_PRIORITY = 'normal'
+# Share of the notifications taken from each lane, relative to the
+# other lanes holding notifications at the time.
+PRIORITY_WEIGHTS = {'high': 16, 'normal': 4, 'low': 1}
+
+
+def check_priority(priority):
+    """
+    Raises ValueError for an unknown priority. None stands for the
+    default priority.
+    """
+    if priority is not None and priority not in PRIORITIES:
+        raise ValueError('Unknown priority: %s' % priority)
+
+
+class Lanes(object):
+    """
+    Storage of a send queue, in place of the deque of gevent and asyncio
+    queues, keeping a FIFO lane per priority. Notifications are taken
+    from the lanes by smooth weighted round robin: while several lanes
+    hold notifications, each lane gets its share according to
+    ``weights``, spread evenly rather than in bursts, so that a bulk
+    broadcast neither holds up urgent notifications nor is starved by
+    them. The time notifications waited is recorded per lane for the
+    service ``name``.
+
+    With ``collapse`` set, queued notifications are indexed by their
+    collapse keys, so that a newer notification can take their place
+    (see ``collapse()``).
+    """
+
+    def __init__(self, name=None, weights=None, collapse=False):
+        self.name = name
+        self.weights = dict(PRIORITY_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        # priority -> deque of [queued at, notification, priority]
+        self._lanes = dict((priority, deque()) for priority in PRIORITIES)
+        self._current = dict((priority, 0) for priority in PRIORITIES)
+        self._length = 0
+        # (token, collapse key) -> entry of the notification queued last
+        self._collapsible = {} if collapse else None
+
+    def __len__(self):
+        return self._length
+
+    def depth(self, priority):
+        return len(self._lanes[priority])
+
+    def append(self, notification):
+        priority = (getattr(notification, 'priority', None) or
+                    DEFAULT_PRIORITY)
+        entry = [time.time(), notification, priority]
+        self._lanes[priority].append(entry)
+        self._length += 1
+        if self._collapsible is not None:
+            for key in notification.collapse_keys():
+                self._collapsible[key] = entry
+
+    def popleft(self):
+        if not self._length:
+            raise IndexError('pop from empty lanes')
+        priority = self._next_priority()
+        lane = self._lanes[priority]
+        entry = lane.popleft()
+        queued_at, notification, _ = entry
+        self._length -= 1
+        if self._collapsible is not None:
+            for key in notification.collapse_keys():
+                if self._collapsible.get(key) is entry:
+                    del self._collapsible[key]
+        if not lane:
+            # No credit (or debt) carried over to its next burst
+            self._current[priority] = 0
+        if self.name is not None:
+            metrics.QUEUE_WAIT.observe(time.time() - queued_at, self.name,
+                                       priority)
+        return notification
+
+    def collapse(self, notification):
+        """
+        Removes the devices ``notification`` is sent to from the queued
+        notifications with the same collapse key. A queued notification
+        of the same priority to the one device is replaced, in place and
+        keeping its turn, by ``notification`` if it is sent to that device
+        only, and returned. Otherwise returns None, and ``notification``
+        is to be queued.
+        """
+        if self._collapsible is None:
+            return None
+        keys = notification.collapse_keys()
+        priority = notification.priority or DEFAULT_PRIORITY
+        replaced = None
+        merged = 0
+        for token, collapse_key in keys:
+            entry = self._collapsible.get((token, collapse_key))
+            if entry is None:
+                continue
+            queued = entry[1]
+            if any(t != token for t in queued.tokens()):
+                queued.drop_tokens([token])
+                del self._collapsible[(token, collapse_key)]
+                merged += 1
+            elif len(keys) == 1 and entry[2] == priority:
+                replaced = queued
+                entry[1] = notification
+        if self.name is not None:
+            if replaced is not None:
+                metrics.NOTIFICATIONS_COLLAPSED.inc(self.name, 'replaced')
+            if merged:
+                metrics.NOTIFICATIONS_COLLAPSED.inc(self.name, 'merged',
+                                                    amount=merged)
+        return replaced
+
+    def _next_priority(self):
+        best = None
+        total = 0
+        for priority in PRIORITIES:
+            if self._lanes[priority]:
+                weight = self.weights[priority]
+                self._current[priority] += weight
+                total += weight
+                if (best is None or
+                        self._current[priority] > self._current[best]):
+                    best = priority
+        self._current[best] -= total
+        return best
+
+
+class LaneQueue(Queue):
+    """gevent queue taking notifications from priority ``Lanes``."""
+
+    def __init__(self, lanes=None):
+        self.lanes = lanes if lanes is not None else Lanes()
+        super(LaneQueue, self).__init__()
+
+    def _create_queue(self, items=()):
+        return self.lanes
+
+
+class JoinableLaneQueue(JoinableQueue):
+    """Joinable variant of ``LaneQueue``."""
+
+    def __init__(self, lanes=None):
+        self.lanes = lanes if lanes is not None else Lanes()
+        super(JoinableLaneQueue, self).__init__()
+
+    def _create_queue(self, items=()):
+        return self.lanes
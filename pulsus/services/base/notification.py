@@ -1,26 +1,110 @@
+from .lanes import check_priority
+
+
 class BaseNotification(object):
 
+    __slots__ = ('app', 'priority', 'journal_offsets', 'queued_count',
+                 'queued_size', 'attempts')
+
     service_type = None
     notification_type = None
 
+    # (service_type, notification_type) -> notification class
+    _registry = {}
+
+    def __init__(self):
+        # Id of the app the notification is sent for, selecting the
+        # service (certificate or API key) it is sent with. None for the
+        # default app.
+        self.app = None
+        # Priority lane (high, normal or low) the notification is queued
+        # in, None for the default (normal).
+        self.priority = None
+        # Offsets of the journal records this notification originates
+        # from.
+        self.journal_offsets = ()
+        # Number of notifications, and bytes, accounted for in the
+        # backlog of the service this notification is queued at.
+        self.queued_count = 1
+        self.queued_size = 0
+        # Number of failed attempts to send this notification.
+        self.attempts = 0
+
+    @classmethod
+    def register(cls, notification_class):
+        """
+        Class decorator, registering the class for deserialization. The
+        first class registered for a service type also handles data
+        that does not specify a notification type (kind).
+        """
+        registry = BaseNotification._registry
+        service_type = notification_class.service_type
+        registry[(service_type, notification_class.notification_type)] = \
+            notification_class
+        registry.setdefault((service_type, None), notification_class)
+        return notification_class
+
     def serialize_data(self):
         raise NotImplementedError()
 
+    def tokens(self):
+        """
+        Returns the device tokens the notification is sent to.
+        """
+        raise NotImplementedError()
+
+    def drop_tokens(self, tokens):
+        """
+        Stops sending the notification to the given device tokens. Only
+        called for some, not all, of the notification's tokens.
+        """
+        raise NotImplementedError()
+
+    def collapse_keys(self):
+        """
+        Returns a (token, collapse key) pair for each device token that
+        only needs the most recent of the notifications with the same
+        collapse key, if any.
+        """
+        return ()
+
+    def expired(self, now):
+        """
+        Returns True if the notification is no longer worth sending.
+        """
+        return False
+
+    def size(self):
+        """
+        Returns the (approximate) number of bytes this notification
+        takes up on the wire.
+        """
+        raise NotImplementedError()
+
     def serialize(self):
         ret = {'data': self.serialize_data()}
         ret['type'] = self.service_type
         if self.notification_type:
             ret['kind'] = self.notification_type
+        if self.app is not None:
+            ret['app'] = self.app
+        if self.priority is not None:
+            ret['priority'] = self.priority
         return ret
 
     @classmethod
     def deserialize(cls, data):
-        # FIXME: Something hardcoded for now, to be
-        # be replaced
-        from ..apns import APNSNotification
-        from ..gcm import GCMJSONMessage
-
-        if data['type'] == APNSNotification.service_type:
-            return APNSNotification.deserialize_data(data['data'])
-        elif data['type'] == GCMJSONMessage.service_type:
-            return GCMJSONMessage.deserialize_data(data['data'])
+        """
+        Returns the notification for the serialized data. Raises
+        ValueError for an unknown type of notification or priority.
+        """
+        priority = data.get('priority')
+        check_priority(priority)
+        notification_class = BaseNotification._registry.get(
+            (data['type'], data.get('kind')))
+        if notification_class is None:
+            raise ValueError('Unknown notification type')
+        notification = notification_class.deserialize_data(data['data'])
+        notification.app = data.get('app')
+        notification.priority = priority
+        return notification
@@ -0,0 +1,180 @@
+import time
+
+from ... import metrics
+
+
+# Seconds worth of tokens a bucket holds at most.
+BURST = 1.0
+# Factor a rate is cut by when the push service throttles, at most once
+# per ADJUST_INTERVAL seconds, as the responses to requests already in
+# flight report the same throttling.
+THROTTLE_FACTOR = 0.5
+# Share of its limit a cut rate recovers by, per ADJUST_INTERVAL seconds
+# without throttling.
+RECOVERY_STEP = 0.05
+ADJUST_INTERVAL = 1.0
+# Lowest share of its limit a rate is cut to.
+MIN_SHARE = 0.05
+# Smoothing factor of the measured rates.
+RATE_ALPHA = 0.5
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at ``rate`` tokens per second, up to ``burst``
+    seconds worth of tokens. The rate is cut when the push service
+    throttles, and recovers up to ``limit`` while it does not.
+    """
+
+    def __init__(self, limit, burst=BURST):
+        self.limit = self.rate = float(limit)
+        self.burst = burst
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._adjusted = 0.0
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate * self.burst)
+
+    def reserve(self, amount=1):
+        """
+        Takes ``amount`` tokens, and returns the number of seconds to
+        wait before using them. Tokens not available yet are borrowed
+        from the future, so that a large amount is not held up forever.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def throttle(self):
+        now = time.monotonic()
+        if now - self._adjusted < ADJUST_INTERVAL:
+            return
+        self.rate = max(self.limit * MIN_SHARE, self.rate * THROTTLE_FACTOR)
+        self.tokens = min(self.tokens, self.capacity)
+        self._adjusted = now
+
+    def recover(self):
+        now = time.monotonic()
+        if self.rate >= self.limit or now - self._adjusted < ADJUST_INTERVAL:
+            return
+        self.rate = min(self.limit, self.rate + self.limit * RECOVERY_STEP)
+        self._adjusted = now
+
+
+class RateLimiter(object):
+    """
+    Limits the requests per second a service makes, and the recipients
+    (device tokens) per second they are sent to, each by a
+    ``TokenBucket``. Either limit may be None, meaning unlimited, until
+    the push service throttles: the limit is then learned from the rate
+    measured at the time, and the rate kept below it. Throttling is
+    counted for the service ``name``.
+    """
+
+    def __init__(self, max_request_rate=None, max_recipient_rate=None,
+                 name=None):
+        self.name = name
+        self.requests = None
+        self.recipients = None
+        self.configure(max_request_rate, max_recipient_rate)
+        self.throttle_count = 0
+        # Measured rates
+        self.request_rate = 0.0
+        self.recipient_rate = 0.0
+        self._window_started = time.monotonic()
+        self._window_requests = 0
+        self._window_recipients = 0
+
+    def configure(self, max_request_rate=None, max_recipient_rate=None):
+        """
+        Sets the limits, None meaning unlimited.
+        """
+        self.requests = None
+        if max_request_rate:
+            self.requests = TokenBucket(max_request_rate)
+        self.recipients = None
+        if max_recipient_rate:
+            self.recipients = TokenBucket(max_recipient_rate)
+
+    def reserve(self, recipients=1, requests=1):
+        """
+        Returns the number of seconds to wait before sending ``requests``
+        requests to ``recipients`` recipients.
+        """
+        self._measure(requests, recipients)
+        delay = 0
+        if self.requests is not None:
+            delay = self.requests.reserve(requests)
+        if self.recipients is not None:
+            delay = max(delay, self.recipients.reserve(recipients))
+        return delay
+
+    def _measure(self, requests, recipients):
+        self._window_requests += requests
+        self._window_recipients += recipients
+        now = time.monotonic()
+        elapsed = now - self._window_started
+        if elapsed >= ADJUST_INTERVAL:
+            self.request_rate = (RATE_ALPHA * self._window_requests /
+                                 elapsed +
+                                 (1 - RATE_ALPHA) * self.request_rate)
+            self.recipient_rate = (RATE_ALPHA * self._window_recipients /
+                                   elapsed +
+                                   (1 - RATE_ALPHA) * self.recipient_rate)
+            self._window_started = now
+            self._window_requests = 0
+            self._window_recipients = 0
+
+    def throttled(self):
+        """
+        Called when the push service reports being sent too much.
+        """
+        self.throttle_count += 1
+        if self.name is not None:
+            metrics.THROTTLED.inc(self.name)
+        if self.requests is None and self.request_rate:
+            self.requests = TokenBucket(self.request_rate)
+        if self.recipients is None and self.recipient_rate:
+            self.recipients = TokenBucket(self.recipient_rate)
+        for bucket in (self.requests, self.recipients):
+            if bucket is not None:
+                bucket.throttle()
+
+    def succeeded(self):
+        """
+        Called when the push service accepted a request.
+        """
+        for bucket in (self.requests, self.recipients):
+            if bucket is not None:
+                bucket.recover()
+
+    def allowed_rate(self, unit):
+        """
+        Returns the rate of ``unit`` (request or recipient) currently
+        allowed, infinite if unlimited.
+        """
+        bucket = self.requests if unit == 'request' else self.recipients
+        return bucket.rate if bucket is not None else float('inf')
+
+    def state(self):
+        """
+        Returns the limits, the rates currently allowed and measured, and
+        the number of times the service was throttled.
+        """
+        state = dict(throttled=self.throttle_count)
+        for unit, bucket, measured in [
+                ('request', self.requests, self.request_rate),
+                ('recipient', self.recipients, self.recipient_rate)]:
+            state['max_%s_rate' % unit] = (
+                bucket.limit if bucket is not None else None)
+            state['allowed_%s_rate' % unit] = (
+                bucket.rate if bucket is not None else None)
+            state['%s_rate' % unit] = measured
+        return state
@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import gevent
+from gevent.event import Event
+
+
+# Number of attempts after which a notification is given up on.
+MAX_ATTEMPTS = 8
+# Delay before the first retry, doubling with every further attempt.
+INITIAL_DELAY = 1.0
+MAX_DELAY = 600
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetryScheduler(object):
+    """
+    Holds notifications that failed to be sent until they are due to be
+    retried, so that the send loops never have to sleep and healthy
+    traffic keeps flowing. Notifications are kept in a heap ordered by
+    the time they are due, at which point they are handed to
+    ``requeue``. The delay doubles with every attempt, up to
+    ``max_delay``, and is jittered so that the notifications of a failed
+    batch are not retried all at once. Notifications that expired, or
+    failed ``max_attempts`` times, are handed to
+    ``dead_letter(notification, reason)`` instead.
+    """
+
+    def __init__(self, requeue, dead_letter, max_attempts=MAX_ATTEMPTS,
+                 initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+        self.requeue = requeue
+        self.dead_letter = dead_letter
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._heap = []
+        # Tie breaker, notifications themselves are not comparable
+        self._counter = itertools.count()
+        self._wakeup = Event()
+        self._greenlet = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def delay(self, attempts):
+        """
+        Returns the jittered delay before the given attempt (1 being the
+        first retry).
+        """
+        delay = min(self.max_delay,
+                    self.initial_delay * 2 ** min(attempts - 1, 32))
+        return random.uniform(delay / 2, delay)
+
+    def schedule(self, notification, reason='error', delay=None):
+        """
+        Schedules the failed notification to be retried, after ``delay``
+        seconds if given (e.g. by a Retry-After header). Returns False if
+        it was given up on instead.
+        """
+        notification.attempts += 1
+        now = time.time()
+        if notification.expired(now):
+            self.dead_letter(notification, 'expired')
+            return False
+        if notification.attempts >= self.max_attempts:
+            logger.warning("Giving up on notification after %d attempts"
+                           " (%s)" % (notification.attempts, reason))
+            self.dead_letter(notification, reason)
+            return False
+        if delay is None:
+            delay = self.delay(notification.attempts)
+        due = now + delay
+        heapq.heappush(self._heap, (due, next(self._counter), notification))
+        if self._heap[0][2] is notification:
+            self._wakeup.set()
+        return True
+
+    def run_due(self):
+        """
+        Requeues the notifications that are due. Returns the number of
+        seconds until the next one is, or None if none is scheduled.
+        """
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            notification = heapq.heappop(self._heap)[2]
+            if notification.expired(now):
+                self.dead_letter(notification, 'expired')
+            else:
+                self.requeue(notification)
+        if self._heap:
+            return self._heap[0][0] - now
+        return None
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._loop)
+
+    def stop(self):
+        if self._greenlet is not None:
+            gevent.kill(self._greenlet)
+            self._greenlet = None
+
+    def _loop(self):
+        try:
+            while True:
+                timeout = self.run_due()
+                self._wakeup.clear()
+                self._wakeup.wait(timeout)
+        except gevent.GreenletExit:
+            pass
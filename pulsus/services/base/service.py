@@ -1,9 +1,62 @@
 from abc import ABCMeta, abstractmethod
 
+from ... import metrics
+
+
+def service_name(kind, app=None):
+    """
+    Returns the name of the service of the given kind (apns, apns_sandbox
+    or gcm) for an app, as used in metrics.
+    """
+    if app is None:
+        return kind
+    return '%s:%s' % (kind, app)
+
 
 class BaseService(object):
     __metaclass__ = ABCMeta
 
+    # Id of the app the service sends notifications for, None for the
+    # default app.
+    app = None
+    # Whether the service sends to the APNS sandbox.
+    sandbox = False
+    # Priority ``Lanes`` of the send queue.
+    lanes = None
+    # ``RateLimiter`` of the requests to the push service.
+    rate_limiter = None
+
+    # Optional callable, invoked with each notification that was handed
+    # over to the push service, or superseded by a newer one.
+    on_sent = None
+    # Optional callable, invoked with each notification that was given up
+    # on, and the reason why.
+    on_failed = None
+
+    def notification_sent(self, notification):
+        self.backlog.remove(notification)
+        if self.on_sent is not None:
+            self.on_sent(notification)
+
+    def collapse(self, notification):
+        """
+        Has the notification take the place of a queued one it supersedes,
+        if collapsing is enabled (see ``Lanes.collapse()``). Returns True
+        if it did, and is thereby queued.
+        """
+        replaced = self.lanes.collapse(notification)
+        if replaced is None:
+            return False
+        self.notification_sent(replaced)
+        return True
+
+    def notification_failed(self, notification, reason):
+        self.backlog.remove(notification)
+        metrics.NOTIFICATIONS_DEAD_LETTERED.inc(
+            self.name, reason, amount=notification.queued_count)
+        if self.on_failed is not None:
+            self.on_failed(notification, reason)
+
     @abstractmethod
     def start(self):
         pass
@@ -21,6 +74,7 @@ class BaseService(object):
         """
         Get the next feedback message.
 
-        Each feedback message is a 2-tuple of (timestamp, device_token).
+        Each feedback message is a ``Feedback`` tuple of (timestamp,
+        device_token, event, canonical_token).
         """
         pass
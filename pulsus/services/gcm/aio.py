@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import queue
+import time
+
+from ..base.aio import AsyncRetryScheduler, SendQueue
+from .service import GCMService, GCMServiceWorker, SCALE_INTERVAL
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGCMServiceWorker(GCMServiceWorker):
+    """
+    asyncio variant of ``GCMServiceWorker``. The blocking HTTP request
+    is run in the default executor; everything else runs on the event
+    loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('send_queue', SendQueue())
+        super(AsyncGCMServiceWorker, self).__init__(*args, **kwargs)
+        self._send_task = None
+
+    def start(self):
+        """Start the message sending loop."""
+        self._send_task = asyncio.ensure_future(self._send_loop())
+
+    async def stop(self, timeout=10.0):
+        clean = True
+        if self._send_task is not None:
+            clean = await join(self._send_queue, timeout)
+        self.kill()
+        return clean
+
+    def kill(self):
+        if self._send_task is not None:
+            self._send_task.cancel()
+            self._send_task = None
+
+    async def _send_loop(self):
+        logger.info("GCM service started: worker %d (asyncio)" % (
+            self.worker_id))
+        try:
+            while True:
+                message = await self._send_queue.get()
+                self.busy = True
+                try:
+                    await self.send_notification(message)
+                except Exception as e:
+                    self.error_sending_notification(message, e)
+                finally:
+                    self.busy = False
+                    self._send_queue.task_done()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.last_err = e
+            raise
+        logger.info("GCM service stopped: worker %d (asyncio)" % (
+            self.worker_id))
+
+    async def send_notification(self, message):
+        delay = self._rate_limit_delay(message)
+        if delay:
+            await asyncio.sleep(delay)
+        t = time.time()
+        loop = asyncio.get_event_loop()
+        resp = await loop.run_in_executor(None, self.post, message)
+        self.handle_response(message, resp, time.time() - t)
+
+
+def call_later(delay, func, *args):
+    return asyncio.get_event_loop().call_later(delay, func, *args)
+
+
+async def join(queue, timeout):
+    """
+    Waits at most ``timeout`` seconds for all items of the queue to be
+    processed. Returns True if they were.
+    """
+    try:
+        await asyncio.wait_for(queue.join(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+class AsyncGCMService(GCMService):
+    """
+    asyncio implementation of the GCM service. ``stop()`` is a
+    coroutine, and ``get_feedback()`` is non-blocking. It must be
+    started from within a running event loop.
+    """
+
+    retry_scheduler_class = AsyncRetryScheduler
+
+    def __init__(self, api_key, **kwargs):
+        super(AsyncGCMService, self).__init__(api_key, **kwargs)
+        self.feedback_queue = queue.Queue()
+        self._scale_task = None
+        if self.coalescer is not None:
+            self.coalescer.call_later = call_later
+
+    def _create_queue(self):
+        return SendQueue(self.lanes)
+
+    def _create_worker(self, worker_id):
+        return AsyncGCMServiceWorker(worker_id, self.api_key,
+                                     self.feedback_queue,
+                                     sent_callback=self.notification_sent,
+                                     send_queue=self._send_queue,
+                                     latency_callback=self._observe_latency,
+                                     retry_callback=self.retry.schedule,
+                                     canonical_ids=self.canonical_ids,
+                                     name=self.name, session=self.session,
+                                     url=self.url,
+                                     rate_limiter=self.rate_limiter)
+
+    def get_feedback(self, block=False, timeout=None):
+        """
+        Get the next feedback message, raising queue.Empty if there is
+        none.
+        """
+        return self.feedback_queue.get_nowait()
+
+    async def _scale_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(SCALE_INTERVAL)
+                self.scale(SCALE_INTERVAL)
+        except asyncio.CancelledError:
+            pass
+
+    def start(self):
+        for i in range(self.min_workers):
+            self._spawn_worker()
+        self._scale_task = asyncio.ensure_future(self._scale_loop())
+        self.retry.start()
+
+    async def stop(self, timeout=10.0):
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        if self._scale_task is not None:
+            self._scale_task.cancel()
+            self._scale_task = None
+        clean = await join(self._send_queue, timeout)
+        self.retry.stop()
+        for worker in list(self.workers.values()):
+            self._retire_worker(worker)
+        return clean and not len(self.retry)
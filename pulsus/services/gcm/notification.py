@@ -4,39 +4,73 @@ from ..base.notification import BaseNotification
 
 class GCMMessage(BaseNotification):
 
+    __slots__ = ()
+
     service_type = 'gcm'
 
 
+@BaseNotification.register
 class GCMJSONMessage(GCMMessage):
 
+    __slots__ = ('data',)
+
     service_type = 'gcm'
     notification_type = 'json'
 
+    OPTIONAL = frozenset([
+        'collapse_key',
+        'time_to_live',
+        'delay_while_idle',
+        'restricted_package_name',
+        'data',
+        'dry_run',
+        'priority'])
+
     def __init__(self, registration_ids, **kwargs):
-        optional = [
-            'collapse_key',
-            'time_to_live',
-            'delay_while_idle',
-            'restricted_package_name',
-            'data',
-            'dry_run',
-            'priority']
-        self.data = {}
-        for k, v in kwargs.items():
-            assert k in optional
-            self.data[k] = v
-        self.data['registration_ids'] = registration_ids
+        super(GCMJSONMessage, self).__init__()
+        if not self.OPTIONAL.issuperset(kwargs):
+            raise ValueError(u"Unsupported GCM fields: %s" % ', '.join(
+                sorted(set(kwargs) - self.OPTIONAL)))
+        kwargs['registration_ids'] = registration_ids
+        self.data = kwargs
 
     @property
     def registration_ids(self):
         return self.data['registration_ids']
 
+    def tokens(self):
+        return self.registration_ids
+
+    def collapse_keys(self):
+        collapse_key = self.data.get('collapse_key')
+        if collapse_key is None:
+            return ()
+        return [(i, collapse_key) for i in self.registration_ids]
+
+    def drop_tokens(self, tokens):
+        self.data['registration_ids'] = [
+            i for i in self.registration_ids if i not in tokens]
+
+    def with_registration_ids(self, registration_ids):
+        """
+        Returns a copy of the message, sent to other registration IDs.
+        """
+        data = dict(self.data)
+        data['registration_ids'] = registration_ids
+        message = GCMJSONMessage(**data)
+        message.app = self.app
+        message.priority = self.priority
+        return message
+
     def serialize_data(self):
         return self.data
 
     @classmethod
     def deserialize_data(cls, data):
-        return GCMJSONMessage(**data)
+        return cls(**data)
+
+    def size(self):
+        return len(self.pack())
 
     def pack(self):
         return json.dumps(self.data)
@@ -1,51 +1,182 @@
+import json
 import logging
+import math
 import requests
 import time
-from datetime import datetime
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
 
 import gevent
-from gevent.event import Event
-from gevent.queue import Queue
-
-from ..base.service import BaseService
+from gevent.queue import JoinableQueue, Queue
+from requests.adapters import HTTPAdapter
+
+from ... import metrics
+from ..base.backlog import Backlog
+from ..base.feedback import CANONICAL_ID, Feedback
+from ..base.lanes import JoinableLaneQueue, Lanes
+from ..base.ratelimit import RateLimiter
+from ..base.retry import MAX_ATTEMPTS, RetryScheduler
+from ..base.service import BaseService, service_name
+from .notification import GCMJSONMessage
+
+
+GCM_URL = "https://fcm.googleapis.com/fcm/send"
+# Bounds of the number of concurrent requests to GCM.
+MIN_WORKERS = 2
+MAX_WORKERS = 50
+# Seconds between adjusting the number of workers.
+SCALE_INTERVAL = 1.0
+# Request latency assumed until one has been observed, and smoothing
+# factor of its moving average.
+INITIAL_LATENCY = 0.1
+LATENCY_ALPHA = 0.2
+# Maximum number of registration IDs GCM accepts in a single request.
+MAX_REGISTRATION_IDS = 1000
+# Seconds to wait for more messages with an identical payload.
+COALESCE_LINGER = 0.05
+# Connections to GCM kept alive by a session shared by several services.
+SHARED_POOL_SIZE = MAX_WORKERS
+
+# Errors after which a registration ID will not work again.
+INVALID_REGISTRATION_ERRORS = ('NotRegistered', 'InvalidRegistration')
+# Errors after which the message should be sent again later.
+RETRIABLE_ERRORS = ('Unavailable', 'InternalServerError',
+                    'DeviceMessageRateExceeded')
+# Responses, and errors, telling that GCM is sent too much.
+THROTTLING_STATUSES = (429, 503)
+THROTTLING_ERRORS = ('DeviceMessageRateExceeded',
+                     'TopicsMessageRateExceeded')
 
+logger = logging.getLogger(__name__)
 
-INITIAL_TIMEOUT = 5
-MAX_TIMEOUT = 600
-WORKER_COUNT = 20
 
-logger = logging.getLogger(__name__)
+class GCMUnavailable(Exception):
+
+    def __init__(self, status, retry_after=None):
+        super(GCMUnavailable, self).__init__(
+            'GCM responded %d' % status)
+        self.retry_after = retry_after
+
+
+def retry_after(resp):
+    """
+    Returns the number of seconds the Retry-After header of the response
+    asks to wait, or None.
+    """
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CanonicalIDMap(object):
+    """
+    Bounded, in-memory map of registration IDs to the canonical IDs GCM
+    reported for them, used to rewrite messages before they are sent.
+    The least recently updated mappings are dropped once it is full.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, registration_id, canonical_id):
+        self._ids.pop(registration_id, None)
+        self._ids[registration_id] = canonical_id
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def rewrite(self, message):
+        """
+        Replaces the registration IDs of the message that have a canonical
+        ID, dropping the duplicates this may introduce.
+        """
+        registration_ids = message.registration_ids
+        if not any(i in self._ids for i in registration_ids):
+            return
+        rewritten = []
+        seen = set()
+        for registration_id in registration_ids:
+            registration_id = self._ids.get(registration_id, registration_id)
+            if registration_id not in seen:
+                seen.add(registration_id)
+                rewritten.append(registration_id)
+        message.data['registration_ids'] = rewritten
+
+
+def shared_session(pool_size=SHARED_POOL_SIZE):
+    """
+    Returns a requests session keeping up to ``pool_size`` connections to
+    GCM alive, for the workers of several services to share.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 class GCMServiceWorker:
-
-    def __init__(self, worker_id, api_key, feedback_queue):
-        self._send_queue = Queue()
-        self._send_queue_cleared = Event()
+    """
+    Sends messages taken from a (possibly shared) send queue, one request
+    at a time. A message that fails is handed to ``retry_callback``, or
+    put back on the queue if there is none.
+    """
+
+    def __init__(self, worker_id, api_key, feedback_queue,
+                 sent_callback=None, send_queue=None, latency_callback=None,
+                 retry_callback=None, canonical_ids=None, name='gcm',
+                 session=None, url=GCM_URL, rate_limiter=None):
+        if send_queue is None:
+            send_queue = JoinableQueue()
+        self._send_queue = send_queue
         self._send_greenlet = None
-        self.timeout = INITIAL_TIMEOUT
+        self.busy = False
         self._feedback_queue = feedback_queue
         self.worker_id = worker_id
+        self._worker_label = str(worker_id)
         self.api_key = api_key
-        self.session = requests.Session()
+        self.url = url
+        self.name = name
+        if session is None:
+            session = requests.Session()
+        self.session = session
+        self._sent_callback = sent_callback
+        self._latency_callback = latency_callback
+        self._retry_callback = retry_callback
+        self._canonical_ids = canonical_ids
+        self._rate_limiter = rate_limiter
 
     def start(self):
         """Start the message sending loop."""
         self._send_greenlet = gevent.spawn(self.save_err, self._send_loop)
 
     def stop(self, timeout=10.0):
-        if (self._send_greenlet is not None) and \
-                (self._send_queue.qsize() > 0):
-            self.wait_send(timeout=timeout)
+        """
+        Sends the messages still queued, then stops the worker. Returns
+        True if no message was left unsent.
+        """
+        clean = True
+        if self._send_greenlet is not None:
+            clean = self._send_queue.join(timeout=timeout)
+        self.kill()
+        return clean
 
+    def kill(self):
+        """Stop the worker, abandoning the message being sent, if any."""
         if self._send_greenlet is not None:
             gevent.kill(self._send_greenlet)
             self._send_greenlet = None
-        return self._send_queue.qsize() < 1
-
-    def wait_send(self, timeout=None):
-        self._send_queue_cleared.clear()
-        return self._send_queue_cleared.wait(timeout=timeout)
 
     def queue_notification(self, notification):
         self._send_queue.put(notification)
@@ -56,34 +187,61 @@ class GCMServiceWorker:
                 self.worker_id))
             while True:
                 message = self._send_queue.get()
+                self.busy = True
                 try:
                     self.send_notification(message)
-                except Exception:
-                    self.error_sending_notification(message)
-                else:
-                    self.timeout = INITIAL_TIMEOUT
+                except Exception as e:
+                    self.error_sending_notification(message, e)
                 finally:
-                    if self._send_queue.qsize() < 1 and \
-                            not self._send_queue_cleared.is_set():
-                        self._send_queue_cleared.set()
+                    self.busy = False
+                    self._send_queue.task_done()
         except gevent.GreenletExit:
             pass
         logger.info("GCM service stopped: worker %d" % (
             self.worker_id))
 
+    def _rate_limit_delay(self, message):
+        if self._rate_limiter is None:
+            return 0
+        return self._rate_limiter.reserve(len(message.registration_ids))
+
     def send_notification(self, message):
+        delay = self._rate_limit_delay(message)
+        if delay:
+            gevent.sleep(delay)
         t = time.time()
+        resp = self.post(message)
+        self.handle_response(message, resp, time.time() - t)
+
+    def post(self, message):
         logger.info('Pushing GCM message...')
-        url = "https://fcm.googleapis.com/fcm/send"
         headers = {'Authorization': 'key=' + self.api_key,
                    'Content-Type': 'application/json'}
-        resp = self.session.post(
-            url,
+        return self.session.post(
+            self.url,
             data=message.pack(),
             headers=headers)
-        logger.info('...pushed GCM message, took %fs' % (time.time() - t))
+
+    def handle_response(self, message, resp, elapsed):
+        logger.info('...pushed GCM message, took %fs' % elapsed)
+        metrics.SEND_DURATION.observe(elapsed, self.name,
+                                      self._worker_label)
+        if self._latency_callback is not None:
+            self._latency_callback(elapsed)
+        if resp.status_code >= 500 or resp.status_code == 429:
+            if (self._rate_limiter is not None and
+                    resp.status_code in THROTTLING_STATUSES):
+                self._rate_limiter.throttled()
+            raise GCMUnavailable(resp.status_code, retry_after(resp))
         resp.raise_for_status()
         data = resp.json()
+        if self._rate_limiter is not None:
+            if data['failure'] and any(
+                    r.get('error') in THROTTLING_ERRORS
+                    for r in data['results']):
+                self._rate_limiter.throttled()
+            else:
+                self._rate_limiter.succeeded()
         # Example:
         # {"multicast_id":592394215791271011422,
         #  "success":1,"failure":0,"canonical_ids":0,
@@ -91,66 +249,81 @@ class GCMServiceWorker:
 
         # If the value of failure and canonical_ids is 0, it's not
         # necessary to parse the remainder of the response.
-        if not data['failure'] and not data['canonical_ids']:
+        unavailable = ()
+        if data['failure'] or data['canonical_ids']:
+            unavailable = self.handle_results(message, data['results'])
+        if unavailable:
+            self.retry_unavailable(message, unavailable, retry_after(resp))
             return
+        metrics.NOTIFICATIONS_SENT.inc(self.name, self._worker_label,
+                                       'success', amount=message.queued_count)
+        if self._sent_callback is not None:
+            self._sent_callback(message)
+
+    def handle_results(self, message, results):
+        """
+        Reports canonical IDs and invalid registration IDs as feedback,
+        and returns the registration IDs that should be retried.
+        """
         registration_ids = message.registration_ids
-        for result_i, result in enumerate(data['results']):
-            logger.info('Result: %r' % result)
-            # message_id = result['message_id']
-
-            sent_registration_id = None
-            if result_i < len(registration_ids):
-                sent_registration_id = registration_ids[result_i]
-            else:
-                logger.error('Unable to lookup sent registration_id')
-
-            registration_id = result.get('registration_id')
+        if len(results) != len(registration_ids):
+            logger.error('Unable to lookup sent registration_id')
+        now = time.time()
+        unavailable = []
+        for registration_id, result in zip(registration_ids, results):
+            canonical_id = result.get('registration_id')
             error = result.get('error')
-            if registration_id:
-                # If registration_id is set, replace the original ID
-                # with the new value (canonical ID) in your server
-                # database. Note that the original ID is not part of
-                # the result, so you need to obtain it from the list
-                # of code>registration_ids passed in the request
-                # (using the same index).
-
-                # FIXME
-                pass
-            if error:
-                if error == 'Unavailable':
-                    # If it is Unavailable, you could retry to send it in
-                    # another request.
-
-                    # FIXME
-                    pass
-                elif error == 'NotRegistered':
-                    # {u'error': u'NotRegistered'}
-
-                    # you should remove the registration ID from your
-                    # server database because the application was
-                    # uninstalled from the device or it does not have a
-                    # broadcast receiver configured to receive
-                    # com.google.android.c2dm.intent.RECEIVE intents.
-
-                    if sent_registration_id:
-                        epoch = time.mktime(datetime.now().utctimetuple())
-                        logger.info(
-                            'Marking registration ID as to be'
-                            ' removed: {}'.format(
-                                sent_registration_id))
-                        self._feedback_queue.put((
-                            epoch,
-                            sent_registration_id))
-                else:
-                    # Otherwise, there is something wrong in the
-                    # registration ID passed in the request; it is
-                    # probably a non-recoverable error that will also
-                    # require removing the registration from the server
-                    # database. See Interpreting an error response for all
-                    # possible error values.
-
-                    # FIXME
-                    pass
+            if canonical_id:
+                # The device is registered under another ID as well,
+                # which is the one to use from now on.
+                metrics.NOTIFICATIONS_SENT.inc(
+                    self.name, self._worker_label, 'canonical_id')
+                self._feedback_queue.put(Feedback(
+                    now, registration_id, CANONICAL_ID, canonical_id))
+                if self._canonical_ids is not None:
+                    self._canonical_ids.add(registration_id, canonical_id)
+            if not error:
+                continue
+            if error in RETRIABLE_ERRORS:
+                unavailable.append(registration_id)
+            elif error in INVALID_REGISTRATION_ERRORS:
+                # The app was uninstalled, or the ID is malformed.
+                metrics.NOTIFICATIONS_SENT.inc(
+                    self.name, self._worker_label, 'invalid_token')
+                logger.info('Marking registration ID as to be removed:'
+                            ' %s' % registration_id)
+                self._feedback_queue.put(Feedback(now, registration_id))
+            else:
+                # Something is wrong with the message itself, sending it
+                # again will not help.
+                metrics.NOTIFICATIONS_SENT.inc(
+                    self.name, self._worker_label, 'rejected')
+                logger.error('GCM rejected message for %s: %s' % (
+                    registration_id, error))
+        return unavailable
+
+    def retry_unavailable(self, message, registration_ids, delay=None):
+        """
+        Retries the message for the given registration IDs in a single
+        multicast. The retry takes over the journal records and backlog
+        accounting of the original message.
+        """
+        retry = message.with_registration_ids(registration_ids)
+        retry.journal_offsets = message.journal_offsets
+        retry.queued_count = message.queued_count
+        retry.queued_size = message.queued_size
+        retry.attempts = message.attempts
+        logger.info('Retrying GCM message for %d unavailable registration'
+                    ' IDs' % len(registration_ids))
+        metrics.NOTIFICATIONS_SENT.inc(self.name, self._worker_label,
+                                       'retry', amount=len(registration_ids))
+        self._retry(retry, delay)
+
+    def _retry(self, notification, delay=None):
+        if self._retry_callback is None:
+            self._send_queue.put(notification)
+        else:
+            self._retry_callback(notification, delay=delay)
 
     def save_err(self, func, *args, **kwargs):
         try:
@@ -162,23 +335,139 @@ class GCMServiceWorker:
     def get_last_error(self):
         return self.last_err
 
-    def error_sending_notification(self, notification):
+    def error_sending_notification(self, notification, error=None):
         logger.exception("Error while pushing")
-        self._send_queue.put(notification)
-        gevent.sleep(self.timeout)
-        # approaching Fibonacci series
-        timeout = int(round(float(self.timeout) * 1.6))
-        self.timeout = min(timeout, MAX_TIMEOUT)
+        metrics.NOTIFICATIONS_SENT.inc(self.name, self._worker_label,
+                                       'retry',
+                                       amount=notification.queued_count)
+        self._retry(notification, getattr(error, 'retry_after', None))
+
+
+class GCMMessageCoalescer(object):
+    """
+    Merges messages that only differ in their registration IDs into
+    multicast messages of up to ``max_ids`` registration IDs. Messages
+    are held back at most ``linger`` seconds before being dispatched.
+    """
+
+    def __init__(self, dispatch, linger=COALESCE_LINGER,
+                 max_ids=MAX_REGISTRATION_IDS, call_later=gevent.spawn_later):
+        self.dispatch = dispatch
+        self.linger = linger
+        self.max_ids = max_ids
+        self.call_later = call_later
+        self._groups = {}
+
+    def _key(self, message):
+        data = dict(message.data)
+        del data['registration_ids']
+        return message.priority, json.dumps(data, sort_keys=True)
+
+    def add(self, message):
+        key = self._key(message)
+        group = self._groups.get(key)
+        if group is not None and len(group['registration_ids']) + len(
+                message.registration_ids) > self.max_ids:
+            self._flush_group(key, group)
+            group = None
+        if group is None:
+            group = self._groups[key] = dict(data=message.data,
+                                             app=message.app,
+                                             priority=message.priority,
+                                             registration_ids=[],
+                                             journal_offsets=[],
+                                             queued_count=0,
+                                             queued_size=0)
+            self.call_later(self.linger, self._flush_group, key, group)
+        group['registration_ids'].extend(message.registration_ids)
+        group['journal_offsets'].extend(message.journal_offsets)
+        group['queued_count'] += message.queued_count
+        group['queued_size'] += message.queued_size
+        if len(group['registration_ids']) >= self.max_ids:
+            self._flush_group(key, group)
+
+    def _flush_group(self, key, group):
+        if self._groups.get(key) is not group:
+            return
+        del self._groups[key]
+        data = dict(group['data'])
+        data['registration_ids'] = group['registration_ids']
+        message = GCMJSONMessage(**data)
+        message.app = group['app']
+        message.priority = group['priority']
+        message.journal_offsets = group['journal_offsets']
+        message.queued_count = group['queued_count']
+        message.queued_size = group['queued_size']
+        self.dispatch(message)
+
+    def flush(self):
+        for key, group in list(self._groups.items()):
+            self._flush_group(key, group)
 
 
 class GCMService(BaseService):
-
-    def __init__(self, api_key):
+    """
+    Sends messages through a pool of workers sharing a single send
+    queue. The pool is resized every ``SCALE_INTERVAL`` seconds, between
+    ``min_workers`` and ``max_workers``, to the concurrency needed to
+    keep up with the incoming and queued messages at the observed
+    request latency. Failed messages are retried by a ``RetryScheduler``.
+    If ``canonical_id_map_size`` is set, registration IDs are replaced by
+    the canonical IDs GCM reported for them before being sent. Services
+    of several apps can share a ``session``, and with it the connections
+    to GCM (see ``shared_session()``).
+    """
+
+    service_type = 'gcm'
+    retry_scheduler_class = RetryScheduler
+
+    def __init__(self, api_key, coalesce_linger=COALESCE_LINGER,
+                 max_queue_count=None, max_queue_bytes=None,
+                 min_workers=MIN_WORKERS, max_workers=MAX_WORKERS,
+                 max_attempts=MAX_ATTEMPTS, canonical_id_map_size=0,
+                 app=None, session=None, url=GCM_URL, priority_weights=None,
+                 collapse=False, max_request_rate=None,
+                 max_recipient_rate=None):
+        self.app = app
+        self.url = url
+        self.name = service_name('gcm', app)
+        self.lanes = Lanes(self.name, priority_weights, collapse)
+        self.api_key = api_key
+        self.session = session
         self.feedback_queue = Queue()
-        self.workers = [
-            GCMServiceWorker(i, api_key, self.feedback_queue)
-            for i in range(WORKER_COUNT)]
-        self.next_worker = 0
+        self.backlog = Backlog(max_queue_count, max_queue_bytes)
+        self.rate_limiter = RateLimiter(max_request_rate, max_recipient_rate,
+                                        self.name)
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.workers = {}
+        self.latency = INITIAL_LATENCY
+        self._send_queue = self._create_queue()
+        self.retry = self.retry_scheduler_class(
+            self._dispatch, self.notification_failed,
+            max_attempts=max_attempts)
+        self._dispatched = 0
+        self._scale_greenlet = None
+        self.canonical_ids = None
+        if canonical_id_map_size:
+            self.canonical_ids = CanonicalIDMap(canonical_id_map_size)
+        self.coalescer = None
+        if coalesce_linger:
+            self.coalescer = GCMMessageCoalescer(
+                self._dispatch, linger=coalesce_linger)
+
+    def _create_queue(self):
+        return JoinableLaneQueue(self.lanes)
+
+    def _create_worker(self, worker_id):
+        return GCMServiceWorker(worker_id, self.api_key, self.feedback_queue,
+                                sent_callback=self.notification_sent,
+                                send_queue=self._send_queue,
+                                latency_callback=self._observe_latency,
+                                retry_callback=self.retry.schedule,
+                                canonical_ids=self.canonical_ids,
+                                name=self.name, session=self.session,
+                                url=self.url, rate_limiter=self.rate_limiter)
 
     def get_feedback(self, block=True, timeout=None):
         return self.feedback_queue.get(
@@ -186,13 +475,77 @@ class GCMService(BaseService):
             timeout=timeout)
 
     def queue_notification(self, notification):
-        self.workers[self.next_worker].queue_notification(notification)
-        self.next_worker = (self.next_worker + 1) % WORKER_COUNT
+        if self.canonical_ids is not None:
+            self.canonical_ids.rewrite(notification)
+        self.backlog.add(notification)
+        if self.collapse(notification):
+            return
+        if self.coalescer is not None:
+            self.coalescer.add(notification)
+        else:
+            self._dispatch(notification)
+
+    def _dispatch(self, notification):
+        self._dispatched += 1
+        self._send_queue.put(notification)
+
+    def _observe_latency(self, elapsed):
+        self.latency = (LATENCY_ALPHA * elapsed +
+                        (1 - LATENCY_ALPHA) * self.latency)
+
+    def _spawn_worker(self):
+        worker_id = min(set(range(self.max_workers)) - set(self.workers))
+        worker = self.workers[worker_id] = self._create_worker(worker_id)
+        worker.start()
+
+    def _retire_worker(self, worker):
+        del self.workers[worker.worker_id]
+        worker.kill()
+
+    def scale(self, interval=SCALE_INTERVAL):
+        """
+        Resizes the pool to the number of workers needed to send the
+        messages dispatched during the last ``interval`` seconds, plus
+        the ones still queued, within ``interval`` seconds (Little's
+        law). The pool grows at once, but shrinks by at most half the
+        excess at a time, and only by retiring idle workers.
+        """
+        demand = (self._dispatched + self._send_queue.qsize()) / interval
+        self._dispatched = 0
+        target = int(math.ceil(demand * self.latency))
+        target = max(self.min_workers, min(self.max_workers, target))
+        count = len(self.workers)
+        if target > count:
+            logger.debug("Growing GCM worker pool to %d" % target)
+            for i in range(target - count):
+                self._spawn_worker()
+        elif target < count:
+            idle = [w for w in self.workers.values() if not w.busy]
+            for worker in idle[:max(1, (count - target) // 2)]:
+                self._retire_worker(worker)
+
+    def _scale_loop(self):
+        try:
+            while True:
+                gevent.sleep(SCALE_INTERVAL)
+                self.scale(SCALE_INTERVAL)
+        except gevent.GreenletExit:
+            pass
 
     def start(self):
-        for w in self.workers:
-            w.start()
+        for i in range(self.min_workers):
+            self._spawn_worker()
+        self._scale_greenlet = gevent.spawn(self._scale_loop)
+        self.retry.start()
 
     def stop(self, timeout=10.0):
-        for w in self.workers:
-            w.stop()
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        if self._scale_greenlet is not None:
+            gevent.kill(self._scale_greenlet)
+            self._scale_greenlet = None
+        clean = self._send_queue.join(timeout=timeout)
+        self.retry.stop()
+        for worker in list(self.workers.values()):
+            self._retire_worker(worker)
+        return clean and not len(self.retry)
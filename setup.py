@@ -24,6 +24,11 @@ setup(
     keywords='push notifications apns gcm',
     packages=find_packages(),
     install_requires=requires,
+    extras_require={
+        'http2': ['h2>=3.0.1'],
+        'msgpack': ['msgpack>=0.6.0'],
+        'orjson': ['orjson>=2.0'],
+    },
     zip_safe=False,
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,26 @@
+import os
+import subprocess
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def certfile(tmp_path_factory):
+    """
+    Self-signed certificate and key, in one file, for the APNS services
+    and the stand-in servers they connect to.
+    """
+    directory = tmp_path_factory.mktemp('cert')
+    cert = str(directory / 'cert.pem')
+    key = str(directory / 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', key, '-out', cert, '-days', '1',
+         '-subj', '/CN=localhost'], stderr=subprocess.DEVNULL)
+    path = str(directory / 'apns.pem')
+    with open(path, 'w') as f:
+        for name in (cert, key):
+            with open(name) as part:
+                f.write(part.read())
+    os.chmod(path, 0o600)
+    return path
@@ -0,0 +1,79 @@
+"""
+Local stand-ins for the push services, for the tests to send to.
+"""
+import json
+
+from gevent import ssl
+from gevent.server import StreamServer
+from h2 import events as h2_events
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+
+
+class APNSHTTP2Stub(object):
+    """
+    Stand-in for the APNS HTTP/2 provider API, listening on a random
+    port of localhost. Records the (token, headers, payload) of each
+    request, and answers with the (status, reason) ``respond`` returns
+    for them, 200 by default.
+    """
+
+    def __init__(self, certfile, respond=None):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile)
+        context.set_alpn_protocols(['h2'])
+        self.respond = respond or (lambda token, headers, payload:
+                                   (200, None))
+        self.requests = []
+        self.server = StreamServer(('127.0.0.1', 0), self.handle,
+                                   ssl_context=context)
+
+    @property
+    def address(self):
+        return ('localhost', self.server.server_port)
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def handle(self, sock, address):
+        conn = H2Connection(config=H2Configuration(
+            client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+        # stream id -> (headers, body)
+        streams = {}
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            for event in conn.receive_data(data):
+                if isinstance(event, h2_events.RequestReceived):
+                    streams[event.stream_id] = (dict(event.headers), [])
+                elif isinstance(event, h2_events.DataReceived):
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+                    streams[event.stream_id][1].append(event.data)
+                elif isinstance(event, h2_events.StreamEnded):
+                    headers, body = streams.pop(event.stream_id)
+                    self.answer(conn, event.stream_id, headers,
+                                b''.join(body))
+                elif isinstance(event, h2_events.ConnectionTerminated):
+                    sock.sendall(conn.data_to_send())
+                    return
+            sock.sendall(conn.data_to_send())
+
+    def answer(self, conn, stream_id, headers, body):
+        token = headers[':path'].rsplit('/', 1)[-1]
+        payload = json.loads(body.decode('utf8'))
+        self.requests.append((token, headers, payload))
+        status, reason = self.respond(token, headers, payload)
+        data = b''
+        if reason is not None:
+            data = json.dumps(dict(reason=reason, timestamp=1000)).encode()
+        conn.send_headers(stream_id, [(':status', str(status))],
+                          end_stream=not data)
+        if data:
+            conn.send_data(stream_id, data, end_stream=True)
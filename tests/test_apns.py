@@ -0,0 +1,76 @@
+import json
+import struct
+from unittest import mock
+
+import pytest
+
+from pulsus.services.apns import APNSNotification, APNSService
+
+
+class Connection(object):
+    """Gateway connection replying with the given messages."""
+
+    def __init__(self, *messages):
+        self.messages = list(messages)
+        self.closed = False
+
+    def recv(self, size):
+        return self.messages.pop(0) if self.messages else b''
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def service(certfile):
+    return APNSService(sandbox=False, certfile=certfile)
+
+
+def sent(service, count):
+    for identifier in range(1, count + 1):
+        service._sent[identifier] = APNSNotification(
+            token='ab' * 32, identifier=identifier)
+
+
+def test_error_response_requeues_later_notifications(service):
+    connection = Connection(struct.pack('!bbI', 8, 8, 1))
+    service._push_connection = connection
+    sent(service, 3)
+    service._error_loop(connection)
+    assert connection.closed
+    assert service._push_connection is None
+    assert not service._sent
+    assert [service._send_queue.get_nowait().identifier
+            for _ in range(2)] == [2, 3]
+    assert service.get_error(block=False) == (8, 1)
+
+
+def test_error_loop_keeps_new_connection(service):
+    old = Connection()
+    new = Connection()
+    # The send loop connected again before the error loop finished
+    service._push_connection = new
+    sent(service, 3)
+    service._error_loop(old)
+    assert old.closed
+    assert not new.closed
+    assert service._push_connection is new
+    assert len(service._sent) == 3
+    assert service._send_queue.qsize() == 0
+
+
+def test_payload_encoded_once():
+    notifications = [
+        APNSNotification(token='%02x' % i * 32, alert='Hello',
+                         extra={'url': '/once'}, identifier=i)
+        for i in range(3)]
+    with mock.patch('pulsus.services.apns.notification.json.dumps',
+                    wraps=json.dumps) as dumps:
+        for notification in notifications:
+            notification.size()
+            frame = notification.pack()
+            notification.payload()
+        # extra once per notification, the payload once for all of them
+        assert dumps.call_count == 3 + 1
+    assert notifications[0].payload() is notifications[2].payload()
+    assert frame.endswith(b'{"aps":{"alert":"Hello"},"url":"/once"}')
@@ -0,0 +1,114 @@
+from queue import Empty
+
+import gevent
+import pytest
+
+pytest.importorskip('h2')
+
+from pulsus.services.apns import APNSHTTP2Service, APNSNotification  # noqa
+from stubs import APNSHTTP2Stub  # noqa
+
+
+TOKEN = 'ab' * 32
+INVALID_TOKEN = 'cd' * 32
+
+
+def respond(token, headers, payload):
+    if token == INVALID_TOKEN:
+        return 410, 'Unregistered'
+    if payload['aps']['alert'] == 'rejected':
+        return 400, 'PayloadEmpty'
+    return 200, None
+
+
+@pytest.fixture
+def stub(certfile):
+    stub = APNSHTTP2Stub(certfile, respond)
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def service(stub, certfile):
+    service = APNSHTTP2Service(sandbox=False, certfile=certfile,
+                               gateway=stub.address, cafile=certfile,
+                               topic='com.example.app', connection_count=2,
+                               max_concurrent_streams=10)
+    service.start()
+    yield service
+    service.stop(timeout=1)
+
+
+def wait_for(condition, timeout=5):
+    with gevent.Timeout(timeout):
+        while not condition():
+            gevent.sleep(0.01)
+
+
+def test_send(stub, service):
+    sent = []
+    service.on_sent = sent.append
+    for i in range(50):
+        service.queue_notification(APNSNotification(
+            token=TOKEN, alert='Hello %d' % i, collapse_id='greeting'))
+    wait_for(lambda: len(sent) == 50)
+    assert len(stub.requests) == 50
+    token, headers, payload = stub.requests[0]
+    assert token == TOKEN
+    assert headers['apns-topic'] == 'com.example.app'
+    assert headers['apns-collapse-id'] == 'greeting'
+    assert sorted(p['aps']['alert'] for _, _, p in stub.requests) == \
+        sorted('Hello %d' % i for i in range(50))
+    assert service.backlog.count == 0
+
+
+def test_invalid_token(stub, service):
+    service.queue_notification(APNSNotification(token=INVALID_TOKEN,
+                                                alert='Hello'))
+    feedback = service.get_feedback(timeout=5)
+    assert feedback.token == INVALID_TOKEN
+    assert feedback.timestamp == 1.0
+    assert service.get_error(timeout=1) == ('Unregistered', 0)
+
+
+def test_rejected(stub, service):
+    service.queue_notification(APNSNotification(token=TOKEN,
+                                                alert='rejected',
+                                                identifier=7))
+    assert service.get_error(timeout=5) == ('PayloadEmpty', 7)
+    with pytest.raises(Empty):
+        service.get_feedback(block=False)
+
+
+def test_throttled(stub, service):
+    statuses = [429]
+    stub.respond = lambda token, headers, payload: (
+        (statuses.pop(), 'TooManyRequests') if statuses else (200, None))
+    sent = []
+    service.on_sent = sent.append
+    service.queue_notification(APNSNotification(token=TOKEN, alert='Hi'))
+    wait_for(lambda: sent, timeout=10)
+    assert len(stub.requests) == 2
+    assert service.rate_limiter.throttle_count == 1
+
+
+def test_stop_waits_for_sends_in_flight(stub, service):
+    stub.respond = lambda token, headers, payload: (
+        gevent.sleep(0.2) or (200, None))
+    sent = []
+    service.on_sent = sent.append
+    for i in range(5):
+        service.queue_notification(APNSNotification(token=TOKEN,
+                                                    alert='Hi %d' % i))
+    gevent.sleep(0.05)
+    assert service.stop(timeout=5)
+    assert len(sent) == 5
+
+
+def test_stop_timeout_with_sends_in_flight(stub, service):
+    stub.respond = lambda token, headers, payload: (
+        gevent.sleep(1) or (200, None))
+    service.queue_notification(APNSNotification(token=TOKEN, alert='Hi'))
+    gevent.sleep(0.05)
+    assert not service.stop(timeout=0.1)
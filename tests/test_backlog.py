@@ -0,0 +1,25 @@
+import time
+
+from pulsus.services.base.backlog import MAX_RETRY_AFTER, Backlog
+
+
+def test_retry_after_decays_while_stalled():
+    backlog = Backlog(max_count=100)
+    backlog.count = 100
+    backlog.rate = 50.0
+    backlog._rate_started = time.time()
+    assert backlog.retry_after(50) == 1
+    # Nothing removed since
+    backlog._rate_started -= 10
+    assert backlog.retry_after(50) == 10
+    backlog._rate_started -= 50
+    assert backlog.retry_after(50) == MAX_RETRY_AFTER
+
+
+def test_retry_after_keeps_rate_while_draining():
+    backlog = Backlog(max_count=100)
+    backlog.count = 100
+    backlog.rate = 50.0
+    backlog._rate_started = time.time() - 10
+    backlog._rate_count = 500
+    assert backlog.retry_after(40) == 1
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from werkzeug.test import Client
+
+from pulsus.server.aio import AsyncAPIServer
+from pulsus.server.feedback import FeedbackLog
+from pulsus.server.server import APIServer
+from pulsus.services.apns import APNSService
+from pulsus.services.apns.aio import AsyncAPNSService
+from pulsus.services.gcm import GCMService
+from pulsus.services.gcm.aio import AsyncGCMService
+
+
+def post_gevent(certfile, log, path, body):
+    server = APIServer(
+        apns=APNSService(sandbox=False, certfile=certfile),
+        apns_sandbox=APNSService(sandbox=True, certfile=certfile),
+        gcm=GCMService('key'), feedback_log=log)
+    resp = Client(server).post(path, data=body,
+                               content_type='application/json')
+    return resp.status_code, resp.get_data(as_text=True)
+
+
+def post_asyncio(certfile, log, path, body):
+    async def call():
+        server = AsyncAPIServer(
+            apns=AsyncAPNSService(sandbox=False, certfile=certfile),
+            apns_sandbox=AsyncAPNSService(sandbox=True, certfile=certfile),
+            gcm=AsyncGCMService('key'), feedback_log=log)
+        messages = [{'type': 'http.request', 'body': body,
+                     'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'path': path, 'method': 'POST',
+                 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json')]}
+        await server(scope, receive, send)
+        return sent[0]['status'], sent[1]['body'].decode('utf8')
+    return asyncio.run(call())
+
+
+@pytest.fixture(params=[post_gevent, post_asyncio],
+                ids=['gevent', 'asyncio'])
+def post(request, certfile, tmp_path):
+    log = FeedbackLog(str(tmp_path / 'log'))
+
+    def post(path, body):
+        return request.param(certfile, log, path, body)
+    post.log = log
+    return post
+
+
+@pytest.mark.parametrize('body', [
+    b'not json', b'{}', b'[]', b'{"cursor": null}', b'{"cursor": "x"}'])
+def test_ack_invalid(post, body):
+    status, _ = post('/api/feedback/ack/', body)
+    assert status == 400
+
+
+def test_ack(post):
+    post.log.append([dict(token='a'), dict(token='b')])
+    entries, cursor, more = post.log.read(limit=1)
+    status, body = post('/api/feedback/ack/',
+                        json.dumps(dict(cursor=cursor)).encode('utf8'))
+    assert status == 200
+    assert json.loads(body) == dict(cursor=cursor)
+
+
+def test_drain_rejected_with_log(post):
+    post.log.append([dict(token='a')])
+    status, _ = post('/api/feedback/', b'')
+    assert status == 409
+    entries, _, _ = post.log.read()
+    assert [entry['token'] for entry in entries] == ['a']
+
+
+def test_log_read_limit(tmp_path):
+    log = FeedbackLog(str(tmp_path))
+    log.append([dict(n=n) for n in range(5)])
+    entries, cursor, more = log.read(limit=2)
+    assert [entry['n'] for entry in entries] == [0, 1]
+    assert more
+    entries, cursor, more = log.read(cursor, limit=3)
+    assert [entry['n'] for entry in entries] == [2, 3, 4]
+    assert not more
+    entries, _, more = log.read(cursor)
+    assert entries == [] and not more
+
+
+def test_log_ack_across_segments(tmp_path):
+    directory = str(tmp_path)
+    log = FeedbackLog(directory, segment_size=1)
+    for n in range(4):
+        log.append([dict(n=n)])
+    segments = sorted(name for name in os.listdir(directory)
+                      if name.endswith('.ndjson'))
+    assert len(segments) == 4
+    entries, _, _ = log.read()
+    # Up to the end of the third segment
+    acked = log.ack(entries[2]['cursor'])
+    assert acked == entries[2]['cursor']
+    assert sorted(name for name in os.listdir(directory)
+                  if name.endswith('.ndjson')) == segments[3:]
+    entries, _, _ = log.read()
+    assert [entry['n'] for entry in entries] == [3]
+    # Acknowledging less changes nothing
+    assert log.ack(0) == acked
+
+
+def test_log_invalid_cursor(tmp_path):
+    log = FeedbackLog(str(tmp_path), segment_size=1)
+    log.append([dict(n=0)])
+    log.append([dict(n=1)])
+    entries, end, _ = log.read()
+    with pytest.raises(ValueError):
+        log.read(end + 1)
+    with pytest.raises(ValueError):
+        # Not at the start of an entry
+        log.read(entries[0]['cursor'] - 1)
+    log.ack(entries[0]['cursor'])
+    # A stale cursor reads from the first unacknowledged entry
+    entries, _, _ = log.read(0)
+    assert [entry['n'] for entry in entries] == [1]
+    # Acknowledging past the end stops at the end
+    assert log.ack(end + 100) == end
+
+
+def fork(target):
+    pid = os.fork()
+    if not pid:
+        status = 1
+        try:
+            target()
+            status = 0
+        finally:
+            os._exit(status)
+    return pid
+
+
+def test_log_shared_by_processes(tmp_path):
+    directory = str(tmp_path)
+    count = 300
+
+    def write():
+        writer = FeedbackLog(directory, segment_size=512)
+        for n in range(count):
+            writer.append([dict(n=n)])
+
+    def peek():
+        # Reads while the other reader acknowledges, and segments go
+        peeker = FeedbackLog(directory, segment_size=512)
+        for _ in range(200):
+            entries, _, _ = peeker.read(limit=20)
+            numbers = [entry['n'] for entry in entries]
+            if numbers:
+                assert numbers == list(
+                    range(numbers[0], numbers[0] + len(numbers)))
+
+    pids = [fork(write), fork(peek)]
+    reader = FeedbackLog(directory, segment_size=512)
+    seen = []
+    cursor = None
+    deadline = time.time() + 30
+    while len(seen) < count and time.time() < deadline:
+        entries, cursor, _ = reader.read(cursor, limit=50)
+        seen.extend(entry['n'] for entry in entries)
+        reader.ack(cursor)
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+    assert seen == list(range(count))
+    entries, _, more = FeedbackLog(directory).read()
+    assert entries == [] and not more
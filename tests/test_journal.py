@@ -0,0 +1,63 @@
+import os
+
+from pulsus.server.journal import NotificationJournal
+
+
+def log_files(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith('.log'))
+
+
+def test_segment_rollover(tmp_path):
+    directory = str(tmp_path)
+    journal = NotificationJournal(directory, segment_entries=4)
+    offsets = [journal.append(dict(n=n)) for n in range(10)]
+    assert offsets == list(range(10))
+    assert log_files(directory) == [
+        '%020d.log' % base for base in (0, 4, 8)]
+    for offset in range(3):
+        journal.ack(offset)
+    assert len(log_files(directory)) == 3
+    journal.ack(3)
+    # Fully acknowledged, the first segment is removed
+    assert log_files(directory) == ['%020d.log' % base for base in (4, 8)]
+    for offset in range(8, 10):
+        journal.ack(offset)
+    # The current segment is kept, it is still being appended to
+    assert len(log_files(directory)) == 2
+    journal.close()
+
+
+def test_replay_after_reopen(tmp_path):
+    directory = str(tmp_path)
+    journal = NotificationJournal(directory, segment_entries=4)
+    for n in range(6):
+        journal.append(dict(n=n))
+    for offset in (0, 2, 5):
+        journal.ack(offset)
+    journal.close()
+    journal = NotificationJournal(directory, segment_entries=4)
+    assert list(journal.replay()) == [
+        (1, dict(n=1)), (3, dict(n=3)), (4, dict(n=4))]
+    # Appending carries on after the records replayed
+    assert journal.append(dict(n=6)) == 6
+    journal.close()
+
+
+def test_partial_record_truncated(tmp_path):
+    directory = str(tmp_path)
+    journal = NotificationJournal(directory)
+    journal.append(dict(n=0))
+    journal.append(dict(n=1))
+    journal.close()
+    path = os.path.join(directory, '%020d.log' % 0)
+    with open(path, 'ab') as f:
+        f.write(b'{"n": 2')
+    journal = NotificationJournal(directory)
+    assert list(journal.replay()) == [(0, dict(n=0)), (1, dict(n=1))]
+    assert journal.append(dict(n=3)) == 2
+    journal.close()
+    journal = NotificationJournal(directory)
+    assert [record for _, record in journal.replay()] == [
+        dict(n=0), dict(n=1), dict(n=3)]
+    journal.close()
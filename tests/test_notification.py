@@ -0,0 +1,22 @@
+import subprocess
+import sys
+
+import pytest
+
+from pulsus.services.base import BaseNotification
+
+
+def test_deserialize_without_importing_services():
+    # A fresh interpreter, as the services are imported by other tests
+    code = '\n'.join([
+        'from pulsus.services.base import BaseNotification',
+        'n = BaseNotification.deserialize(',
+        '    {"type": "apns", "data": {"token": "ab" * 32}})',
+        'print(type(n).__name__)'])
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'APNSNotification'
+
+
+def test_deserialize_unknown_type():
+    with pytest.raises(ValueError):
+        BaseNotification.deserialize({'type': 'unknown', 'data': {}})
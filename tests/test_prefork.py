@@ -0,0 +1,26 @@
+import signal
+
+import pytest
+
+from pulsus.server import prefork
+from pulsus.server.prefork import PreforkServer
+
+
+@pytest.fixture
+def fast_restart(monkeypatch):
+    monkeypatch.setattr(prefork, 'RESTART_DELAY', 0.01)
+    handlers = {signum: signal.getsignal(signum) for signum in
+                (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_gives_up_on_crashing_workers(fast_restart):
+    def make_app(worker_id):
+        raise RuntimeError('Broken config')
+
+    server = PreforkServer('127.0.0.1', 0, 2, make_app, max_crashes=3)
+    assert server.serve_forever() is False
+    assert len(server.crashes) == 4
+    assert not server.workers
@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+import pytest
+from werkzeug.test import Client
+
+from pulsus.serialization import content_types, get_codec
+from pulsus.server.aio import AsyncAPIServer
+from pulsus.server.api import MAX_REJECTED
+from pulsus.server.server import APIServer
+from pulsus.services.apns import APNSNotification, APNSService
+from pulsus.services.apns.aio import AsyncAPNSService
+from pulsus.services.gcm import GCMService
+from pulsus.services.gcm.aio import AsyncGCMService
+
+
+TOKEN = 'ab' * 32
+
+
+def notification(**kwargs):
+    return APNSNotification(token=TOKEN, alert='Hello', sandbox=False,
+                            **kwargs).serialize()
+
+
+def push_gevent(certfile, body, content_type='application/json'):
+    server = APIServer(
+        apns=APNSService(sandbox=False, certfile=certfile),
+        apns_sandbox=APNSService(sandbox=True, certfile=certfile),
+        gcm=GCMService('key'))
+    resp = Client(server).post('/api/push/', data=body,
+                               content_type=content_type)
+    return resp.status_code, resp.get_data(as_text=True)
+
+
+def push_asyncio(certfile, body, content_type='application/json'):
+    async def call():
+        server = AsyncAPIServer(
+            apns=AsyncAPNSService(sandbox=False, certfile=certfile),
+            apns_sandbox=AsyncAPNSService(sandbox=True, certfile=certfile),
+            gcm=AsyncGCMService('key'))
+        messages = [{'type': 'http.request', 'body': body,
+                     'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'path': '/api/push/', 'method': 'POST',
+                 'query_string': b'',
+                 'headers': [(b'content-type', content_type.encode())]}
+        await server(scope, receive, send)
+        return sent[0]['status'], sent[1]['body'].decode('utf8')
+    return asyncio.run(call())
+
+
+@pytest.fixture(params=[push_gevent, push_asyncio],
+                ids=['gevent', 'asyncio'])
+def push(request, certfile):
+    def push(notifications):
+        return request.param(certfile,
+                             json.dumps(notifications).encode('utf8'))
+    return push
+
+
+def test_push(push):
+    status, _ = push([notification()])
+    assert status == 201
+
+
+@pytest.mark.parametrize('data, error', [
+    (dict(notification(), app='unknown'), 'Unknown app'),
+    (dict(notification(), type='unknown'), 'Unknown notification type'),
+    (dict(notification(), data=dict(token='ab')), 'Token'),
+    ({'data': {}}, 'type'),
+])
+def test_push_invalid(push, data, error):
+    status, body = push([notification(), data])
+    assert status == 400
+    assert error in body
+
+
+def test_push_invalid_queues_nothing(certfile):
+    server = APIServer(
+        apns=APNSService(sandbox=False, certfile=certfile),
+        apns_sandbox=APNSService(sandbox=True, certfile=certfile),
+        gcm=GCMService('key'))
+    resp = Client(server).post(
+        '/api/push/',
+        data=json.dumps([notification(), dict(notification(), app='x')]))
+    assert resp.status_code == 400
+    assert server.registry.get(None, 'apns').backlog.count == 0
+
+
+@pytest.mark.parametrize('content_type', [
+    'application/x-www-form-urlencoded', 'text/plain', 'application/xml'])
+@pytest.mark.parametrize('engine', [push_gevent, push_asyncio],
+                         ids=['gevent', 'asyncio'])
+def test_push_unsupported_content_type(certfile, engine, content_type):
+    body = json.dumps([notification()]).encode('utf8')
+    status, _ = engine(certfile, body, content_type)
+    assert status == 415
+
+
+@pytest.mark.parametrize('content_type', content_types())
+@pytest.mark.parametrize('engine', [push_gevent, push_asyncio],
+                         ids=['gevent', 'asyncio'])
+def test_push_unknown_priority(certfile, engine, content_type):
+    body = get_codec(content_type).dumps(
+        [dict(notification(), priority='urgent')])
+    status, body = engine(certfile, body, content_type)
+    assert status == 400
+    assert 'Unknown priority' in body
+
+
+def test_push_stream_unknown_priority(certfile):
+    server = APIServer(
+        apns=APNSService(sandbox=False, certfile=certfile),
+        apns_sandbox=APNSService(sandbox=True, certfile=certfile),
+        gcm=GCMService('key'))
+    lines = [notification(), dict(notification(), priority='urgent')]
+    resp = Client(server).post(
+        '/api/push/', data=''.join(json.dumps(l) + '\n' for l in lines),
+        content_type='application/x-ndjson')
+    summary = json.loads(resp.get_data())
+    assert resp.status_code == 201
+    assert summary['accepted'] == 1
+    assert summary['rejected'] == [
+        dict(line=2, error='Unknown priority: urgent')]
+
+
+def test_push_stream_rejected_bounded(certfile):
+    server = APIServer(
+        apns=APNSService(sandbox=False, certfile=certfile),
+        apns_sandbox=APNSService(sandbox=True, certfile=certfile),
+        gcm=GCMService('key'))
+    lines = ['garbage\n'] * (MAX_REJECTED + 50) + [
+        json.dumps(notification()) + '\n']
+    resp = Client(server).post('/api/push/', data=''.join(lines),
+                               content_type='application/x-ndjson')
+    summary = json.loads(resp.get_data())
+    assert summary['accepted'] == 1
+    assert summary['rejected_count'] == MAX_REJECTED + 50
+    assert len(summary['rejected']) == MAX_REJECTED
+    assert summary['rejected'][0]['line'] == 1
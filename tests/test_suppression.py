@@ -0,0 +1,73 @@
+import asyncio
+
+from pulsus.server.aio import AsyncSuppressionIndex
+from pulsus.server.suppression import SuppressionIndex
+from pulsus.services.gcm import GCMJSONMessage
+
+
+def test_scoped_by_service():
+    index = SuppressionIndex()
+    index.add('apns_sandbox', 'token')
+    index.add('gcm:app', 'a')
+    assert index.contains('apns_sandbox', 'token')
+    assert not index.contains('apns', 'token')
+    message = GCMJSONMessage(['a', 'b'], data={})
+    assert index.filter(message, 'gcm') == (0, 2)
+    assert index.filter(message, 'gcm:app') == (1, 1)
+    assert message.registration_ids == ['b']
+
+
+def test_shared_file(tmp_path):
+    path = str(tmp_path / 'suppression.idx')
+    first = SuppressionIndex(path=path)
+    second = SuppressionIndex(path=path)
+    first.add('apns', 'a')
+    second.add('apns', 'b')
+    first.sync()
+    second.sync()
+    assert second.contains('apns', 'a')
+    assert second.contains('apns', 'b')
+    first.sync()
+    assert first.contains('apns', 'b')
+    # Nothing changed, nothing to load
+    assert first._exchange() == ([], first._version)
+    third = SuppressionIndex(path=path)
+    assert len(third) == 2
+
+
+def test_expired(tmp_path):
+    path = str(tmp_path / 'suppression.idx')
+    index = SuppressionIndex(ttl=10, path=path)
+    index.add('apns', 'a', timestamp=0)
+    index.add('apns', 'b')
+    index.save()
+    assert not index.contains('apns', 'a')
+    assert len(SuppressionIndex(path=path)) == 1
+
+
+def test_added_while_writing(tmp_path):
+    path = str(tmp_path / 'suppression.idx')
+    index = SuppressionIndex(path=path)
+    index.add('apns', 'a')
+    snapshot = index._snapshot(True)
+    # Reported while the snapshot is being written
+    index.add('apns', 'b')
+    index._merge(*index._exchange(snapshot))
+    assert index.dirty
+    index.sync()
+    assert len(SuppressionIndex(path=path)) == 2
+
+
+def test_async_shared_file(tmp_path):
+    path = str(tmp_path / 'suppression.idx')
+
+    async def run():
+        first = AsyncSuppressionIndex(path=path)
+        second = AsyncSuppressionIndex(path=path)
+        first.add('apns', 'a')
+        await first.sync()
+        await second.sync()
+        assert second.contains('apns', 'a')
+        await second.save()
+    asyncio.run(run())
+    assert len(SuppressionIndex(path=path)) == 1